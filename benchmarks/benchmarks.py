@@ -0,0 +1,208 @@
+"""
+Benchmarks of the ABC simulation core for airspeed velocity (asv).
+
+Run from the repository root with `asv run` to benchmark commits, or
+`asv dev` to check the working tree in the current environment. Each
+benchmark is parametrised over the bundled example models and uses a
+fixed set of parameter samples drawn from the priors of the example
+notebooks so timings are comparable between commits.
+
+`time_*` benchmarks measure one call, except `Simulation.time_model`
+which simulates `N_PARTICLES` particles, and `peakmem_*` benchmarks the
+peak resident memory of the process during the call.
+"""
+
+import importlib
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from ionchannelABC import (setup,
+                           get_observations_df,
+                           IonChannelDistance,
+                           DiscrepancyKernel,
+                           EfficientMultivariateNormalTransition,
+                           SUM_STATS_KEY)
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'docs', 'examples')
+
+# Example name: (example directory, model file, experiments as
+# (module, name) and prior limits from the example notebooks).
+CASES = {
+    'standardised_ina': (
+        'human-atrial',
+        'models/standardised_ina.mmt',
+        [('ina_sakakibara', 'sakakibara_act_nyg_adjust'),
+         ('ina_sakakibara', 'sakakibara_inact_nyg_adjust'),
+         ('ina_schneider', 'schneider_taum_nyg_adjust'),
+         ('ina_sakakibara', 'sakakibara_inact_kin_nyg_adjust'),
+         ('ina_sakakibara', 'sakakibara_rec_nyg_adjust')],
+        {'log_ina.A': (0., 1.),
+         'log_ina.p_1': (1., 5.),
+         'ina.p_2': (1e-7, 0.2),
+         'log_ina.p_3': (-3., 1.),
+         'ina.p_4': (1e-7, 0.4),
+         'log_ina.p_5': (-1., 3.),
+         'ina.p_6': (1e-7, 0.2),
+         'log_ina.p_7': (-4., 0.),
+         'ina.p_8': (1e-7, 0.2)}),
+    'courtemanche_ina': (
+        'human-atrial',
+        'models/courtemanche_ina.mmt',
+        [('ina_sakakibara', 'sakakibara_act'),
+         ('ina_schneider', 'schneider_taum_cou_adjust')],
+        {'ina.a1_m': (-100, 0),
+         'ina.a2_m': (0, 1),
+         'ina.a3_m': (0, 1),
+         'ina.a4_m': (0, 10),
+         'ina.b1_m': (0, 10),
+         'ina.b2_m': (0, 100)}),
+    'ikr_markov': (
+        'hl1',
+        'models/ikr_markov.mmt',
+        [('ikr_markov', 'toyoda_iv'),
+         ('ikr_markov', 'toyoda_taua'),
+         ('ikr_markov', 'toyoda_deact_single_exp'),
+         ('ikr_markov', 'toyoda_trec'),
+         ('ikr_markov', 'toyoda_inact')],
+        {'log_ikr.p_1': (-7., 3.),
+         'ikr.p_2': (1e-7, 0.4),
+         'log_ikr.p_3': (-7., 3.),
+         'ikr.p_4': (1e-7, 0.4),
+         'log_ikr.p_5': (-7., 3.),
+         'ikr.p_6': (1e-7, 0.4),
+         'log_ikr.p_7': (-7., 3.),
+         'ikr.p_8': (1e-7, 0.4),
+         'ikr.g_Kr': (0., 10.)}),
+}
+
+N_PARTICLES = 10
+N_POPULATION = 1000
+
+
+def load_experiments(example, experiments):
+    """Import experiments from an example directory.
+
+    Example experiment modules import `data` and `custom_protocols` from
+    their example directory, and both examples have an `experiments`
+    package, so these are imported afresh for each example.
+    """
+    path = os.path.join(EXAMPLES, example)
+    for name in list(sys.modules):
+        if name.split('.')[0] in ('experiments', 'data', 'custom_protocols'):
+            del sys.modules[name]
+    sys.path.insert(0, path)
+    try:
+        return [getattr(importlib.import_module('experiments.'+module), name)
+                for module, name in experiments]
+    finally:
+        sys.path.remove(path)
+
+
+def prior_samples(limits, n, seed=0):
+    """Fixed uniform samples within prior limits."""
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({k: rng.uniform(a, b, size=n)
+                         for k, (a, b) in limits.items()})
+
+
+class Simulation:
+    """Per-particle simulation and summary statistics from `setup`."""
+    params = list(CASES.keys())
+    param_names = ['model']
+    timeout = 600
+
+    def setup(self, case):
+        example, modelfile, experiments, limits = CASES[case]
+        self.experiments = load_experiments(example, experiments)
+        self.modelfile = os.path.join(EXAMPLES, example, modelfile)
+        (self.observations,
+         self.model,
+         self.summary_statistics) = setup(self.modelfile, *self.experiments)
+        self.particles = (prior_samples(limits, N_PARTICLES)
+                          .to_dict(orient='records'))
+        self.data = self.model(self.particles[0])
+
+    def time_model(self, case):
+        for par in self.particles:
+            self.model(par)
+
+    def peakmem_model(self, case):
+        for par in self.particles:
+            self.model(par)
+
+    def time_summary_statistics(self, case):
+        self.summary_statistics(self.data)
+
+    def time_setup(self, case):
+        setup(self.modelfile, *self.experiments)
+
+    def peakmem_setup(self, case):
+        setup(self.modelfile, *self.experiments)
+
+    def time_get_observations_df(self, case):
+        get_observations_df(list(self.experiments))
+
+
+class Distance:
+    """Distance between simulated and observed summary statistics."""
+    params = (list(CASES.keys()), ['dict', 'array'])
+    param_names = ['model', 'sum_stats_format']
+    timeout = 600
+
+    def setup(self, case, sum_stats_format):
+        example, _, experiments, _ = CASES[case]
+        observations = get_observations_df(
+                load_experiments(example, experiments))
+        if sum_stats_format == 'array':
+            self.x_0 = {SUM_STATS_KEY: observations.y.values}
+        else:
+            self.x_0 = {str(i): y for i, y in enumerate(observations.y)}
+        self.x = {k: v*1.1 for k, v in self.x_0.items()}
+
+        self.distance = IonChannelDistance(
+                exp_id=list(observations.exp_id),
+                variance=list(observations.variance),
+                delta=0.05)
+        # First call initialises weights
+        self.distance(self.x, self.x_0, 0)
+
+        self.kernel = DiscrepancyKernel(
+                measure_var=list(observations.variance),
+                keys=list(self.x_0.keys()),
+                exp_mask=list(observations.exp_id))
+        self.kernel.initialize(t=0, get_sum_stats=lambda: [], x_0=self.x_0)
+
+    def time_ion_channel_distance(self, case, sum_stats_format):
+        self.distance(self.x, self.x_0, 0)
+
+    def time_discrepancy_kernel(self, case, sum_stats_format):
+        self.kernel(self.x, self.x_0)
+
+
+class Transition:
+    """Fitting and sampling the perturbation kernel for a population."""
+    params = list(CASES.keys())
+    param_names = ['model']
+
+    def setup(self, case):
+        limits = CASES[case][3]
+        self.X = prior_samples(limits, N_POPULATION)
+        self.w = np.ones(N_POPULATION)/N_POPULATION
+        self.transition = EfficientMultivariateNormalTransition()
+        self.transition.fit(self.X, self.w)
+
+    def time_fit(self, case):
+        EfficientMultivariateNormalTransition().fit(self.X, self.w)
+
+    def time_rvs(self, case):
+        self.transition.rvs(size=N_POPULATION)
+
+    def time_pdf(self, case):
+        self.transition.pdf(self.X)
+
+    def peakmem_rvs(self, case):
+        self.transition.rvs(size=N_POPULATION)
@@ -1,3 +1,5 @@
+import importlib
+
 from .utils import (ion_channel_sum_stats_calculator,
                     EfficientMultivariateNormalTransition,
                     IonChannelAcceptor,
@@ -8,13 +10,66 @@ from .distance import (IonChannelDistance,
 
 from .experiment import (Experiment,
                          setup,
-                         get_observations_df)
+                         get_observations_df,
+                         SummaryStatisticsSchema,
+                         SUM_STATS_KEY)
+
+from .background import BackgroundSampler
+from .posterior import (export_posterior,
+                        load_posterior)
+from .cache import ResultCache
+from .failure_region import FailureRegionCache
+from .profiling import Profiler
+from .budget import RuntimeBudget
+from .checkpoint import (EvaluationJournal,
+                         RunManager)
+from .distributed import (DistributedEvaluator,
+                          DistributedSampler,
+                          LocalQueueServer,
+                          RedisQueue,
+                          connect_local_queue,
+                          run_worker)
+from .lookahead import LookAheadSampler
+from .multifidelity import (MultiFidelity,
+                            MultiFidelityAcceptor,
+                            MultiFidelityEpsilon)
+from .storage import (export_sum_stats,
+                      load_sum_stats,
+                      prune_sum_stats,
+                      sum_stats_output)
+
+from .predictive import posterior_predictive
+from .hpd import hpd
+from .traces import (TraceEnsemble,
+                     sample_experiment_traces)
+from .store import PosteriorStore
+
+# Plotting and sensitivity analysis pull in matplotlib, seaborn and
+# scikit-learn, so are only imported on first access. This keeps worker
+# processes which only need the simulation core light.
+_lazy_imports = {
+    'plot_sim_results': '.visualization',
+    'plot_experiment_traces': '.visualization',
+    'plot_distance_weights': '.visualization',
+    'plot_parameters_kde': '.visualization',
+    'plot_solver_statistics': '.visualization',
+    'calculate_parameter_sensitivity': '.parameter_sensitivity',
+    'plot_parameter_sensitivity': '.parameter_sensitivity',
+    'plot_regression_fit': '.parameter_sensitivity',
+    'calculate_sobol_sensitivity': '.sobol_sensitivity',
+    'plot_sobol_sensitivity': '.sobol_sensitivity',
+}
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        module = importlib.import_module(_lazy_imports[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'
+                         .format(__name__, name))
 
-from .visualization import (plot_sim_results,
-                            plot_experiment_traces,
-                            plot_distance_weights,
-                            plot_parameters_kde)
 
-from .parameter_sensitivity import (calculate_parameter_sensitivity,
-                                    plot_parameter_sensitivity,
-                                    plot_regression_fit)
+def __dir__():
+    return sorted(list(globals().keys())+list(_lazy_imports.keys()))
@@ -0,0 +1,195 @@
+import hashlib
+import numpy as np
+from typing import Dict, List
+
+from pyabc import History
+from pyabc import Distribution
+
+from .posterior import is_exported_posterior, load_posterior_arrays
+
+
+def _from_log(pars: Dict[str, float]) -> Dict[str, float]:
+    """Convert `log_` prefixed parameters to linear scale."""
+    return dict([(key[4:], 10**value) if key.startswith("log")
+                 else (key, value)
+                 for key, value in pars.items()])
+
+
+class AliasTable:
+    """Walker/Vose alias table for O(1) sampling from discrete weights.
+
+    Args:
+        w (np.ndarray): Non-negative weights, need not be normalised.
+    """
+    def __init__(self, w: np.ndarray):
+        w = np.asarray(w, dtype=float)
+        n = len(w)
+        prob = w*n/np.sum(w)
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+
+        small = [i for i in range(n) if prob[i] < 1.]
+        large = [i for i in range(n) if prob[i] >= 1.]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = prob[s]
+            self.alias[s] = l
+            prob[l] = prob[l]+prob[s]-1.
+            if prob[l] < 1.:
+                small.append(l)
+            else:
+                large.append(l)
+        # Remaining entries are 1 up to numerical error
+        for i in small+large:
+            self.prob[i] = 1.
+
+    def __len__(self) -> int:
+        return len(self.prob)
+
+    def draw(self, rng: np.random.RandomState, size: int=None):
+        """Draw index (or array of indices) proportional to weights."""
+        i = rng.randint(len(self.prob), size=size)
+        u = rng.random_sample(size=size)
+        return np.where(u < self.prob[i], i, self.alias[i])
+
+
+class BackgroundSampler:
+    """Draws parameters calibrated outside of the current ABC run.
+
+    Background parameters come from the posteriors of previous pyABC runs
+    and/or an additional distribution of parameters which are not refined.
+    By default a fresh background set is drawn on every call, from the
+    global numpy random number generator (reseeded in each worker by pyABC
+    samplers). If `seed` is given, the set for a call with a key is drawn
+    from a generator seeded with `seed`, a hash of the key and the offset,
+    so results are reproducible whichever process evaluates the particle.
+    Calls without a key draw from one generator seeded with `seed`, which
+    is only reproducible within a single process.
+
+    If `n_bank` is given a fixed bank of background sets is drawn once on
+    creation. Each call is then assigned a bank entry by hashing the ABC
+    parameters, so repeated evaluations of the same particle reuse the
+    same background (common random numbers) and the model becomes
+    deterministic.
+
+    Args:
+        prev_runs (List[str]): Path to previous pyABC runs, or posteriors
+            exported with `export_posterior`, which are memory-mapped rather
+            than read from the database. Earlier runs take precedence where
+            parameters overlap.
+        additional_pars (Distribution): Additional parameters that are not
+            refined during calibration.
+        seed (int): Optional seed for the random number generator.
+        n_bank (int): Optional size of pre-drawn bank of background sets.
+        decimals (int): Rounding of ABC parameters before hashing to a
+            bank entry.
+    """
+    def __init__(self,
+                 prev_runs: List[str]=[],
+                 additional_pars: Distribution=None,
+                 seed: int=None,
+                 n_bank: int=None,
+                 decimals: int=10):
+        self.additional_pars = additional_pars
+        self.n_bank = n_bank
+        self.decimals = decimals
+        self.seed_value = seed
+        self.rng = np.random.RandomState(seed) if seed is not None else None
+
+        # Posteriors of previous runs as arrays already on linear scale,
+        # each with an alias table over the weights.
+        # Note: defaults to latest run in database file
+        self._runs = []
+        for run in prev_runs:
+            if is_exported_posterior(run):
+                # Stored on linear scale, so stays memory-mapped
+                names, values, w = load_posterior_arrays(run, linear=True)
+                names = list(names)
+            else:
+                df, w = History(run).get_distribution()
+                columns, values = list(df.columns), df.values
+                names = [key[4:] if key.startswith("log") else key
+                         for key in columns]
+                is_log = np.array([key.startswith("log") for key in columns])
+                if np.any(is_log):
+                    values = np.array(values, dtype=float)
+                    values[:, is_log] = 10**values[:, is_log]
+            self._runs.append((names, values, AliasTable(np.asarray(w))))
+
+        self.bank = None
+        if n_bank is not None:
+            self.bank = [self._draw() for _ in range(n_bank)]
+
+    @property
+    def rng(self):
+        """Random number generator for draws without a key."""
+        return self._rng if self._rng is not None else np.random
+
+    @rng.setter
+    def rng(self, rng: np.random.RandomState):
+        self._rng = rng
+
+    @property
+    def empty(self) -> bool:
+        """Whether there are any background parameters to draw."""
+        return len(self._runs) == 0 and self.additional_pars is None
+
+    def seed(self, seed: int=None):
+        """Reseed the random number generator and redraw any bank."""
+        self.seed_value = seed
+        self.rng = np.random.RandomState(seed) if seed is not None else None
+        if self.n_bank is not None:
+            self.bank = [self._draw() for _ in range(self.n_bank)]
+
+    def _draw(self, rng: np.random.RandomState=None) -> Dict[str, float]:
+        if rng is None:
+            rng = self.rng
+        pars = {}
+        if self.additional_pars is not None:
+            pars.update(_from_log(
+                {key: rv.rvs(random_state=rng)
+                 for key, rv in self.additional_pars.items()}))
+        for names, values, alias in reversed(self._runs):
+            pars.update(zip(names, values[alias.draw(rng)]))
+        return pars
+
+    def _digest(self, key: Dict[str, float]) -> str:
+        """Hash of the rounded ABC parameters."""
+        values = np.round([float(key[k]) for k in sorted(key.keys())],
+                          self.decimals)
+        return hashlib.sha1(
+            (','.join(sorted(key.keys()))).encode()+values.tobytes()
+        ).hexdigest()
+
+    def _bank_index(self, key: Dict[str, float]) -> int:
+        return int(self._digest(key), 16) % self.n_bank
+
+    def _key_rng(self,
+                 key: Dict[str, float],
+                 offset: int) -> np.random.RandomState:
+        """Generator of the particle `key`, independent of the process."""
+        return np.random.RandomState([self.seed_value % 2**32,
+                                      int(self._digest(key)[:8], 16),
+                                      offset % 2**32])
+
+    def sample(self,
+               key: Dict[str, float]=None,
+               offset: int=0) -> Dict[str, float]:
+        """Background parameters (on linear scale) for one evaluation.
+
+        Args:
+            key (Dict[str, float]): ABC parameters of the evaluation, used
+                to choose the bank entry when a bank was drawn, or the
+                random stream when seeded.
+            offset (int): Shift in the chosen bank entry or random stream,
+                e.g. to retry a failed evaluation with a different
+                background.
+        """
+        if self.empty:
+            return {}
+        if self.bank is None:
+            if key and self.seed_value is not None:
+                return self._draw(self._key_rng(key, offset))
+            return self._draw()
+        index = self._bank_index(key) if key else 0
+        return self.bank[(index+offset) % self.n_bank]
@@ -0,0 +1,117 @@
+import multiprocessing
+import numpy as np
+
+
+class RuntimeBudget:
+    """Dynamic wall-clock budget for simulating one particle.
+
+    Run times of simulations are recorded and the budget of a new particle
+    is `factor` times the `quantile` of recent run times, bounded by
+    `min_budget` and `max_budget`. A particle still running when its
+    budget is used up is stopped and treated as a failed simulation, i.e.
+    rejected.
+
+    Failed and over-budget simulations are recorded as well as successful
+    ones, otherwise the run times seen would be censored to the fast
+    successes and the budget would shrink until it rejected most
+    particles. The run time of a stopped simulation is unknown, so is
+    recorded as the time it ran for, at least the budget. This lower bound
+    only biases the quantile low when more than 1-`quantile` of particles
+    run over budget. Failures which occur quickly, e.g. a solver giving up
+    at the first step, also pull the quantile down, which is the price of
+    not conditioning the budget on the outcome.
+
+    Rejecting over-budget particles targets the posterior conditioned on
+    the model simulating within the budget, p(theta | data, runtime(theta)
+    <= budget). Since run time is a deterministic property of the
+    parameters, this truncates the posterior to exclude the slowest
+    (typically stiff, near-failure) region of parameter space, as a fixed
+    `timeout` already does. The target is only well defined for a fixed
+    budget, so the budget adapts during the first `freeze_after` recorded
+    simulations and is then held fixed for the rest of the run.
+
+    Run times are held in shared memory, so the budget is shared between
+    (and persists across) worker processes forked by pyABC samplers after
+    it is created.
+
+    Args:
+        quantile (float): Quantile of recent run times.
+        factor (float): Multiple of the quantile allowed.
+        min_budget (float): Minimum budget in seconds.
+        max_budget (float): Optional maximum budget in seconds, which also
+            applies before enough run times have been recorded.
+        min_samples (int): Number of run times recorded before the budget
+            applies.
+        window (int): Number of most recent run times used.
+        freeze_after (int): Number of recorded simulations after which
+            the budget is fixed. Never fixed if None.
+    """
+    def __init__(self,
+                 quantile: float=0.9,
+                 factor: float=10.,
+                 min_budget: float=1.,
+                 max_budget: float=None,
+                 min_samples: int=50,
+                 window: int=1000,
+                 freeze_after: int=1000):
+        self.quantile = quantile
+        self.factor = factor
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        self.min_samples = min_samples
+        self.window = window
+        self.freeze_after = freeze_after
+
+        ctx = multiprocessing.get_context('fork')
+        self._times = ctx.Array('d', window, lock=False)
+        self._n = ctx.Value('l', 0)
+        self._n_over = ctx.Value('l', 0)
+        self._frozen = ctx.Value('d', np.nan)
+
+    def budget(self) -> float:
+        """Budget in seconds for a new particle, or None if unlimited."""
+        frozen = self._frozen.value
+        if not np.isnan(frozen):
+            return frozen
+        with self._n.get_lock():
+            n = self._n.value
+            times = np.frombuffer(self._times, dtype=float)[:min(n,
+                                                                 self.window)]
+            times = times.copy()
+        if n < self.min_samples:
+            return self.max_budget
+        budget = max(self.factor*np.quantile(times, self.quantile),
+                     self.min_budget)
+        if self.max_budget is not None:
+            budget = min(budget, self.max_budget)
+        if self.freeze_after is not None and n >= self.freeze_after:
+            self._frozen.value = budget
+        return budget
+
+    def record(self, duration: float):
+        """Record the run time of a finished, possibly failed, simulation."""
+        with self._n.get_lock():
+            self._times[self._n.value % self.window] = duration
+            self._n.value += 1
+
+    def record_over_budget(self, duration: float):
+        """Record a simulation stopped after `duration` over its budget."""
+        with self._n_over.get_lock():
+            self._n_over.value += 1
+        self.record(duration)
+
+    @property
+    def n_completed(self) -> int:
+        """Number of simulations with recorded run times."""
+        return self._n.value
+
+    @property
+    def n_over_budget(self) -> int:
+        """Number of particles stopped for exceeding their budget."""
+        return self._n_over.value
+
+    def freeze(self, budget: float=None):
+        """Fix the budget at `budget`, or at its current value if None."""
+        if budget is None:
+            budget = self.budget()
+        self._frozen.value = np.nan if budget is None else budget
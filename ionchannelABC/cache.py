@@ -0,0 +1,261 @@
+import functools
+import hashlib
+import inspect
+import os
+import numpy as np
+from typing import Dict, List, Optional
+
+import myokit
+
+
+class CachedResult(list):
+    """Model output restored from (or added to) a `ResultCache`.
+
+    Behaves as the list of `myokit.DataLog` returned by the model, which is
+    empty if traces were not stored, and carries the raw (unnormalised)
+    summary statistics in `sum_stats`.
+    """
+    def __init__(self, traces: List[myokit.DataLog], sum_stats: List[float]):
+        super().__init__(traces)
+        self.sum_stats = sum_stats
+
+
+def _value_signature(value, seen: set) -> str:
+    """Deterministic description of a value captured by a function."""
+    if id(value) in seen:
+        return '<recursive>'
+    seen = seen | {id(value)}
+    if isinstance(value, functools.partial):
+        return 'partial({},{},{})'.format(
+            _value_signature(value.func, seen),
+            _value_signature(value.args, seen),
+            _value_signature(value.keywords, seen))
+    if inspect.isfunction(value) or inspect.ismethod(value):
+        return _function_signature(value, seen)
+    if isinstance(value, np.ndarray):
+        return 'array({},{},{})'.format(
+            value.dtype.str, value.shape,
+            hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, (list, tuple)):
+        return '{}({})'.format(type(value).__name__, ','.join(
+            _value_signature(v, seen) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return 'set({})'.format(','.join(
+            sorted(_value_signature(v, seen) for v in value)))
+    if isinstance(value, dict):
+        return 'dict({})'.format(','.join(
+            '{}:{}'.format(repr(k), _value_signature(value[k], seen))
+            for k in sorted(value.keys(), key=repr)))
+    if type(value).__repr__ is object.__repr__:
+        # Default repr includes the memory address, so describe the state
+        return '{}({})'.format(type(value).__qualname__, _value_signature(
+            getattr(value, '__dict__', {}), seen))
+    return repr(value)
+
+
+def _function_signature(f, seen: set) -> str:
+    signature = getattr(f, '__qualname__', repr(f))
+    try:
+        signature += inspect.getsource(f)
+    except (OSError, TypeError):
+        pass
+    f = getattr(f, '__func__', f)
+    defaults = (getattr(f, '__defaults__', None),
+                getattr(f, '__kwdefaults__', None))
+    if any(d is not None for d in defaults):
+        signature += _value_signature(defaults, seen)
+    closure = getattr(f, '__closure__', None)
+    if closure is not None:
+        values = []
+        for cell in closure:
+            try:
+                values.append(cell.cell_contents)
+            except ValueError:
+                values.append(None)  # Empty cell
+        signature += _value_signature(values, seen)
+    return signature
+
+
+def function_signature(f) -> str:
+    """Name and, where available, source code of a function.
+
+    Values the function captures in its closure and default arguments are
+    included, so e.g. summary statistics functions created by a factory
+    with different arguments have different signatures. Global variables
+    and the state of objects with their own `repr` are not (see the
+    `version` argument of `ResultCache`).
+    """
+    return _function_signature(f, set())
+
+
+def experiment_signature(modelfile: str, experiments: List, **options) -> str:
+    """Hash identifying a model file, set of experiments and options.
+
+    Args:
+        modelfile (str): Path to Myokit MMT file.
+        experiments (List[Experiment]): Experiments run by the model.
+        options: Any other settings which change model output, e.g.
+            logged variables or log interval.
+    """
+    h = hashlib.sha1()
+    with open(modelfile, 'rb') as f:
+        h.update(f.read())
+    for exp in experiments:
+        h.update(exp.protocol.code().encode())
+        h.update(repr(sorted(exp.conditions.items())).encode())
+        for f in exp.sum_stats:
+            h.update(function_signature(f).encode())
+    h.update(repr(sorted(options.items())).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Content-addressed on-disk cache of model evaluations.
+
+    Entries are keyed by a hash of the model file, experiment set and
+    parameter vector rounded to `significant_digits`, and hold the raw
+    summary statistics and optionally compressed simulation traces. Least
+    recently used entries are evicted once the total size exceeds
+    `max_size`.
+
+    Note entries are only reused for identical (rounded) parameters,
+    including any background parameters drawn from previous runs, so hits
+    are only expected when the model is deterministic (see the
+    `background_samples` argument of `setup`).
+
+    Summary statistics functions are identified by their source code and
+    the values in their closures and default arguments, but not by global
+    variables they use. Change `version` after changing anything else
+    which affects results to avoid reusing stale entries.
+
+    Args:
+        directory (str): Directory holding cache entries.
+        max_size (int): Maximum total size of entries in bytes.
+        significant_digits (int): Rounding of parameter values in key.
+        store_traces (bool): Whether to also store simulation traces.
+            Required if cached output is used for plotting traces.
+        version (str): Optional version included in every key.
+    """
+    def __init__(self,
+                 directory: str,
+                 max_size: int=2**30,
+                 significant_digits: int=10,
+                 store_traces: bool=False,
+                 version: str=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.significant_digits = significant_digits
+        self.store_traces = store_traces
+        self.version = version
+        os.makedirs(directory, exist_ok=True)
+
+        # Running estimate of total size to avoid scanning on every put
+        self._size = self.size()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, signature: str, pars: Dict[str, float]) -> str:
+        """Cache key for parameters evaluated under an experiment signature."""
+        rounded = ','.join('{}={:.{}g}'.format(k, float(pars[k]),
+                                               self.significant_digits)
+                           for k in sorted(pars.keys()))
+        if self.version is not None:
+            signature += 'version={}'.format(self.version)
+        return hashlib.sha1((signature+rounded).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key+'.npz')
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        """Cached result, or None if the key is not in the cache.
+
+        A cached failed simulation is returned as an empty
+        `CachedResult` with `sum_stats` None.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                if entry['failed']:
+                    result = CachedResult([], None)
+                else:
+                    traces = []
+                    for i, time_key in enumerate(entry['time_keys']):
+                        log = myokit.DataLog(time=str(time_key))
+                        prefix = '{}|'.format(i)
+                        for name in entry.files:
+                            if name.startswith(prefix):
+                                log[name[len(prefix):]] = entry[name]
+                        traces.append(log)
+                    result = CachedResult(traces,
+                                          list(entry['sum_stats']))
+        except (IOError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return result
+
+    def put(self,
+            key: str,
+            sum_stats: List[float],
+            traces: List[myokit.DataLog]=None):
+        """Add a result to the cache, evicting old entries if necessary.
+
+        Args:
+            key (str): Cache key from `key`.
+            sum_stats (List[float]): Raw summary statistics, or None if the
+                simulation failed.
+            traces (List[myokit.DataLog]): Optional simulation output, only
+                stored if `store_traces` is set.
+        """
+        arrays = {'failed': sum_stats is None,
+                  'sum_stats': np.asarray(sum_stats if sum_stats is not None
+                                          else [], dtype=float),
+                  'time_keys': np.array([])}
+        if self.store_traces and traces is not None:
+            arrays['time_keys'] = np.array([str(log.time_key())
+                                            for log in traces])
+            for i, log in enumerate(traces):
+                for name, values in log.items():
+                    arrays['{}|{}'.format(i, name)] = np.asarray(values)
+
+        # Write to temporary file then move so readers never see partial
+        # entries written by other processes.
+        path = self._path(key)
+        tmp = path+'.{}.tmp.npz'.format(os.getpid())
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, path)
+        self._size += os.path.getsize(path)
+        if self._size > self.max_size:
+            self.evict()
+
+    def size(self) -> int:
+        """Total size of cache entries in bytes."""
+        return sum(e.stat().st_size for e in os.scandir(self.directory)
+                   if e.name.endswith('.npz'))
+
+    def evict(self):
+        """Remove least recently used entries until below `max_size`."""
+        entries = [e for e in os.scandir(self.directory)
+                   if e.name.endswith('.npz') and '.tmp.' not in e.name]
+        total = sum(e.stat().st_size for e in entries)
+        self._size = total
+        if total <= self.max_size:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries:
+            if total <= self.max_size:
+                break
+            try:
+                total -= e.stat().st_size
+                os.remove(e.path)
+            except OSError:
+                pass
+        self._size = total
+
+    def clear(self):
+        """Remove all cache entries."""
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.npz'):
+                os.remove(e.path)
+        self._size = 0
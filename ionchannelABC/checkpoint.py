@@ -0,0 +1,377 @@
+import copy
+import hashlib
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, Optional, Tuple
+
+from pyabc import ABCSMC, Distribution, History
+from pyabc.parameters import Parameter
+from pyabc.transition import Transition
+
+from .utils import EfficientMultivariateNormalTransition
+
+
+def par_key(par: Dict[str, float]) -> str:
+    """Hash of exact parameter values, identifying a proposal."""
+    h = hashlib.sha1()
+    for k in sorted(par.keys()):
+        h.update(k.encode())
+        h.update(np.float64(par[k]).tobytes())
+    return h.hexdigest()
+
+
+class EvaluationJournal:
+    """On-disk journal of particle evaluations of the current generation.
+
+    Every proposal is written to the journal when it is drawn and its
+    summary statistics are added when they have been calculated, so the
+    journal holds each generation's proposals in the order they were drawn
+    whether finished or not. Each entry is a separate file written
+    atomically, so forked worker processes can share one journal.
+
+    After a crash, the entries of the generation which was in flight are
+    moved to a replay queue when that generation is restarted. Proposals
+    are then drawn from the queue first, with finished evaluations reusing
+    their stored summary statistics and unfinished ones simulated again.
+    As *all* proposals drawn before the crash are replayed, not only those
+    which finished (which would favour fast simulations), the proposals
+    remain independent draws from the same prior or transition.
+
+    Each process keeps an index of the entries it proposed or claimed, as
+    the process drawing a proposal also evaluates it, so entries are found
+    without listing the journal.
+
+    Args:
+        path (str): Directory of the journal.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.generation = None
+        self._index = {}
+
+    def _dir(self, t: int) -> str:
+        return os.path.join(self.path, str(t))
+
+    def _replay_dir(self, t: int) -> str:
+        return os.path.join(self.path, 'replay', str(t))
+
+    def set_generation(self, t: int):
+        """Start journaling generation `t`.
+
+        Entries of earlier generations, which are committed to the pyABC
+        history, are deleted. Existing entries of generation `t` are from
+        an interrupted run and are queued for replay.
+        """
+        if t == self.generation:
+            return
+        self.generation = t
+        self._index = {}
+        for d in os.listdir(self.path):
+            if d != 'replay' and d != str(t):
+                shutil.rmtree(os.path.join(self.path, d), ignore_errors=True)
+        replay_root = os.path.join(self.path, 'replay')
+        if os.path.isdir(replay_root):
+            for d in os.listdir(replay_root):
+                if d != str(t):
+                    shutil.rmtree(os.path.join(replay_root, d),
+                                  ignore_errors=True)
+        os.makedirs(self._replay_dir(t), exist_ok=True)
+        if os.path.isdir(self._dir(t)):
+            for f in os.listdir(self._dir(t)):
+                os.replace(os.path.join(self._dir(t), f),
+                           os.path.join(self._replay_dir(t), f))
+        os.makedirs(self._dir(t), exist_ok=True)
+
+    def n_replay(self) -> int:
+        """Number of proposals still queued for replay."""
+        if self.generation is None:
+            return 0
+        return len(os.listdir(self._replay_dir(self.generation)))
+
+    def _write(self, filename: str, arrays: Dict[str, np.ndarray]):
+        tmp = filename+'.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp, **arrays)
+        os.replace(tmp, filename)
+
+    def propose(self, par: Dict[str, float]):
+        """Record a new proposal of the current generation."""
+        key = par_key(par)
+        name = '{:017.6f}-{}.npz'.format(time.time(), key)
+        filename = os.path.join(self._dir(self.generation), name)
+        self._index[key] = filename
+        self._write(filename,
+                    {'names': np.array(list(par.keys()), dtype=str),
+                     'values': np.array(list(par.values()), dtype=float)})
+
+    def next_replay(self) -> Optional[Dict[str, float]]:
+        """Claim the next queued proposal, or None if there are none left.
+
+        Claiming moves the entry back into the current generation, so each
+        queued proposal is replayed by exactly one process.
+        """
+        if self.generation is None:
+            return None
+        replay = self._replay_dir(self.generation)
+        for f in sorted(os.listdir(replay)):
+            try:
+                os.rename(os.path.join(replay, f),
+                          os.path.join(self._dir(self.generation), f))
+            except OSError:
+                # Claimed by another process
+                continue
+            filename = os.path.join(self._dir(self.generation), f)
+            with np.load(filename) as a:
+                par = dict(zip(a['names'], a['values']))
+            self._index[par_key(par)] = filename
+            return par
+        return None
+
+    def _find(self, key: str) -> Optional[str]:
+        filename = self._index.get(key)
+        if filename is None or not filename.startswith(
+                self._dir(self.generation)+os.sep):
+            return None
+        return filename
+
+    def get(self, par: Dict[str, float]) -> Optional[Dict[str, np.ndarray]]:
+        """Stored summary statistics of a proposal, or None if unfinished."""
+        if self.generation is None:
+            return None
+        filename = self._find(par_key(par))
+        if filename is None:
+            return None
+        with np.load(filename) as a:
+            if 'ss_keys' not in a.files:
+                return None
+            return {k: (a['ss_'+k] if a['ss_'+k].ndim > 0
+                        else float(a['ss_'+k]))
+                    for k in a['ss_keys']}
+
+    def complete(self, par: Dict[str, float], sum_stats: Dict):
+        """Add summary statistics to the entry of a proposal."""
+        if self.generation is None:
+            return
+        filename = self._find(par_key(par))
+        if filename is None:
+            return
+        keys = [str(k) for k in sum_stats.keys()]
+        arrays = {'names': np.array(list(par.keys()), dtype=str),
+                  'values': np.array(list(par.values()), dtype=float),
+                  'ss_keys': np.array(keys, dtype=str)}
+        for k, v in zip(keys, sum_stats.values()):
+            arrays['ss_'+k] = np.asarray(v, dtype=float)
+        self._write(filename, arrays)
+
+    def clear(self):
+        """Delete all entries."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+        self.generation = None
+        self._index = {}
+
+
+class ReplayDistribution:
+    """Prior which replays journaled proposals before sampling.
+
+    Behaves as the wrapped `pyabc.Distribution`.
+
+    Args:
+        prior (Distribution): Prior of the ABC run.
+        journal (EvaluationJournal): Journal of proposals.
+    """
+    def __init__(self, prior: Distribution, journal: EvaluationJournal):
+        self.prior = prior
+        self.journal = journal
+
+    def rvs(self, *args, **kwargs) -> Parameter:
+        par = self.journal.next_replay()
+        if par is None:
+            par = self.prior.rvs(*args, **kwargs)
+            self.journal.propose(par)
+        return Parameter(par)
+
+    def pdf(self, x):
+        return self.prior.pdf(x)
+
+    def __getattr__(self, name):
+        # Only called for attributes not defined here
+        if name in ('prior', 'journal'):
+            raise AttributeError(name)
+        return getattr(self.prior, name)
+
+
+class ReplayTransition(Transition):
+    """Transition which replays journaled proposals before sampling.
+
+    Fitting the transition at the start of each generation also moves the
+    journal to that generation, found from the pyABC history.
+
+    Args:
+        transition (Transition): Transition of the ABC run.
+        journal (EvaluationJournal): Journal of proposals.
+        generation (Callable): Returns the generation about to be sampled.
+    """
+    def __init__(self,
+                 transition: Transition,
+                 journal: EvaluationJournal,
+                 generation: Callable[[], int]):
+        self.transition = transition
+        self.journal = journal
+        self.generation = generation
+
+    def fit(self, X: pd.DataFrame, w: np.ndarray):
+        self.journal.set_generation(self.generation())
+        self.transition.fit(X, w)
+
+    def rvs_single(self) -> pd.Series:
+        par = self.journal.next_replay()
+        if par is not None:
+            return pd.Series(par)[list(self.X.columns)]
+        par = self.transition.rvs_single()
+        self.journal.propose(par.to_dict())
+        return par
+
+    def rvs(self, size: int=None):
+        if size is None:
+            return self.rvs_single()
+        # Batches are only drawn outside of pyABC sampling so not journaled
+        return self.transition.rvs(size=size)
+
+    def pdf(self, x):
+        return self.transition.pdf(x)
+
+    def __copy__(self):
+        # Copies, e.g. bootstrapped by pyABC, are plain transitions which
+        # must not move the journal to another generation
+        return copy.copy(self.transition)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.transition, memo)
+
+
+class JournaledOutput:
+    """Model output of a proposal whose summary statistics are known.
+
+    Returned by model wrappers which skip simulation, e.g. for journaled
+    or look-ahead proposals, and unwrapped by their summary statistics.
+    """
+    def __init__(self, par, data=None, sum_stats=None):
+        self.par = par
+        self.data = data
+        self.sum_stats = sum_stats
+
+
+def journal_model(model: Callable,
+                  summary_statistics: Callable,
+                  journal: EvaluationJournal) -> Tuple[Callable, Callable]:
+    """Wrap model and summary statistics functions from `setup`.
+
+    The wrapped model skips simulation of proposals whose summary
+    statistics are already journaled, and the wrapped summary statistics
+    add newly calculated summary statistics to the journal.
+    """
+    def journaled_model(x, *args, **kwargs):
+        sum_stats = journal.get(x)
+        if sum_stats is not None:
+            return JournaledOutput(dict(x), sum_stats=sum_stats)
+        return JournaledOutput(dict(x), data=model(x, *args, **kwargs))
+
+    def journaled_summary_statistics(data):
+        if not isinstance(data, JournaledOutput):
+            return summary_statistics(data)
+        if data.sum_stats is not None:
+            return data.sum_stats
+        sum_stats = summary_statistics(data.data)
+        journal.complete(data.par, sum_stats)
+        return sum_stats
+
+    if hasattr(model, 'background'):
+        journaled_model.background = model.background
+    if hasattr(summary_statistics, 'schema'):
+        journaled_summary_statistics.schema = summary_statistics.schema
+    return journaled_model, journaled_summary_statistics
+
+
+class RunManager:
+    """Run pyABC on `setup` outputs so interrupted runs can be resumed.
+
+    pyABC only stores a generation in its database once it is complete.
+    The run manager journals every evaluation of the generation in flight
+    (see `EvaluationJournal`), so when an interrupted run is resumed by
+    passing its `run_id` to `run` the evaluations of that generation are
+    replayed and only simulations which had not finished are redone.
+
+    Note that ABCSMC is constructed by the run manager, so the prior,
+    transition, model and summary statistics are passed here rather than
+    to ABCSMC.
+
+    Args:
+        db (str): Database of the pyABC history, e.g. "sqlite:///run.db".
+        journal_path (str): Directory of the evaluation journal.
+        model (Callable): Model function from `setup`.
+        summary_statistics (Callable): Summary statistics function from
+            `setup`.
+        prior (Distribution): Parameter prior.
+        transition (Transition): Perturbation kernel. Defaults to
+            `EfficientMultivariateNormalTransition`.
+        **abc_kwargs: Other arguments to `pyabc.ABCSMC`, e.g. distance
+            function, population size, epsilon, sampler and acceptor.
+    """
+    def __init__(self,
+                 db: str,
+                 journal_path: str,
+                 model: Callable,
+                 summary_statistics: Callable,
+                 prior: Distribution,
+                 transition: Transition=None,
+                 **abc_kwargs):
+        if transition is None:
+            transition = EfficientMultivariateNormalTransition()
+        self.db = db
+        self.journal = EvaluationJournal(journal_path)
+        model, summary_statistics = journal_model(model,
+                                                  summary_statistics,
+                                                  self.journal)
+        self.abc = ABCSMC(models=model,
+                          parameter_priors=ReplayDistribution(prior,
+                                                              self.journal),
+                          summary_statistics=summary_statistics,
+                          transitions=ReplayTransition(transition,
+                                                       self.journal,
+                                                       self._next_generation),
+                          **abc_kwargs)
+
+    def _next_generation(self) -> int:
+        return self.abc.history.max_t + 1
+
+    def run(self,
+            observations: Dict,
+            run_id: int=None,
+            **run_kwargs) -> History:
+        """Start a new run, or resume an interrupted run.
+
+        Args:
+            observations (Dict): Observed summary statistics.
+            run_id (int): ID of a run in the database to resume. Starts a
+                new run if None.
+            **run_kwargs: Arguments to `ABCSMC.run`, e.g. minimum_epsilon
+                and max_nr_populations.
+
+        Returns:
+            History: History of the run.
+        """
+        if run_id is None:
+            self.journal.clear()
+            self.abc.new(self.db, observations)
+        else:
+            self.abc.load(self.db, run_id, observations)
+        # Generations after the first are set when the transition is fit
+        if self._next_generation() == 0:
+            self.journal.set_generation(0)
+        history = self.abc.run(**run_kwargs)
+        self.journal.clear()
+        return history
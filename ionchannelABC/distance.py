@@ -5,6 +5,8 @@ import warnings
 from pyabc.distance import PNormDistance, StochasticKernel
 import scipy.stats as stats
 
+from .experiment import SUM_STATS_KEY
+
 import logging
 abclogger = logging.getLogger('ABC')
 
@@ -22,7 +24,8 @@ class IonChannelDistance(PNormDistance):
 
     Calling is identical to pyabc.distance.PNormDistance, other than
     it checks whether the simulated input is empty, in which case it returns
-    np.inf.
+    np.inf. Summary statistics in array format (a single vector under
+    `SUM_STATS_KEY`) are also accepted and handled directly.
 
     Args:
         exp_id (List[int]): Number of experiment each data point belongs to.
@@ -58,6 +61,9 @@ class IonChannelDistance(PNormDistance):
 
         abclogger.debug('ion channel weights: {}'.format(weights))
 
+        # Same weights as a vector for array format summary statistics
+        self._w_arr = np.array([weights[k] for k in ids])
+
         # now initialize PNormDistance
         super().__init__(p=p, weights={0: weights})
 
@@ -81,6 +87,11 @@ class IonChannelDistance(PNormDistance):
             float: Error between x and x_0. If distance gives
                 overflow warning will return inf.
         """
+        # array format summary statistics
+        if SUM_STATS_KEY in x:
+            return self._array_distance(x[SUM_STATS_KEY],
+                                        x_0[SUM_STATS_KEY])
+
         # x is the simulated output
         if (len(x) is 0 or
             any(np.isinf(xi) for xi in x.values())):
@@ -95,6 +106,53 @@ class IonChannelDistance(PNormDistance):
             except RuntimeWarning:
                 return np.inf
 
+    @property
+    def weight_array(self) -> np.ndarray:
+        """Weight of each summary statistic in order as a vector."""
+        return self._w_arr
+
+    def _array_distance(self,
+                        x: np.ndarray,
+                        x_0: np.ndarray) -> float:
+        """Weighted p-norm distance between summary statistic vectors."""
+        x = np.asarray(x)
+        if x.size == 0 or np.any(np.isinf(x)):
+            return np.inf
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            try:
+                d = np.abs(self._w_arr*(x-np.asarray(x_0)))
+                if self.p == np.inf:
+                    return float(np.max(d))
+                return float(np.sum(d**self.p)**(1/self.p))
+            except RuntimeWarning:
+                return np.inf
+
+
+def distance_by_experiment(distance_fn: IonChannelDistance,
+                           sum_stats: np.ndarray,
+                           x_0: np.ndarray,
+                           exp_map: List[int]) -> np.ndarray:
+    """Weighted p-norm distance of each experiment for many samples.
+
+    Args:
+        distance_fn (IonChannelDistance): Distance providing weights and p.
+        sum_stats (np.ndarray): Simulated summary statistics with shape
+            (samples, statistics).
+        x_0 (np.ndarray): Reference summary statistics.
+        exp_map (List[int]): Experiment number of each summary statistic.
+
+    Returns:
+        np.ndarray: Distances with shape (samples, experiments).
+    """
+    exp_map = np.asarray(exp_map, dtype=int)
+    exp_onehot = np.zeros((len(exp_map), max(exp_map)+1))
+    exp_onehot[np.arange(len(exp_map)), exp_map] = 1.
+    p = distance_fn.p
+    d = np.abs(distance_fn.weight_array*(np.asarray(sum_stats) -
+                                         np.asarray(x_0)))
+    return np.power(np.dot(np.power(d, p), exp_onehot), 1/p)
+
 
 class DiscrepancyKernel(StochasticKernel):
     """A kernel to infer model discrepancy variance with parameters.
@@ -108,6 +166,7 @@ class DiscrepancyKernel(StochasticKernel):
         measure_var (Union[Callable, List[float], float]): Variances in
             experimental data.
         keys (List[str]): Keys of summary statistics (in order to be used).
+            Use `[SUM_STATS_KEY]` for array format summary statistics.
         eps_keys (List[str]): Keys of model discrepancy variance parameters
             (in order to be used).
         exp_mask (List[int]): Experiment ID for each summary statistic.
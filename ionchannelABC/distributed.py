@@ -0,0 +1,519 @@
+"""Distributed evaluation of `setup` models.
+
+A coordinator pushes batches of parameter samples onto a work queue.
+Workers on any number of nodes pull batches, evaluate them with model and
+summary statistics functions they build once locally (so compiled Myokit
+simulations stay on the worker) and return the summary statistics. While
+evaluating, workers renew a lease on the batch with heartbeats. Batches
+whose lease expires, e.g. because the worker died, are put back on the
+queue for another worker, up to a limit. Lease times are taken from the
+queue server's clock, so clocks of the nodes need not agree.
+
+The queue is either a Redis server (`RedisQueue`) or, for a single machine
+or testing without a cluster, a local stand-in server (`LocalQueueServer`)
+with the same interface.
+"""
+import logging
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.managers import BaseManager
+import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pyabc.sampler import Sampler
+
+from .parallel import sum_stats_to_array
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+abclogger = logging.getLogger('ABC')
+
+
+class LocalQueue:
+    """In-memory work queue with leases on claimed tasks.
+
+    Serve with `LocalQueueServer` to share it between processes. Lease
+    times are then those of the serving process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks = []
+        self._payloads = {}
+        self._leases = {}
+        self._results = {}
+
+    def push(self, task_id: str, payload: bytes):
+        """Add a task to the end of the queue."""
+        with self._lock:
+            self._payloads[task_id] = payload
+            self._tasks.append(task_id)
+
+    def claim(self, worker_id: str) -> Optional[Tuple[str, bytes]]:
+        """Take the next task and lease it to a worker, or None if empty."""
+        with self._lock:
+            while self._tasks:
+                task_id = self._tasks.pop(0)
+                if task_id in self._payloads:
+                    self._leases[task_id] = (worker_id, time.time())
+                    return task_id, self._payloads[task_id]
+        return None
+
+    def heartbeat(self, task_id: str, worker_id: str):
+        """Renew the lease of a task."""
+        with self._lock:
+            if task_id in self._leases:
+                self._leases[task_id] = (worker_id, time.time())
+
+    def complete(self, task_id: str, result: bytes):
+        """Store the result of a task. Later results of a task are ignored."""
+        with self._lock:
+            if task_id in self._payloads:
+                self._results[task_id] = result
+                del self._payloads[task_id]
+                self._leases.pop(task_id, None)
+
+    def result(self, task_id: str) -> Optional[bytes]:
+        """Remove and return the result of a task, or None if not done."""
+        with self._lock:
+            return self._results.pop(task_id, None)
+
+    def cancel(self, task_id: str):
+        """Remove a task, so it is not claimed again or completed."""
+        with self._lock:
+            self._payloads.pop(task_id, None)
+            self._leases.pop(task_id, None)
+
+    def requeue_stale(self, lease: float) -> List[str]:
+        """Requeue tasks without a heartbeat for `lease` seconds."""
+        now = time.time()
+        with self._lock:
+            stale = [task_id for task_id, (_, t) in self._leases.items()
+                     if now-t > lease]
+            for task_id in stale:
+                del self._leases[task_id]
+                self._tasks.append(task_id)
+        return stale
+
+    def size(self) -> int:
+        """Number of tasks waiting to be claimed."""
+        with self._lock:
+            return len(self._tasks)
+
+
+class _QueueManager(BaseManager):
+    pass
+
+
+_local_queue = None
+
+
+def _get_local_queue():
+    return _local_queue
+
+
+class LocalQueueServer:
+    """Serve a `LocalQueue` to other processes on this or other machines.
+
+    A stand-in for a Redis server to run distributed evaluation without a
+    cluster, e.g. for testing.
+
+    Args:
+        address (Tuple[str, int]): Address to listen on. A free port is
+            chosen if the port is 0.
+        authkey (bytes): Authentication key shared with workers.
+    """
+    def __init__(self,
+                 address: Tuple[str, int]=('127.0.0.1', 0),
+                 authkey: bytes=b'ionchannelABC'):
+        self.authkey = authkey
+        self._address = address
+        self._manager = None
+
+    def start(self) -> 'LocalQueueServer':
+        global _local_queue
+        _local_queue = LocalQueue()
+        _QueueManager.register('get_queue', callable=_get_local_queue)
+        self._manager = _QueueManager(address=self._address,
+                                      authkey=self.authkey)
+        self._manager.start()
+        return self
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._manager.address
+
+    def queue(self):
+        """Proxy of the served queue."""
+        return self._manager.get_queue()
+
+    def shutdown(self):
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def __enter__(self) -> 'LocalQueueServer':
+        return self.start()
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+def connect_local_queue(address: Tuple[str, int],
+                        authkey: bytes=b'ionchannelABC'):
+    """Proxy of a queue served by a `LocalQueueServer`."""
+    _QueueManager.register('get_queue')
+    manager = _QueueManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.get_queue()
+
+
+# Current time of the Redis server in seconds. Scripts calling TIME must
+# replicate their effects rather than the script (default from Redis 5)
+_REDIS_NOW = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1])+tonumber(time[2])/1000000
+"""
+
+# Pop the next task which has not completed and lease it
+_REDIS_CLAIM = _REDIS_NOW + """
+while true do
+    local task_id = redis.call('LPOP', KEYS[1])
+    if not task_id then
+        return nil
+    end
+    local payload = redis.call('HGET', KEYS[2], task_id)
+    if payload then
+        redis.call('HSET', KEYS[3], task_id, now)
+        return {task_id, payload}
+    end
+end
+"""
+
+# Renew the lease of a task if it is still leased
+_REDIS_HEARTBEAT = _REDIS_NOW + """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], now)
+end
+"""
+
+# Requeue tasks whose lease was last renewed more than ARGV[1] seconds ago
+_REDIS_REQUEUE_STALE = _REDIS_NOW + """
+local leases = redis.call('HGETALL', KEYS[1])
+local stale = {}
+for i = 1, #leases, 2 do
+    if now-tonumber(leases[i+1]) > tonumber(ARGV[1]) then
+        redis.call('HDEL', KEYS[1], leases[i])
+        redis.call('RPUSH', KEYS[2], leases[i])
+        stale[#stale+1] = leases[i]
+    end
+end
+return stale
+"""
+
+
+class RedisQueue:
+    """Work queue with leases on claimed tasks held in a Redis server.
+
+    Has the same interface as `LocalQueue`. Requires the `redis` package.
+    Leases are timed by the Redis server's clock in Lua scripts.
+
+    Args:
+        prefix (str): Prefix of Redis keys, to share one server between
+            several queues.
+        **redis_kwargs: Arguments to `redis.StrictRedis`, e.g. host, port.
+    """
+    def __init__(self, prefix: str='ionchannelABC', **redis_kwargs):
+        if redis is None:
+            raise ImportError('RedisQueue requires the redis package.')
+        self._redis = redis.StrictRedis(**redis_kwargs)
+        self._tasks = prefix+':tasks'
+        self._payloads = prefix+':payloads'
+        self._leases = prefix+':leases'
+        self._results = prefix+':results'
+        self._claim = self._redis.register_script(_REDIS_CLAIM)
+        self._heartbeat = self._redis.register_script(_REDIS_HEARTBEAT)
+        self._requeue_stale = self._redis.register_script(
+                _REDIS_REQUEUE_STALE)
+
+    def push(self, task_id: str, payload: bytes):
+        pipe = self._redis.pipeline()
+        pipe.hset(self._payloads, task_id, payload)
+        pipe.rpush(self._tasks, task_id)
+        pipe.execute()
+
+    def claim(self, worker_id: str) -> Optional[Tuple[str, bytes]]:
+        # Pop and lease in one step, so a task is never lost by a worker
+        # dying in between
+        claimed = self._claim(keys=[self._tasks, self._payloads,
+                                    self._leases])
+        if claimed is None:
+            return None
+        task_id, payload = claimed
+        return task_id.decode(), payload
+
+    def heartbeat(self, task_id: str, worker_id: str):
+        self._heartbeat(keys=[self._leases], args=[task_id])
+
+    def complete(self, task_id: str, result: bytes):
+        # Only the first worker to remove the payload stores its result
+        if self._redis.hdel(self._payloads, task_id):
+            pipe = self._redis.pipeline()
+            pipe.hset(self._results, task_id, result)
+            pipe.hdel(self._leases, task_id)
+            pipe.execute()
+
+    def result(self, task_id: str) -> Optional[bytes]:
+        pipe = self._redis.pipeline()
+        pipe.hget(self._results, task_id)
+        pipe.hdel(self._results, task_id)
+        result, _ = pipe.execute()
+        return result
+
+    def cancel(self, task_id: str):
+        pipe = self._redis.pipeline()
+        pipe.hdel(self._payloads, task_id)
+        pipe.hdel(self._leases, task_id)
+        pipe.execute()
+
+    def requeue_stale(self, lease: float) -> List[str]:
+        stale = self._requeue_stale(keys=[self._leases, self._tasks],
+                                    args=[lease])
+        return [task_id.decode() for task_id in stale]
+
+    def size(self) -> int:
+        return self._redis.llen(self._tasks)
+
+
+def _evaluate_safely(model: Callable,
+                     summary_statistics: Callable,
+                     pars: Dict[str, float]) -> Dict:
+    """Summary statistics of a sample, or of a failure if it raises."""
+    try:
+        return summary_statistics(model(pars))
+    except Exception:
+        abclogger.exception('Evaluation of {} failed.'.format(pars))
+    try:
+        return summary_statistics(None)
+    except Exception:
+        # Filled with inf by `DistributedEvaluator.map`
+        return {}
+
+
+def run_worker(queue,
+               model_factory: Callable[[], Tuple[Callable, Callable]],
+               heartbeat_interval: float=5.,
+               poll_interval: float=0.5,
+               idle_timeout: float=None,
+               max_tasks: int=None) -> int:
+    """Evaluate tasks from a work queue until stopped.
+
+    A sample whose evaluation raises an exception is logged and returned as
+    failed, i.e. `summary_statistics(None)`, so one bad sample neither
+    stops the worker nor loses the rest of its batch.
+
+    Args:
+        queue: `RedisQueue`, `LocalQueue` or proxy from
+            `connect_local_queue`.
+        model_factory (Callable): Returns the model and summary statistics
+            functions, e.g. `lambda: setup(modelfile, *experiments)[1:]`.
+            Called once, so simulations are compiled once per worker.
+        heartbeat_interval (float): Seconds between lease renewals while
+            evaluating a task. Must be well below the coordinator's lease.
+        poll_interval (float): Seconds to wait when the queue is empty.
+        idle_timeout (float): Optionally stop after the queue has been
+            empty for this many seconds.
+        max_tasks (int): Optionally stop after this many tasks.
+
+    Returns:
+        int: Number of tasks evaluated.
+    """
+    model, summary_statistics = model_factory()
+    worker_id = uuid.uuid4().hex
+    n_tasks = 0
+    idle_since = time.time()
+    while max_tasks is None or n_tasks < max_tasks:
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            if (idle_timeout is not None and
+                    time.time()-idle_since > idle_timeout):
+                break
+            time.sleep(poll_interval)
+            continue
+        task_id, payload = claimed
+
+        done = threading.Event()
+        def beat():
+            while not done.wait(heartbeat_interval):
+                queue.heartbeat(task_id, worker_id)
+        heart = threading.Thread(target=beat, daemon=True)
+        heart.start()
+        try:
+            samples = pickle.loads(payload)
+            result = [_evaluate_safely(model, summary_statistics, pars)
+                      for pars in samples]
+        finally:
+            done.set()
+            heart.join()
+        queue.complete(task_id, pickle.dumps(result))
+        n_tasks += 1
+        idle_since = time.time()
+    return n_tasks
+
+
+class DistributedEvaluator:
+    """Coordinator submitting parameter samples to distributed workers.
+
+    Args:
+        queue: `RedisQueue`, `LocalQueue` or proxy from
+            `connect_local_queue`, shared with workers (see `run_worker`).
+        lease (float): Seconds without a heartbeat after which a task is
+            assumed lost and given to another worker.
+        poll_interval (float): Seconds between checks for results.
+        max_redeliveries (int): Number of times a task may be given to
+            another worker before it is cancelled and `wait` raises, e.g.
+            if the task repeatedly crashes or hangs workers.
+    """
+    def __init__(self,
+                 queue,
+                 lease: float=60.,
+                 poll_interval: float=0.1,
+                 max_redeliveries: int=3):
+        self.queue = queue
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_redeliveries = max_redeliveries
+        self.n_requeued = 0
+        self._redeliveries = {}
+
+    def submit(self, samples: List[Dict[str, float]]) -> str:
+        """Push a batch of samples and return its task ID."""
+        task_id = uuid.uuid4().hex
+        self.queue.push(task_id, pickle.dumps([dict(s) for s in samples]))
+        return task_id
+
+    def wait(self, task_ids: List[str]) -> Dict[str, List[Dict]]:
+        """Summary statistics of each sample of each batch, once all done."""
+        results = {}
+        while len(results) < len(task_ids):
+            for task_id in task_ids:
+                if task_id not in results:
+                    result = self.queue.result(task_id)
+                    if result is not None:
+                        results[task_id] = pickle.loads(result)
+                        self._redeliveries.pop(task_id, None)
+            if len(results) < len(task_ids):
+                self._requeue_stale()
+                time.sleep(self.poll_interval)
+        return results
+
+    def _requeue_stale(self):
+        """Count requeued tasks and cancel those requeued too often.
+
+        Tasks requeued for other coordinators sharing the queue are counted
+        by each, which is harmless as only the own tasks are cancelled.
+        """
+        stale = self.queue.requeue_stale(self.lease)
+        self.n_requeued += len(stale)
+        for task_id in stale:
+            n = self._redeliveries.get(task_id, 0)+1
+            self._redeliveries[task_id] = n
+            if n > self.max_redeliveries:
+                self.queue.cancel(task_id)
+                raise RuntimeError(
+                    'Task {} was lost by a worker {} times, so is assumed '
+                    'to crash or hang workers.'.format(task_id, n))
+
+    def map(self,
+            samples: List[Dict[str, float]],
+            n_stats: int,
+            batch_size: int=10) -> np.ndarray:
+        """Summary statistics for each parameter sample.
+
+        Returns:
+            np.ndarray: Summary statistics with shape (samples, statistics)
+                as for `evaluate_samples`.
+        """
+        starts = list(range(0, len(samples), batch_size))
+        task_ids = [self.submit(samples[s:s+batch_size]) for s in starts]
+        results = self.wait(task_ids)
+        output = np.empty((len(samples), n_stats))
+        for start, task_id in zip(starts, task_ids):
+            for i, sum_stats in enumerate(results[task_id]):
+                values = sum_stats_to_array(sum_stats)
+                output[start+i, :] = values if len(values) > 0 else np.inf
+        return output
+
+    def model(self, pars: Dict[str, float]) -> Dict:
+        """Model for pyABC returning summary statistics from a worker.
+
+        Use with `summary_statistics` and `DistributedSampler`, which calls
+        the model from many threads to keep workers busy.
+        """
+        task_id = self.submit([pars])
+        return self.wait([task_id])[task_id][0]
+
+    @staticmethod
+    def summary_statistics(sum_stats: Dict) -> Dict:
+        """Summary statistics already calculated by the worker."""
+        return sum_stats
+
+
+class DistributedSampler(Sampler):
+    """pyABC sampler for models evaluated by distributed workers.
+
+    Runs up to `n_threads` particle simulations at once in threads of the
+    coordinator, each of which waits on a worker through the model of a
+    `DistributedEvaluator`. Set `n_threads` to at least the total number of
+    worker processes.
+
+    Accepted particles are kept in the order they were proposed, as for
+    pyABC's own parallel samplers, so the population is not biased
+    towards fast simulations.
+
+    Args:
+        n_threads (int): Maximum number of particles in flight.
+    """
+    def __init__(self, n_threads: int=16):
+        super().__init__()
+        self.n_threads = n_threads
+
+    def sample_until_n_accepted(self,
+                                n: int,
+                                simulate_one: Callable,
+                                max_eval: float=np.inf,
+                                all_accepted: bool=False):
+        particles = {}
+        n_accepted = 0
+        n_submitted = 0
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            running = {}
+            while running or (n_accepted < n and n_submitted < max_eval):
+                while (n_accepted < n and n_submitted < max_eval and
+                       len(running) < self.n_threads):
+                    running[executor.submit(simulate_one)] = n_submitted
+                    n_submitted += 1
+                done, _ = wait(list(running.keys()),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    particle = future.result()
+                    particles[running.pop(future)] = particle
+                    if particle.accepted:
+                        n_accepted += 1
+
+        sample = self._create_empty_sample()
+        n_kept = 0
+        for i in sorted(particles.keys()):
+            if n_kept >= n:
+                break
+            sample.append(particles[i])
+            if particles[i].accepted:
+                n_kept += 1
+        self.nr_evaluations_ = n_submitted
+        return sample
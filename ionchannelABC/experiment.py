@@ -1,13 +1,20 @@
 from functools import wraps
+from timeit import default_timer as timer
 import numpy as np
 import pandas as pd
 from typing import List, Callable, Dict, Union, Tuple
 import warnings
 
-from pyabc import History
 from pyabc import Distribution
 import myokit
 
+from .background import BackgroundSampler
+from .cache import (CachedResult, ResultCache, experiment_signature,
+                    function_signature)
+from .failure_region import FailureRegionCache
+from .profiling import Profiler, _no_profile
+from .budget import RuntimeBudget
+
 
 def log_transform(f):
     @wraps(f)
@@ -29,6 +36,60 @@ def combine_sum_stats(*functions):
     return lambda x: sum_stats_fn(x)
 
 
+# Key of the single summary statistic vector when using array format.
+SUM_STATS_KEY = 'ss'
+
+# Output of simulations stopped by the runtime budget. These are rejected
+# like failures but not remembered as failures, as they depend on the
+# budget and machine rather than the model.
+_OVER_BUDGET = object()
+
+
+class SummaryStatisticsSchema:
+    """Immutable layout of array-valued summary statistics.
+
+    Each summary statistic vector holds one value per observation in the
+    order of the observations dataframe. The schema records which
+    experiment and normalising factor each position corresponds to, and
+    is shared by the summary statistics function, distance and kernel.
+
+    Args:
+        observations (pd.DataFrame): Observations from `setup` or
+            `get_observations_df`.
+    """
+    def __init__(self, observations: pd.DataFrame):
+        self._keys = tuple(str(i) for i in range(len(observations)))
+        self._exp_id = np.array(observations.exp_id, dtype=int)
+        self._normalise_factor = np.array(observations.normalise_factor,
+                                          dtype=float)
+        self._observed = np.array(observations.y, dtype=float)
+        for arr in (self._exp_id, self._normalise_factor, self._observed):
+            arr.flags.writeable = False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def keys(self) -> Tuple[str, ...]:
+        return self._keys
+
+    @property
+    def exp_id(self) -> np.ndarray:
+        return self._exp_id
+
+    @property
+    def normalise_factor(self) -> np.ndarray:
+        return self._normalise_factor
+
+    def observed(self) -> Dict[str, np.ndarray]:
+        """Observed summary statistics in array format for pyABC."""
+        return {SUM_STATS_KEY: self._observed}
+
+    def to_dict(self, sum_stats: Dict[str, np.ndarray]) -> Dict[str, float]:
+        """Convert array format to stringified-index dict format."""
+        return dict(zip(self._keys, sum_stats[SUM_STATS_KEY]))
+
+
 class Experiment:
     """Contains related information from patch clamp experiment."""
     def __init__(self,
@@ -39,7 +100,11 @@ class Experiment:
                  tvar: str='phys.T',
                  Q10: Union[float, List[float]]=None,
                  Q10_factor: Union[int, List[int]]=0,
-                 description: str=""):
+                 description: str="",
+                 coarse_protocol: myokit.Protocol=None,
+                 coarse_sum_stats: Union[Callable, List[Callable]]=None,
+                 coarse_log_interval: float=None,
+                 coarse_tolerance: Tuple[float, float]=None):
         """Initialisation.
 
         Args:
@@ -66,6 +131,17 @@ class Experiment:
                 Can accept a list if separate exp_id generated by the experiment
                 which are adjusted differently.
             description (str): Optional descriptor.
+            coarse_protocol (myokit.Protocol): Optional cheaper variant of
+                `protocol` for low fidelity simulation, e.g. with shortened
+                prepulses or fewer sweeps.
+            coarse_sum_stats (Union[Callable, List[Callable]]): Summary
+                statistics function(s) for output of `coarse_protocol`.
+                Must give the same number of values as `sum_stats`, e.g.
+                by interpolating between fewer sweeps.
+            coarse_log_interval (float): Optional log interval for low
+                fidelity simulation.
+            coarse_tolerance (Tuple[float, float]): Optional absolute and
+                relative solver tolerance for low fidelity simulation.
         """
         if isinstance(dataset, list):
             self._dataset = dataset
@@ -94,6 +170,14 @@ class Experiment:
         self._conditions = conditions_exp
         self._description = description
 
+        self._coarse_protocol = coarse_protocol
+        if coarse_sum_stats is None or isinstance(coarse_sum_stats, list):
+            self._coarse_sum_stats = coarse_sum_stats
+        else:
+            self._coarse_sum_stats = [coarse_sum_stats]
+        self._coarse_log_interval = coarse_log_interval
+        self._coarse_tolerance = coarse_tolerance
+
     def __call__(self) -> None:
         """Print descriptor"""
         print(self._description)
@@ -126,6 +210,22 @@ class Experiment:
     def Q10_factor(self) -> List[int]:
         return self._Q10_factor
 
+    @property
+    def coarse_protocol(self) -> myokit.Protocol:
+        return self._coarse_protocol
+
+    @property
+    def coarse_sum_stats(self) -> List[Callable]:
+        return self._coarse_sum_stats
+
+    @property
+    def coarse_log_interval(self) -> float:
+        return self._coarse_log_interval
+
+    @property
+    def coarse_tolerance(self) -> Tuple[float, float]:
+        return self._coarse_tolerance
+
 
 def setup(modelfile: str,
           *experiments: Experiment,
@@ -137,7 +237,16 @@ def setup(modelfile: str,
           additional_pars: Distribution=None,
           logvars: List[str]=myokit.LOG_ALL,
           log_interval: float=None,
-          normalise: bool=True
+          normalise: bool=True,
+          failure_cache: FailureRegionCache=None,
+          seed: int=None,
+          background_samples: int=None,
+          cache: ResultCache=None,
+          sum_stats_format: str='dict',
+          profiler: Profiler=None,
+          runtime_budget: RuntimeBudget=None,
+          sum_stats_dtype: str='float64',
+          fidelity: str='full'
           ) -> Tuple[pd.DataFrame, Callable, Callable]:
     """Combine chosen experiments into inputs for ABC.
 
@@ -152,13 +261,49 @@ def setup(modelfile: str,
         tvar (str): Optionally specify name of temperature in modelfile.
             Defaults to `phys.T`.
         prev_runs (List[str]): Path to previous pyABC runs containing samples
-            to randomly sample outside of ABC algorithm.
+            to randomly sample outside of ABC algorithm, or posteriors
+            exported with `export_posterior`.
         logvars (List[str]): Optionally specify variables to log in simulations.
+        failure_cache (FailureRegionCache): Optional memory of failed
+            simulations used to skip proposals deep inside regions of
+            parameter space known to crash the solver.
+        seed (int): Optional seed for drawing `prev_runs` and
+            `additional_pars` samples.
+        background_samples (int): Optionally pre-draw a fixed bank of this
+            many `prev_runs` and `additional_pars` samples. Each parameter
+            set then always uses the same bank entry (common random
+            numbers), making the model deterministic.
+        cache (ResultCache): Optional on-disk cache of summary statistics
+            (and traces) to avoid resimulating identical parameter sets.
+        sum_stats_format (str): Either `dict` to return summary statistics
+            as `{str(i): value}` or `array` to return a single float64
+            vector under `SUM_STATS_KEY`. In `array` format the
+            `SummaryStatisticsSchema` is available as the `schema`
+            attribute of the summary statistics function.
+        sum_stats_dtype (str): Data type of `array` format summary
+            statistics. `float32` halves their size when stored by pyABC
+            as one packed array per particle.
+        profiler (Profiler): Optional collector of the time spent by each
+            experiment in each stage of simulation and summary statistics,
+            and of solver statistics of each run.
+        runtime_budget (RuntimeBudget): Optional dynamic limit on the
+            wall-clock time to simulate all experiments for one parameter
+            set. Simulations exceeding it are stopped and treated as
+            failed (see `RuntimeBudget`). `timeout` still applies to each
+            experiment.
+        fidelity (str): Either `full` or `coarse` to simulate the cheap
+            variant declared by each experiment (its `coarse_protocol`,
+            `coarse_sum_stats`, `coarse_log_interval` and
+            `coarse_tolerance`, falling back to the full fidelity settings
+            where not declared). See `MultiFidelity`.
 
     Returns:
         Tuple[pd.DataFrame, Callable, Callable]:
             Observations combined from experiments.
             Model function to run combined protocols from experiments.
+                The optional `draw` argument shifts the background sample
+                used, and the `BackgroundSampler` is available as its
+                `background` attribute.
             Summary statistics function to convert 'raw' simulation output.
     """
 
@@ -180,83 +325,187 @@ def setup(modelfile: str,
                                        temp_adjust=True,
                                        model_temperature=model_temperature)
 
+    if fidelity not in ('full', 'coarse'):
+        raise ValueError('Unknown fidelity: {}'.format(fidelity))
+    coarse = fidelity == 'coarse'
+
     # Combine protocols into Myokit simulations
-    simulations, times = [], []
+    simulations, times, log_intervals = [], [], []
     for exp in list(experiments):
-        s = myokit.Simulation(m, exp.protocol)
+        protocol = exp.protocol
+        if coarse and exp.coarse_protocol is not None:
+            protocol = exp.coarse_protocol
+        s = myokit.Simulation(m, protocol)
         for ci, vi in exp.conditions.items():
             s.set_constant(ci, vi)
+        if coarse and exp.coarse_tolerance is not None:
+            s.set_tolerance(*exp.coarse_tolerance)
         simulations.append(s)
-        times.append(exp.protocol.characteristic_time())
+        times.append(protocol.characteristic_time())
+        if coarse and exp.coarse_log_interval is not None:
+            log_intervals.append(exp.coarse_log_interval)
+        else:
+            log_intervals.append(log_interval)
 
-    # Get previous pyABC runs
-    # Note: defaults to latest run in database file
-    sample_df, sample_w = [], []
-    for run in prev_runs:
-        h = History(run)
-        df, w = h.get_distribution()
-        sample_df.append(df)
-        sample_w.append(w)
+    # Previously calibrated parameters and additional parameters that are
+    # not refined during calibration
+    background = BackgroundSampler(prev_runs=prev_runs,
+                                   additional_pars=additional_pars,
+                                   seed=seed,
+                                   n_bank=background_samples)
+
+    stage = profiler.stage if profiler is not None else _no_profile
 
     # Create model function
     def simulate_model(**pars):
         sim_output = []
-        # Previously calibrated parameters
-        for df, w in zip(sample_df, sample_w):
-            pars = dict([(key[4:], 10**value) if key.startswith("log")
-                         else (key, value)
-                         for key, value in df.sample(weights=w, replace=True).to_dict('records')[0].items()],
-                        **pars)
-        # Additional parameters that are not refined during calibration
-        if additional_pars is not None:
-            pars = dict([(key[4:], 10**value) if key.startswith("log")
-                         else (key, value)
-                         for key, value in dict(additional_pars.rvs()).items()],
-                        **pars)
 
         # Create timeout ProgressReporter if necessary
         progress = None
         if timeout is not None:
             progress = myokit.Timeout(timeout)
 
-        for sim, time in zip(simulations, times):
-            for p, v in pars.items():
-                if err_pars is not None and p in err_pars:
-                    continue
-                try:
-                    sim.set_constant(p, v)
-                except:
-                    warnings.warn("Could not set value of {}"
-                                  .format(p))
-                    return None
-            sim.reset()
+        budget = None
+        if runtime_budget is not None:
+            budget = runtime_budget.budget()
+            start = timer()
+
+        for i, (sim, time, interval) in enumerate(zip(simulations, times,
+                                                      log_intervals)):
+            if budget is not None:
+                remaining = budget - (timer()-start)
+                if remaining <= 0:
+                    runtime_budget.record_over_budget(timer()-start)
+                    return _OVER_BUDGET
+                progress = myokit.Timeout(remaining if timeout is None
+                                          else min(remaining, timeout))
+            with stage(i, 'set_parameters'):
+                for p, v in pars.items():
+                    if err_pars is not None and p in err_pars:
+                        continue
+                    # A parameter missing from the model is a configuration
+                    # error, not a failed simulation, so is not recorded in
+                    # the failure cache or rejected as a particle
+                    try:
+                        sim.set_constant(p, v)
+                    except Exception as e:
+                        raise ValueError('Could not set value of {}'
+                                         .format(p)) from e
+            with stage(i, 'reset'):
+                sim.reset()
             try:
-                sim_output.append(
-                    sim.run(time,
-                            log=logvars,
-                            log_interval=log_interval,
-                            progress=progress)
-                    )
+                with stage(i, 'run') as rec:
+                    sim_output.append(
+                        sim.run(time,
+                                log=logvars,
+                                log_interval=interval,
+                                progress=progress)
+                        )
+                    if profiler is not None:
+                        rec.update(profiler.get_solver_stats(sim))
             except:
                 del(sim_output)
+                if runtime_budget is not None:
+                    elapsed = timer()-start
+                    if budget is not None and elapsed >= budget:
+                        runtime_budget.record_over_budget(elapsed)
+                        return _OVER_BUDGET
+                    runtime_budget.record(elapsed)
                 return None
+        if runtime_budget is not None:
+            runtime_budget.record(timer()-start)
         return sim_output
-    def model(x):
-        return log_transform(simulate_model)(**x)
+    def model(x, draw: int=0):
+        if failure_cache is not None and failure_cache.should_skip(x):
+            return None
+        pars = dict(background.sample(key=x, offset=draw),
+                    **log_transform(dict)(**x))
+        if cache is not None:
+            key = cache.key(signature, pars)
+            output = cache.get(key)
+            if output is not None:
+                return output if output.sum_stats is not None else None
+        output = simulate_model(**pars)
+        if output is _OVER_BUDGET:
+            if profiler is not None:
+                profiler.flush()
+            return None
+        if failure_cache is not None:
+            failure_cache.record(x, output is None)
+        if cache is not None:
+            if output is not None:
+                output = CachedResult(output, sum_stats_combined(output))
+                cache.put(key, output.sum_stats, traces=output)
+            else:
+                cache.put(key, None)
+        if profiler is not None:
+            profiler.flush()
+        return output
+    model.background = background
 
     # Combine summary statistic functions
     normalise_factor = {}
     for i, f in enumerate(observations.normalise_factor):
         normalise_factor[i] = f
-    sum_stats_combined = combine_sum_stats(
-        *[e.sum_stats for e in list(experiments)]
-    )
-    def summary_statistics(data):
-        if data is None:
-            return {str(i): np.inf for i in range(len(observations))}
-        ss = {str(i): val/normalise_factor[i]
-              for i, val in enumerate(sum_stats_combined(data))}
-        return ss
+    sum_stats_fns = [e.coarse_sum_stats
+                     if coarse and e.coarse_sum_stats is not None
+                     else e.sum_stats for e in list(experiments)]
+    if profiler is not None:
+        sum_stats_fns = [[profiler.timed(i, 'sum_stats', f) for f in fns]
+                         for i, fns in enumerate(sum_stats_fns)]
+    sum_stats_combined = combine_sum_stats(*sum_stats_fns)
+    if cache is not None:
+        options = {}
+        if coarse:
+            # Coarse variants are not part of the experiment hash
+            options['fidelity'] = [
+                (e.coarse_protocol.code()
+                 if e.coarse_protocol is not None else None,
+                 [function_signature(f) for f in e.coarse_sum_stats]
+                 if e.coarse_sum_stats is not None else None,
+                 e.coarse_log_interval,
+                 e.coarse_tolerance) for e in experiments]
+        signature = experiment_signature(modelfile,
+                                         list(experiments),
+                                         pacevar=pacevar,
+                                         tvar=tvar,
+                                         err_pars=err_pars,
+                                         logvars=logvars,
+                                         log_interval=log_interval,
+                                         timeout=timeout,
+                                         **options)
+    if sum_stats_format == 'dict':
+        def summary_statistics(data):
+            if data is None:
+                return {str(i): np.inf for i in range(len(observations))}
+            if isinstance(data, CachedResult):
+                raw = data.sum_stats
+            else:
+                raw = sum_stats_combined(data)
+            ss = {str(i): val/normalise_factor[i]
+                  for i, val in enumerate(raw)}
+            if profiler is not None:
+                profiler.flush()
+            return ss
+    elif sum_stats_format == 'array':
+        schema = SummaryStatisticsSchema(observations)
+        def summary_statistics(data):
+            if data is None:
+                return {SUM_STATS_KEY: np.full(len(schema), np.inf,
+                                               dtype=sum_stats_dtype)}
+            if isinstance(data, CachedResult):
+                raw = data.sum_stats
+            else:
+                raw = sum_stats_combined(data)
+            if profiler is not None:
+                profiler.flush()
+            return {SUM_STATS_KEY: (np.asarray(raw, dtype=np.float64) /
+                                    schema.normalise_factor)
+                                   .astype(sum_stats_dtype, copy=False)}
+        summary_statistics.schema = schema
+    else:
+        raise ValueError('Unknown summary statistics format: {}'
+                         .format(sum_stats_format))
 
     return observations, model, summary_statistics
 
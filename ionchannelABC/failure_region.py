@@ -0,0 +1,140 @@
+import multiprocessing
+import numpy as np
+from typing import Dict, List
+
+
+class FailureRegionCache:
+    """Memory of parameter sets which failed to simulate.
+
+    Some regions of parameter space reliably cause the solver to fail or
+    time out. Every parameter set passed to the model is recorded along
+    with whether it failed. A new proposal is skipped without simulating
+    only if its `k` nearest recorded neighbours *all* failed and *all* lie
+    within `radius`, i.e. it falls deep inside a known-failure region.
+
+    Skipped proposals are treated exactly as a failed simulation (the
+    model returns None), so this only changes the result at the edges of
+    failure regions where a proposal would have succeeded.
+
+    Records and counters are held in shared memory, so the memory is built
+    up across (and persists between) worker processes forked by pyABC
+    samplers after the cache is created. This requires the names of the
+    ABC parameters on creation. The shared memory cannot be pickled, so
+    the cache only works with samplers which fork workers, such as pyABC's
+    multicore samplers, and not with those sending the model to other
+    processes or machines, such as the Dask or Redis samplers.
+
+    Args:
+        parameters (List[str]): Names of the ABC parameters. Defaults to
+            the keys of `scale`.
+        radius (float): Maximum scaled Euclidean distance of neighbours.
+        k (int): Number of nearest neighbours which must all have failed.
+        scale (Dict[str, float]): Optional characteristic width of each
+            parameter (e.g. prior width) used to scale distances.
+            Defaults to unit width for every parameter.
+        max_records (int): Maximum number of evaluations remembered. The
+            oldest are discarded first.
+    """
+    def __init__(self,
+                 parameters: List[str]=None,
+                 radius: float=0.05,
+                 k: int=5,
+                 scale: Dict[str, float]=None,
+                 max_records: int=10000):
+        if k < 1:
+            raise ValueError('Number of neighbours k must be at least 1.')
+        if parameters is None:
+            if scale is None:
+                raise ValueError('Names of parameters are required, either '
+                                 'as `parameters` or keys of `scale`.')
+            parameters = list(scale.keys())
+        self.parameters = list(parameters)
+        self.radius = radius
+        self.k = k
+        self.scale = scale
+        self.max_records = max_records
+
+        self._keys = sorted(self.parameters)
+        if scale is not None:
+            self._scale = np.array([scale.get(k, 1.) for k in self._keys])
+        else:
+            self._scale = np.ones(len(self._keys))
+
+        ctx = multiprocessing.get_context('fork')
+        self._lock = ctx.Lock()
+        self._points_shared = ctx.Array('d', max_records*len(self._keys),
+                                        lock=False)
+        self._failed_shared = ctx.Array('b', max_records, lock=False)
+        self._points = np.frombuffer(self._points_shared).reshape(
+                max_records, len(self._keys))
+        self._failed = np.frombuffer(self._failed_shared, dtype=np.int8)
+        # evaluated, failed, skipped, records held, next record
+        self._n = ctx.Array('l', 5, lock=False)
+
+    def __getstate__(self):
+        raise TypeError('FailureRegionCache holds shared memory and cannot '
+                        'be pickled. Use a sampler which forks workers, '
+                        'e.g. pyabc.sampler.MulticoreEvalParallelSampler.')
+
+    @property
+    def n_evaluated(self) -> int:
+        return self._n[0]
+
+    @property
+    def n_failed(self) -> int:
+        return self._n[1]
+
+    @property
+    def n_skipped(self) -> int:
+        return self._n[2]
+
+    def _to_array(self, pars: Dict[str, float]) -> np.ndarray:
+        return np.array([pars[k] for k in self._keys])/self._scale
+
+    def should_skip(self, pars: Dict[str, float]) -> bool:
+        """Whether a proposal lies deep inside a known-failure region.
+
+        Increments the `n_skipped` counter when returning True.
+        """
+        if set(pars.keys()) != set(self._keys):
+            return False
+        x = self._to_array(pars)
+        with self._lock:
+            n_records = self._n[3]
+            if n_records < self.k:
+                return False
+            points = self._points[:n_records]
+            dist = np.sqrt(np.sum((points-x)**2, axis=1))
+            nearest = np.argpartition(dist, self.k-1)[:self.k]
+            skip = bool(np.all(self._failed[nearest]) and
+                        np.all(dist[nearest] <= self.radius))
+            if skip:
+                self._n[2] += 1
+        return skip
+
+    def record(self, pars: Dict[str, float], failed: bool):
+        """Add the outcome of simulating a parameter set."""
+        if set(pars.keys()) != set(self._keys):
+            return
+        x = self._to_array(pars)
+        with self._lock:
+            i = self._n[4]
+            self._points[i] = x
+            self._failed[i] = failed
+            self._n[4] = (i+1) % self.max_records
+            self._n[3] = min(self._n[3]+1, self.max_records)
+            self._n[0] += 1
+            if failed:
+                self._n[1] += 1
+
+    def counters(self) -> Dict[str, int]:
+        """Number of evaluated, failed and skipped proposals."""
+        return {'evaluated': self.n_evaluated,
+                'failed': self.n_failed,
+                'skipped': self.n_skipped}
+
+    def reset(self):
+        """Forget all recorded evaluations and zero counters."""
+        with self._lock:
+            for i in range(len(self._n)):
+                self._n[i] = 0
@@ -2,93 +2,187 @@
 #from sklearn.metrics import r2_score
 import scipy.optimize as so
 import numpy as np
-import pandas as pd
-import copy
-from typing import List, Dict, Tuple
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, List, Dict, Tuple
 import warnings
 
-from .ion_channel_pyabc import (IonChannelModel,
-                                ion_channel_sum_stats_calculator)
 from .distance import IonChannelDistance
+from .parallel import sum_stats_to_array
+
+# Model closures inherited by forked worker processes
+_worker_state = None
+
 
 def min_fn(macro_vals, *args):
-    (model, macro_parameters, abc_parameters,
-     observations, w) = args
-    result = ion_channel_sum_stats_calculator(
-            model.sample({**dict(zip(macro_parameters, macro_vals)),
-                          **abc_parameters}))
-    x = result
-    if len(x) == 0 | np.any(~np.isfinite(list(x.values()))):
+    (macro_parameters, abc_parameters, x_0, w) = args
+    model, summary_statistics = _worker_state
+    x = sum_stats_to_array(summary_statistics(
+            model({**dict(zip(macro_parameters, macro_vals)),
+                   **abc_parameters})))
+    if len(x) == 0 or np.any(~np.isfinite(x)):
         return np.inf
-    y = observations
     # always going to be separate experiments in full model so no need to
     # do exp_map step
-    d = [abs(w[key]*(x[key]-y[key]))
-         if key in x and key in y else 0
-         for key in w]
-    return sum(d)
+    return np.sum(np.abs(w*(x-x_0)))
+
+
+def _fit_sample(i, abc_parameters, init, macro_parameters, x_0, w,
+                bounds, seed, disp, optimise_args):
+    """Fit macro parameters for one ABC sample by differential evolution."""
+    if disp:
+        print('=> Running ABC sample {}...'.format(i))
+    result = so.differential_evolution(min_fn,
+                                       bounds=bounds,
+                                       args=(macro_parameters,
+                                             abc_parameters,
+                                             x_0,
+                                             w),
+                                       init=init,
+                                       seed=seed,
+                                       disp=disp,
+                                       **optimise_args)
+    return i, result.success, result.x, result.message
+
+
+def _initial_population(rng, bounds, popsize, neighbours):
+    """Random population within bounds seeded with neighbour solutions."""
+    lower = np.array([b[0] for b in bounds])
+    upper = np.array([b[1] for b in bounds])
+    n = max(5, popsize*len(bounds))
+    # Latin hypercube for the random part of the population
+    u = (np.argsort(rng.random_sample((n, len(bounds))), axis=0) +
+         rng.random_sample((n, len(bounds))))/n
+    init = lower + (upper-lower)*u
+    if len(neighbours) > 0:
+        neighbours = np.clip(neighbours, lower, upper)[:n]
+        init[:len(neighbours)] = neighbours
+    return init
 
 
 def generate_training_data(
         macro_parameters: List[str],
         abc_samples: List[Dict[str, float]],
-        model: IonChannelModel,
+        model: Callable,
+        summary_statistics: Callable,
+        observations: Dict[str, float],
         distance_fn: IonChannelDistance,
-        limits: List[Tuple[float, float]],
+        limits: Dict[str, Tuple[float, float]],
         disp: bool=False,
-        workers: int=1,
-        optimise_args: dict=None):
-    """
-    Fit final parameters of full model by least squares regression.
+        n_workers: int=1,
+        warm_start: int=5,
+        popsize: int=15,
+        seed: int=None,
+        optimise_args: dict=None) -> Tuple[np.ndarray, np.ndarray]:
+    """Fit final parameters of full model for each ABC sample.
+
+    Macro parameters are fit by differential evolution separately for each
+    ABC sample, with optimisations for different samples run concurrently
+    across `n_workers` processes. Samples are visited in nearest-neighbour
+    order of their (normalised) ABC parameters, and the initial population
+    of each optimisation is seeded with the solutions of up to
+    `warm_start` of its nearest already-solved neighbours.
+
+    Args:
+        macro_parameters (List[str]): Names of macro parameters to fit.
+        abc_samples (List[Dict[str, float]]): Samples from ABC posterior.
+        model (Callable): Model function from `setup`.
+        summary_statistics (Callable): Summary statistics function from
+            `setup`.
+        observations (Dict[str, float]): Observed summary statistics.
+        distance_fn (IonChannelDistance): ABC distance function providing
+            weights of each summary statistic.
+        limits (Dict[str, Tuple[float, float]]): Bounds of each macro
+            parameter.
+        disp (bool): Whether to print progress.
+        n_workers (int): Number of concurrent optimisations.
+        warm_start (int): Number of neighbouring solutions seeded into
+            each initial population. Set to 0 to disable.
+        popsize (int): Population size multiplier (see
+            `scipy.optimize.differential_evolution`).
+        seed (int): Optional seed for initial populations and optimisation.
+        optimise_args (dict): Other arguments to
+            `scipy.optimize.differential_evolution`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: ABC samples and fitted macro
+            parameters (nan where optimisation failed).
     """
+    global _worker_state
+
     # Send warning about experimental feature
     warnings.warn("experimental feature may produce unexpected results")
 
-    # Get original values for perturbing later
-    macro_original_vals = (np.asarray(list(
-        model.get_parameter_vals(macro_parameters)
-             .values()
-             )))
+    if optimise_args is None:
+        optimise_args = {}
+    bounds = tuple(limits[p] for p in macro_parameters)
 
-    observations = ion_channel_sum_stats_calculator(
-            model.get_experiment_data())
-    _ = distance_fn(0, observations, observations)
+    _ = distance_fn(observations, observations, 0)
+    w = distance_fn.weight_array
+    x_0 = sum_stats_to_array(observations)
 
-    w = distance_fn.w[0]
-   
     # Dependent variable for fitting - ABC parameter samples
     X = np.empty((len(abc_samples), len(abc_samples[0])))
     for i, sample in enumerate(abc_samples):
         X[i, :] = np.array(list(sample.values()))
-    
-    Y = np.empty((len(abc_samples), len(macro_parameters)))
-    for i, abc_parameters in enumerate(abc_samples):
-        if disp:
-            print('=> Running ABC sample {}...'.format(i))
-
-        # Fit macro parameters by differential evolution algorithm
-        result = so.differential_evolution(min_fn,
-                                 bounds=tuple(limits.values()),
-                                 args=(copy.deepcopy(model),
-                                       macro_parameters,
-                                       abc_parameters,
-                                       observations,
-                                       w),
-                                 disp=disp,
-                                 workers=workers,
-                                 **optimise_args)
-#                                 updating='deferred',
-#                                 tol=.05,
-#                                 maxiter=200)
-
-        if result.success:
-            Y[i, :] = result.x
+    Xn = (X - np.mean(X, axis=0))/np.where(np.std(X, axis=0) > 0,
+                                          np.std(X, axis=0), 1.)
+
+    # Visit samples in greedy nearest-neighbour order so that neighbours
+    # of most samples are already solved when they start
+    order = [0]
+    remaining = set(range(1, len(abc_samples)))
+    while remaining:
+        rem = np.array(sorted(remaining))
+        nearest = rem[np.argmin(np.sum((Xn[rem]-Xn[order[-1]])**2, axis=1))]
+        order.append(int(nearest))
+        remaining.remove(int(nearest))
+
+    rng = np.random.RandomState(seed)
+    seeds = rng.randint(2**31, size=len(abc_samples))
+    Y = np.full((len(abc_samples), len(macro_parameters)), np.nan)
+    solved = []
+
+    def task_args(i):
+        neighbours = []
+        if warm_start > 0 and len(solved) > 0:
+            dist = np.sum((Xn[solved]-Xn[i])**2, axis=1)
+            nearest = np.array(solved)[np.argsort(dist)[:warm_start]]
+            neighbours = Y[nearest]
+        init = _initial_population(rng, bounds,
+                                   optimise_args.get('popsize', popsize),
+                                   neighbours)
+        return (i, abc_samples[i], init, macro_parameters, x_0, w,
+                bounds, seeds[i], disp,
+                {k: v for k, v in optimise_args.items() if k != 'popsize'})
+
+    def collect(i, success, x, message):
+        if success:
+            Y[i, :] = x
+            solved.append(i)
         else:
             print('differential_evolution failed with message: {}'
-                  .format(result.message))
-            # fill results vector with nan if optimisation fails
-            Y[i, :] = [np.nan,]*len(macro_parameters)
-            continue
+                  .format(message))
+
+    _worker_state = (model, summary_statistics)
+    try:
+        if n_workers == 1:
+            for i in order:
+                collect(*_fit_sample(*task_args(i)))
+        else:
+            ctx = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(n_workers, mp_context=ctx) as executor:
+                queue = list(order)
+                running = set()
+                while queue or running:
+                    while queue and len(running) < n_workers:
+                        running.add(executor.submit(_fit_sample,
+                                                    *task_args(queue.pop(0))))
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(*future.result())
+    finally:
+        _worker_state = None
 
     return (X, Y)
 
@@ -0,0 +1,183 @@
+"""Binned kernel density estimates for weighted samples.
+
+Samples are linearly binned onto a regular grid (padded by four kernel
+widths so mass outside the plotted range still contributes) and convolved
+with a Gaussian kernel by FFT. The bandwidth matches the defaults used by
+pyabc's `kde_1d`/`kde_2d` (weighted sample covariance scaled by
+Silverman's rule of thumb on the effective sample size).
+"""
+import numpy as np
+import pandas as pd
+from scipy.signal import fftconvolve
+from typing import Tuple
+
+
+def _silverman(n_eff: float, dimension: int) -> float:
+    return (4/(n_eff*(dimension+2)))**(1/(dimension+4))
+
+
+def _normalise_weights(w, n):
+    w = np.ones(n) if w is None else np.asarray(w, dtype=float)
+    return w/np.sum(w)
+
+
+def _linear_binning(pos: np.ndarray, w: np.ndarray, shape: Tuple[int, ...]):
+    """Distribute weights onto neighbouring grid points.
+
+    Args:
+        pos (np.ndarray): Fractional grid index of each sample with shape
+            (samples, dimensions).
+        w (np.ndarray): Weight of each sample.
+        shape (Tuple[int, ...]): Shape of the grid.
+    """
+    i = np.floor(pos).astype(int)
+    f = pos - i
+    valid = np.all((i >= 0) & (i < np.array(shape)-1), axis=1)
+    i, f, w = i[valid], f[valid], w[valid]
+    counts = np.zeros(shape)
+    d = pos.shape[1]
+    # Each corner of the enclosing cell gets the product of 1-f or f
+    for corner in range(2**d):
+        offset = np.array([(corner >> k) & 1 for k in range(d)])
+        frac = np.prod(np.where(offset, f, 1-f), axis=1)
+        np.add.at(counts, tuple((i+offset).T), w*frac)
+    return counts
+
+
+def _pad(sigma: float, dx: float, n: int) -> int:
+    return int(min(np.ceil(4*sigma/dx), 2*n)) if dx > 0 else 0
+
+
+def binned_kde_1d(x: np.ndarray,
+                  w: np.ndarray=None,
+                  xmin: float=None,
+                  xmax: float=None,
+                  numx: int=1000) -> Tuple[np.ndarray, np.ndarray]:
+    """Weighted Gaussian KDE of 1D samples evaluated on a regular grid.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Grid points and density.
+    """
+    x = np.asarray(x, dtype=float)
+    w = _normalise_weights(w, len(x))
+    xmin = np.min(x) if xmin is None else xmin
+    xmax = np.max(x) if xmax is None else xmax
+
+    n_eff = 1/np.sum(w**2)
+    mean = np.sum(w*x)
+    sigma = np.sqrt(np.sum(w*(x-mean)**2))*_silverman(n_eff, 1)
+    dx = (xmax-xmin)/(numx-1)
+    sigma = max(sigma, dx)
+
+    pad = _pad(sigma, dx, numx)
+    counts = _linear_binning(((x-xmin)/dx+pad)[:, np.newaxis], w,
+                             (numx+2*pad,))
+    offsets = np.arange(-pad, pad+1)*dx
+    kernel = np.exp(-0.5*(offsets/sigma)**2)/(np.sqrt(2*np.pi)*sigma)
+    pdf = fftconvolve(counts, kernel, mode='same')[pad:pad+numx]
+
+    return np.linspace(xmin, xmax, numx), np.maximum(pdf, 0)
+
+
+def binned_kde_2d(x: np.ndarray,
+                  y: np.ndarray,
+                  w: np.ndarray=None,
+                  xmin: float=None,
+                  xmax: float=None,
+                  ymin: float=None,
+                  ymax: float=None,
+                  numx: int=100,
+                  numy: int=100
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Weighted Gaussian KDE of 2D samples evaluated on a regular grid.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Meshgrid X, Y and
+            density with shape (numy, numx), as for `pcolormesh`.
+    """
+    xy = np.column_stack((np.asarray(x, dtype=float),
+                          np.asarray(y, dtype=float)))
+    w = _normalise_weights(w, len(xy))
+    xmin = np.min(xy[:, 0]) if xmin is None else xmin
+    xmax = np.max(xy[:, 0]) if xmax is None else xmax
+    ymin = np.min(xy[:, 1]) if ymin is None else ymin
+    ymax = np.max(xy[:, 1]) if ymax is None else ymax
+
+    n_eff = 1/np.sum(w**2)
+    mean = np.sum(w[:, np.newaxis]*xy, axis=0)
+    diff = xy - mean
+    cov = np.dot((w[:, np.newaxis]*diff).T, diff)*_silverman(n_eff, 2)**2
+    dx = (xmax-xmin)/(numx-1)
+    dy = (ymax-ymin)/(numy-1)
+    # Kernel at least one grid cell wide
+    cov[0, 0] = max(cov[0, 0], dx**2)
+    cov[1, 1] = max(cov[1, 1], dy**2)
+
+    padx = _pad(np.sqrt(cov[0, 0]), dx, numx)
+    pady = _pad(np.sqrt(cov[1, 1]), dy, numy)
+    pos = np.column_stack(((xy[:, 1]-ymin)/dy+pady,
+                           (xy[:, 0]-xmin)/dx+padx))
+    counts = _linear_binning(pos, w, (numy+2*pady, numx+2*padx))
+
+    ox, oy = np.meshgrid(np.arange(-padx, padx+1)*dx,
+                         np.arange(-pady, pady+1)*dy)
+    offsets = np.stack((ox, oy), axis=-1)
+    inv = np.linalg.inv(cov)
+    kernel = (np.exp(-0.5*np.einsum('...i,ij,...j->...', offsets, inv, offsets)) /
+              (2*np.pi*np.sqrt(np.linalg.det(cov))))
+    pdf = fftconvolve(counts, kernel, mode='same')
+    pdf = pdf[pady:pady+numy, padx:padx+numx]
+
+    X, Y = np.meshgrid(np.linspace(xmin, xmax, numx),
+                       np.linspace(ymin, ymax, numy))
+    return X, Y, np.maximum(pdf, 0)
+
+
+class KDECache:
+    """Marginal and pairwise KDEs of a weighted posterior, computed once.
+
+    Densities are computed on first request and reused, e.g. between the
+    filled and outline passes of a plot.
+
+    Args:
+        df (pd.DataFrame): Parameter samples (see pyabc.History).
+        w (np.ndarray): The corresponding weights.
+        numx (int): Number of grid points per dimension.
+    """
+    def __init__(self, df: pd.DataFrame, w: np.ndarray, numx: int=1000):
+        self.df = df
+        self.w = w
+        self.numx = numx
+        self._cache = {}
+
+    def marginal(self,
+                 name: str,
+                 xmin: float=None,
+                 xmax: float=None) -> Tuple[np.ndarray, np.ndarray]:
+        """1D KDE of a parameter (see `binned_kde_1d`)."""
+        key = (name, xmin, xmax)
+        if key not in self._cache:
+            self._cache[key] = binned_kde_1d(self.df[name].values, self.w,
+                                             xmin=xmin, xmax=xmax,
+                                             numx=self.numx)
+        return self._cache[key]
+
+    def pairwise(self,
+                 x: str,
+                 y: str,
+                 xmin: float=None,
+                 xmax: float=None,
+                 ymin: float=None,
+                 ymax: float=None
+                 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """2D KDE of a pair of parameters (see `binned_kde_2d`)."""
+        key = (x, y, xmin, xmax, ymin, ymax)
+        if key not in self._cache:
+            self._cache[key] = binned_kde_2d(self.df[x].values,
+                                             self.df[y].values,
+                                             self.w,
+                                             xmin=xmin, xmax=xmax,
+                                             ymin=ymin, ymax=ymax,
+                                             numx=self.numx,
+                                             numy=self.numx)
+        return self._cache[key]
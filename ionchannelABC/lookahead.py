@@ -0,0 +1,365 @@
+"""Multicore sampling which looks ahead into the next generation.
+
+Cores left idle at the end of a generation simulate proposals for the
+next one, which are thinned and replayed once it starts.
+"""
+import copy
+import multiprocessing
+import os
+import queue
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, List, Tuple
+
+from pyabc import Distribution
+from pyabc.sampler import Sampler
+from pyabc.transition import Transition
+
+from .checkpoint import JournaledOutput, par_key
+from .utils import EfficientMultivariateNormalTransition
+
+# Sampler inherited by forked worker processes
+_sampler = None
+
+
+def _work(tasks, results, seed):
+    np.random.seed(seed)
+    sampler = _sampler
+    while True:
+        kind, idx, payload = tasks.get()
+        try:
+            if kind == 'current':
+                sampler._replay = payload
+                sampler._replay_pending = payload is not None
+                results.put((kind, idx, sampler._simulate_one()))
+            else:
+                par, q = payload
+                sum_stats = sampler._summary_statistics(sampler._model(par))
+                results.put((kind, idx, (par, sum_stats, q)))
+        except Exception as e:
+            results.put(('error', idx, e))
+
+
+class LookAheadTransition(Transition):
+    """Transition which draws proposals simulated ahead of time.
+
+    Created by `LookAheadSampler`.
+    """
+    def __init__(self, transition: Transition, sampler: 'LookAheadSampler'):
+        self.transition = transition
+        self.sampler = sampler
+        self.n_fit = 0
+
+    def fit(self, X: pd.DataFrame, w: np.ndarray):
+        self.transition.fit(X, w)
+        self.n_fit += 1
+
+    def rvs_single(self) -> pd.Series:
+        if self.sampler._replay_pending:
+            self.sampler._replay_pending = False
+            return pd.Series(self.sampler._replay[0])[list(self.X.columns)]
+        return self.transition.rvs_single()
+
+    def rvs(self, size: int=None):
+        if size is None:
+            return self.rvs_single()
+        return self.transition.rvs(size=size)
+
+    def pdf(self, x):
+        return self.transition.pdf(x)
+
+    def __copy__(self):
+        # Copies, e.g. bootstrapped by pyABC, are plain transitions
+        return copy.copy(self.transition)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.transition, memo)
+
+
+class LookAheadSampler(Sampler):
+    """Multicore sampler which simulates ahead into the next generation.
+
+    Once enough particles of a generation have been accepted, cores would
+    otherwise wait for the last (often slowest) simulations to finish.
+    Instead, a preliminary transition is fit to the particles accepted so
+    far and idle cores simulate proposals from it. Every proposal started
+    is kept in proposal order, with its summary statistics if the
+    simulation finished before the generation completed. Unfinished
+    proposals are simulated again when replayed, so slow parameter sets
+    are not dropped in favour of fast ones.
+
+    At the start of the next generation, each proposal simulated ahead is
+    kept with probability min(1, q(x)/(M q'(x))), where q is the final and
+    q' the preliminary transition density. Otherwise its slot is filled
+    with a draw from the residual density proportional to
+    q - min(q', q/M), so every slot is distributed exactly as q (a maximal
+    coupling for `M=1`). The slots are replayed as the first proposals of
+    the generation and accepted, rejected and weighted by pyABC as usual,
+    reusing summary statistics of kept proposals which finished.
+
+    Proposals are drawn ahead (and for the residual) without regard to the
+    prior, as for the transition itself. Slots outside the prior support
+    are not simulated ahead, and pyABC rejects and redraws them when they
+    are replayed. Every slot therefore follows pyABC's own proposal
+    distribution, the transition restricted to the prior support.
+
+    Use the `model`, `summary_statistics` and `transition` attributes in
+    place of the originals when creating `pyabc.ABCSMC`, e.g.::
+
+        sampler = LookAheadSampler(model, summary_statistics, prior)
+        abc = ABCSMC(models=sampler.model,
+                     parameter_priors=prior,
+                     summary_statistics=sampler.summary_statistics,
+                     transitions=sampler.transition,
+                     sampler=sampler, ...)
+
+    Args:
+        model (Callable): Model function from `setup`.
+        summary_statistics (Callable): Summary statistics function from
+            `setup`.
+        prior (Distribution): Parameter prior, to skip simulating
+            proposals outside its support.
+        transition (Transition): Perturbation kernel. Defaults to
+            `EfficientMultivariateNormalTransition`.
+        n_procs (int): Number of worker processes. Defaults to the number
+            of CPUs.
+        M (float): Scale of the preliminary transition density used to
+            thin proposals simulated ahead, at least 1. Larger values keep
+            fewer proposals.
+        min_preliminary (int): Minimum number of accepted particles to fit
+            the preliminary transition. Defaults to twice the number of
+            parameters plus one.
+    """
+    def __init__(self,
+                 model: Callable,
+                 summary_statistics: Callable,
+                 prior: Distribution,
+                 transition: Transition=None,
+                 n_procs: int=None,
+                 M: float=1.,
+                 min_preliminary: int=None):
+        super().__init__()
+        if M < 1:
+            raise ValueError('M must be at least 1.')
+        if transition is None:
+            transition = EfficientMultivariateNormalTransition()
+        self._model = model
+        self._summary_statistics = summary_statistics
+        self.prior = prior
+        self.transition = LookAheadTransition(transition, self)
+        self.n_procs = n_procs if n_procs is not None else os.cpu_count()
+        self.M = M
+        self.min_preliminary = min_preliminary
+
+        self._simulate_one = None
+        self._replay = None
+        self._replay_pending = False
+        self._bank = []
+        self._bank_fit = None
+        self._bank_prelim = None
+
+        self.n_look_ahead = 0
+        self.n_reused = 0
+
+        def look_ahead_model(x, *args, **kwargs):
+            if (self._replay is not None and
+                    self._replay[1] is not None and
+                    par_key(x) == par_key(self._replay[0])):
+                return JournaledOutput(dict(x), sum_stats=self._replay[1])
+            return self._model(x, *args, **kwargs)
+
+        def look_ahead_summary_statistics(data):
+            if isinstance(data, JournaledOutput):
+                return data.sum_stats
+            return self._summary_statistics(data)
+
+        if hasattr(model, 'background'):
+            look_ahead_model.background = model.background
+        if hasattr(summary_statistics, 'schema'):
+            look_ahead_summary_statistics.schema = summary_statistics.schema
+        self.model = look_ahead_model
+        self.summary_statistics = look_ahead_summary_statistics
+
+    def _take_bank(self, prelim: Transition
+                   ) -> List[Tuple[Dict[str, float], Dict]]:
+        """Thin proposals simulated ahead to follow the fitted transition.
+
+        Returns replay entries of parameters and summary statistics, which
+        are None for proposals to be simulated.
+        """
+        bank, self._bank = self._bank, []
+        # Only valid if the transition was fit once since, i.e. this is
+        # the generation the proposals were simulated for
+        if len(bank) == 0 or self.transition.n_fit != self._bank_fit+1:
+            return []
+        columns = list(self.transition.X.columns)
+        pars = pd.DataFrame([b[0] for b in bank])[columns]
+        q = np.atleast_1d(self.transition.pdf(pars)).astype(float)
+        q_prelim = np.array([b[2] for b in bank])
+        keep = (np.random.uniform(size=len(bank)) <
+                np.minimum(1., q/(self.M*q_prelim)))
+        replay = []
+        for b, k in zip(bank, keep):
+            if k:
+                replay.append((b[0], b[1]))
+                if b[1] is not None:
+                    self.n_reused += 1
+            else:
+                residual = self._draw_residual(prelim, columns)
+                if residual is None:
+                    break
+                replay.append((residual, None))
+        return replay
+
+    def _draw_residual(self,
+                       prelim: Transition,
+                       columns: List[str],
+                       batch: int=100,
+                       max_draws: int=100000) -> Dict[str, float]:
+        """Draw from the residual of the transition after thinning.
+
+        Draws x from the fitted transition q and keeps it with probability
+        1 - min(q'(x)/q(x), 1/M), giving density proportional to
+        q - min(q', q/M). Returns None in the (negligible) case that no
+        draw is kept within `max_draws`.
+        """
+        for _ in range(max_draws//batch):
+            draws = pd.DataFrame(self.transition.transition.rvs(size=batch))
+            draws = draws[columns]
+            q = np.atleast_1d(self.transition.pdf(draws)).astype(float)
+            q_prelim = np.atleast_1d(prelim.pdf(draws)).astype(float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = np.where(q > 0, q_prelim/q, np.inf)
+            keep = (np.random.uniform(size=batch) <
+                    1.-np.minimum(ratio, 1./self.M))
+            if np.any(keep):
+                return draws.iloc[np.flatnonzero(keep)[0]].to_dict()
+        return None
+
+    def _preliminary(self, particles: List):
+        """Transition fit to the particles accepted so far, or None."""
+        accepted = [p for p in particles if p.accepted]
+        if len(accepted) == 0:
+            return None
+        X = pd.DataFrame([dict(p.parameter) for p in accepted])
+        min_preliminary = (self.min_preliminary
+                           if self.min_preliminary is not None
+                           else 2*len(X.columns)+1)
+        if len(accepted) < min_preliminary:
+            return None
+        w = np.array([p.weight for p in accepted], dtype=float)
+        prelim = copy.deepcopy(self.transition.transition)
+        prelim.fit(X, w/np.sum(w))
+        return prelim
+
+    def _propose_ahead(self,
+                       prelim: Transition,
+                       ahead: List[list],
+                       max_draws: int=1000) -> int:
+        """Draw proposals ahead until one lies inside the prior support.
+
+        Every draw is added to `ahead` in order. Draws outside the support
+        are not simulated, as pyABC rejects and redraws them when they are
+        replayed, exactly as for its own proposals. Returns the index of
+        the draw to simulate, or None.
+        """
+        for _ in range(max_draws):
+            par = prelim.rvs_single()
+            ahead.append([par.to_dict(), None, float(prelim.pdf(par))])
+            if self.prior.pdf(par) > 0:
+                return len(ahead)-1
+        return None
+
+    def sample_until_n_accepted(self,
+                                n: int,
+                                simulate_one: Callable,
+                                max_eval: float=np.inf,
+                                all_accepted: bool=False):
+        global _sampler
+
+        replay = self._take_bank(self._bank_prelim)
+        self._bank_prelim = None
+        self._simulate_one = simulate_one
+        # Proposals simulated ahead are for the next fit of the transition
+        fit_count = self.transition.n_fit
+
+        ctx = multiprocessing.get_context('fork')
+        tasks, results = ctx.Queue(), ctx.Queue()
+        _sampler = self
+        workers = [ctx.Process(target=_work, args=(tasks, results, seed),
+                               daemon=True)
+                   for seed in np.random.randint(2**31, size=self.n_procs)]
+        for w in workers:
+            w.start()
+
+        particles = {}
+        ahead = []
+        n_accepted = n_submitted = n_current = n_ahead = 0
+        prelim = None
+        try:
+            while True:
+                while n_current+n_ahead < self.n_procs:
+                    if n_accepted < n and n_submitted < max_eval:
+                        entry = replay.pop(0) if replay else None
+                        tasks.put(('current', n_submitted, entry))
+                        n_submitted += 1
+                        n_current += 1
+                    elif n_current > 0:
+                        # Idle cores waiting for the last particles
+                        if prelim is None:
+                            prelim = self._preliminary(
+                                list(particles.values()))
+                            if prelim is None:
+                                break
+                        idx = self._propose_ahead(prelim, ahead)
+                        if idx is None:
+                            break
+                        tasks.put(('ahead', idx, (ahead[idx][0],
+                                                  ahead[idx][2])))
+                        n_ahead += 1
+                    else:
+                        break
+                if n_current == 0:
+                    break
+                kind, idx, result = results.get()
+                if kind == 'error':
+                    raise result
+                elif kind == 'current':
+                    n_current -= 1
+                    particles[idx] = result
+                    if result.accepted:
+                        n_accepted += 1
+                else:
+                    n_ahead -= 1
+                    ahead[idx][1] = result[1]
+                    self.n_look_ahead += 1
+            # Proposals simulated ahead which already finished
+            while n_ahead > 0:
+                try:
+                    kind, idx, result = results.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == 'ahead':
+                    n_ahead -= 1
+                    ahead[idx][1] = result[1]
+                    self.n_look_ahead += 1
+        finally:
+            for w in workers:
+                w.terminate()
+            _sampler = None
+        # Keep all proposals started, including unfinished ones, in order
+        self._bank = [tuple(a) for a in ahead]
+        self._bank_fit = fit_count
+        self._bank_prelim = prelim
+        self._simulate_one = None
+
+        sample = self._create_empty_sample()
+        n_kept = 0
+        for i in sorted(particles.keys()):
+            if n_kept >= n:
+                break
+            sample.append(particles[i])
+            if particles[i].accepted:
+                n_kept += 1
+        self.nr_evaluations_ = n_submitted
+        return sample
@@ -0,0 +1,303 @@
+"""Multi-fidelity ABC.
+
+Particles are pre-filtered with cheap low fidelity simulations, and only
+promising ones are simulated at full fidelity.
+"""
+import multiprocessing
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict
+
+from pyabc import UniformAcceptor
+from pyabc.acceptor import AcceptorResult
+from pyabc.epsilon import Epsilon, MedianEpsilon
+
+from .checkpoint import par_key
+from .distance import IonChannelDistance
+
+
+class _Evaluated:
+    """Model output with summary statistics already calculated."""
+    def __init__(self, sum_stats):
+        self.sum_stats = sum_stats
+
+
+class MultiFidelity:
+    """Early rejection of particles from low fidelity simulations.
+
+    Every particle is first simulated at low fidelity (`setup` with
+    `fidelity='coarse'`). A particle whose coarse distance d_c is within
+    `margin` of the current epsilon is simulated at full fidelity and
+    accepted or rejected by pyABC as usual. Otherwise it is rejected
+    without the full simulation, except with probability
+    `audit_probability` when it is simulated at full fidelity anyway and,
+    if accepted, has its weight multiplied by 1/`audit_probability`. A
+    particle rejected at low fidelity is returned to pyABC with the summary
+    statistics of a failed simulation.
+
+    This is lazy ABC (Prangle, 2016): continuing with probability alpha
+    and weighting by 1/alpha leaves the posterior unchanged for any margin,
+    so the coarse model only affects efficiency. A margin bounding the
+    discrepancy between coarse and full distances means accepted particles
+    are (almost) never audits, keeping the weights balanced. Unless fixed,
+    the margin is calibrated as the `margin_quantile` of d_c-d_f over
+    recent particles simulated at both fidelities, and every particle is
+    simulated at full fidelity until `min_samples` are recorded. A particle
+    failing at low fidelity is always simulated at full fidelity.
+
+    Use the `model`, `summary_statistics`, `acceptor` and `epsilon`
+    attributes when creating `pyabc.ABCSMC`, e.g.::
+
+        observations, model, summary_statistics = setup(modelfile, *exps)
+        _, coarse_model, coarse_summary_statistics = setup(
+            modelfile, *exps, fidelity='coarse')
+        mf = MultiFidelity(model, summary_statistics, coarse_model,
+                           coarse_summary_statistics, distance_fn,
+                           observations)
+        abc = ABCSMC(models=mf.model,
+                     parameter_priors=prior,
+                     distance_function=distance_fn,
+                     summary_statistics=mf.summary_statistics,
+                     acceptor=mf.acceptor,
+                     eps=mf.epsilon, ...)
+
+    The epsilon passes its current value to the model when pyABC reads it
+    at the start of each generation, so it is known before any particle is
+    simulated. Without it the acceptor passes epsilon on after the first
+    particle of a generation and earlier particles use the previous value,
+    which costs efficiency but not validity. The acceptor passes weights
+    of audited particles from the model, so both must run in the same
+    process, as with pyABC's multicore samplers. Epsilon and counts are
+    held in shared memory, so are shared with worker processes forked
+    after creation.
+
+    Args:
+        model (Callable): Full fidelity model function from `setup`.
+        summary_statistics (Callable): Full fidelity summary statistics
+            function from `setup`.
+        coarse_model (Callable): Low fidelity model function from `setup`.
+        coarse_summary_statistics (Callable): Low fidelity summary
+            statistics function from `setup`, in the same format.
+        distance_fn (IonChannelDistance): Distance function used in ABC.
+        observations (pd.DataFrame): Observations from `setup`.
+        margin (float): Fixed margin above epsilon of coarse distances to
+            simulate at full fidelity. Calibrated if None.
+        margin_quantile (float): Quantile of coarse minus full distances
+            used as the calibrated margin.
+        audit_probability (float): Probability of simulating a particle
+            outside the margin at full fidelity. Must be positive for the
+            posterior to remain valid.
+        min_samples (int): Number of distance pairs recorded before the
+            calibrated margin applies.
+        window (int): Number of most recent distance pairs used.
+        eps (Epsilon): pyABC epsilon schedule wrapped by the `epsilon`
+            attribute. Defaults to `pyabc.MedianEpsilon`.
+    """
+    def __init__(self,
+                 model: Callable,
+                 summary_statistics: Callable,
+                 coarse_model: Callable,
+                 coarse_summary_statistics: Callable,
+                 distance_fn: IonChannelDistance,
+                 observations: pd.DataFrame,
+                 margin: float=None,
+                 margin_quantile: float=0.99,
+                 audit_probability: float=0.05,
+                 min_samples: int=100,
+                 window: int=1000,
+                 eps: Epsilon=None):
+        if not 0 < audit_probability <= 1:
+            raise ValueError('audit_probability must be in (0, 1].')
+        self._model = model
+        self._summary_statistics = summary_statistics
+        self._coarse_model = coarse_model
+        self._coarse_summary_statistics = coarse_summary_statistics
+        self.distance_fn = distance_fn
+        if hasattr(summary_statistics, 'schema'):
+            self._x_0 = summary_statistics.schema.observed()
+        else:
+            self._x_0 = {str(i): y for i, y in enumerate(observations.y)}
+        self._margin = margin
+        self.margin_quantile = margin_quantile
+        self.audit_probability = audit_probability
+        self.min_samples = min_samples
+        self.window = window
+
+        # Acceptance weight of particles in this process by parameters,
+        # zero for particles rejected at low fidelity
+        self._factors = {}
+
+        ctx = multiprocessing.get_context('fork')
+        self._diffs = ctx.Array('d', window, lock=False)
+        self._n_diffs = ctx.Value('l', 0)
+        self._eps = ctx.Value('d', np.inf)
+        self._t = ctx.Value('l', 0)
+        self._n = ctx.Array('l', 4)  # evaluated, full, skipped, audited
+
+        def multi_fidelity_model(x, *args, **kwargs):
+            return self._evaluate(x, *args, **kwargs)
+
+        def multi_fidelity_summary_statistics(data):
+            if isinstance(data, _Evaluated):
+                return data.sum_stats
+            return self._summary_statistics(data)
+
+        if hasattr(model, 'background'):
+            multi_fidelity_model.background = model.background
+        if hasattr(summary_statistics, 'schema'):
+            multi_fidelity_summary_statistics.schema = (
+                    summary_statistics.schema)
+        self.model = multi_fidelity_model
+        self.summary_statistics = multi_fidelity_summary_statistics
+        self.acceptor = MultiFidelityAcceptor(self)
+        self.epsilon = MultiFidelityEpsilon(
+                self, eps if eps is not None else MedianEpsilon())
+
+    def margin(self) -> float:
+        """Current margin above epsilon of coarse distances."""
+        if self._margin is not None:
+            return self._margin
+        with self._n_diffs.get_lock():
+            n = self._n_diffs.value
+            diffs = np.frombuffer(self._diffs, dtype=float)[:min(
+                n, self.window)].copy()
+        if n < self.min_samples:
+            return np.inf
+        return float(np.quantile(diffs, self.margin_quantile))
+
+    def _count(self, i: int):
+        with self._n.get_lock():
+            self._n[i] += 1
+
+    def _record_diff(self, diff: float):
+        with self._n_diffs.get_lock():
+            self._diffs[self._n_diffs.value % self.window] = diff
+            self._n_diffs.value += 1
+
+    def _record_epsilon(self, eps: float, t: int):
+        self._eps.value = eps
+        self._t.value = t
+
+    def _evaluate(self, x, *args, **kwargs) -> _Evaluated:
+        par = dict(x)
+        key = par_key(par)
+        t = self._t.value
+        self._count(0)
+
+        coarse = self._coarse_model(x, *args, **kwargs)
+        d_c = np.inf
+        alpha = 1.
+        if coarse is not None:
+            ss_c = self._coarse_summary_statistics(coarse)
+            d_c = self.distance_fn(ss_c, self._x_0, t, par)
+            if d_c > self._eps.value+self.margin():
+                alpha = self.audit_probability
+        if alpha < 1. and np.random.uniform() >= alpha:
+            self._factors[key] = 0.
+            self._count(2)
+            return _Evaluated(self._summary_statistics(None))
+
+        ss = self._summary_statistics(self._model(x, *args, **kwargs))
+        self._count(1)
+        d_f = self.distance_fn(ss, self._x_0, t, par)
+        if np.isfinite(d_c) and np.isfinite(d_f):
+            self._record_diff(d_c-d_f)
+        if alpha < 1.:
+            self._factors[key] = 1./alpha
+            self._count(3)
+        return _Evaluated(ss)
+
+    def _pop_factor(self, par: Dict[str, float]) -> float:
+        return self._factors.pop(par_key(dict(par)), 1.)
+
+    @property
+    def n_evaluated(self) -> int:
+        return self._n[0]
+
+    @property
+    def n_full(self) -> int:
+        """Number of particles simulated at full fidelity."""
+        return self._n[1]
+
+    @property
+    def n_skipped(self) -> int:
+        """Number of particles rejected at low fidelity."""
+        return self._n[2]
+
+    @property
+    def n_audited(self) -> int:
+        """Number of particles outside the margin simulated in full."""
+        return self._n[3]
+
+    @property
+    def fraction_avoided(self) -> float:
+        """Fraction of full fidelity simulations avoided."""
+        n = self.n_evaluated
+        return self.n_skipped/n if n > 0 else 0.
+
+    def report(self) -> pd.Series:
+        """Counts of simulations, fraction avoided and current margin."""
+        return pd.Series({'evaluated': self.n_evaluated,
+                          'full': self.n_full,
+                          'skipped': self.n_skipped,
+                          'audited': self.n_audited,
+                          'fraction_avoided': self.fraction_avoided,
+                          'margin': self.margin()})
+
+
+class MultiFidelityAcceptor(UniformAcceptor):
+    """Uniform acceptor applying the early rejection of `MultiFidelity`.
+
+    Particles rejected at low fidelity are rejected and audited particles
+    have their weight corrected. Created by `MultiFidelity`.
+    """
+    def __init__(self,
+                 multi_fidelity: MultiFidelity,
+                 use_complete_history: bool=False):
+        super().__init__(use_complete_history=use_complete_history)
+        self.multi_fidelity = multi_fidelity
+
+    def __call__(self, distance_function, eps, x, x_0, t, par):
+        self.multi_fidelity._record_epsilon(eps(t), t)
+        factor = self.multi_fidelity._pop_factor(par)
+        result = super().__call__(distance_function, eps, x, x_0, t, par)
+        if factor == 1.:
+            return result
+        return AcceptorResult(distance=result.distance,
+                              accept=result.accept and factor > 0,
+                              weight=result.weight*factor)
+
+
+class MultiFidelityEpsilon(Epsilon):
+    """pyABC epsilon passing its values on to `MultiFidelity`.
+
+    Wraps another epsilon schedule, recording its value for each
+    generation as pyABC reads it. Created by `MultiFidelity`.
+    """
+    def __init__(self, multi_fidelity: MultiFidelity, eps: Epsilon):
+        super().__init__()
+        self.multi_fidelity = multi_fidelity
+        self.eps = eps
+
+    def initialize(self, *args, **kwargs):
+        self.eps.initialize(*args, **kwargs)
+
+    def configure_sampler(self, *args, **kwargs):
+        self.eps.configure_sampler(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self.eps.update(*args, **kwargs)
+
+    def __call__(self, t: int) -> float:
+        eps = self.eps(t)
+        self.multi_fidelity._record_epsilon(eps, t)
+        return eps
+
+    def get_config(self):
+        return self.eps.get_config()
+
+    def __getattr__(self, name):
+        # Other methods of the wrapped schedule
+        if name == 'eps':
+            raise AttributeError(name)
+        return getattr(self.eps, name)
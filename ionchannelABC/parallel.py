@@ -0,0 +1,112 @@
+"""Evaluation of many parameter samples of a `setup` model in parallel.
+
+Worker processes are forked so the model and summary statistics closures
+(including compiled Myokit simulations) are inherited rather than pickled.
+"""
+import multiprocessing
+import numpy as np
+from typing import Callable, Dict, List
+
+from .experiment import SUM_STATS_KEY
+
+# Closures inherited by forked worker processes
+_worker_state = None
+
+
+def sum_stats_to_array(sum_stats: Dict) -> np.ndarray:
+    """Convert summary statistics in dict or array format to a vector.
+
+    Dict format values are ordered by their integer keys, i.e. in the order
+    of the observations, whatever the order of the dict.
+    """
+    if SUM_STATS_KEY in sum_stats:
+        return np.asarray(sum_stats[SUM_STATS_KEY], dtype=float)
+    return np.array([sum_stats[k] for k in sorted(sum_stats.keys(), key=int)],
+                    dtype=float)
+
+
+def _evaluate_one(model: Callable,
+                  summary_statistics: Callable,
+                  pars: Dict[str, float],
+                  try_limit: int) -> np.ndarray:
+    """Summary statistics of one sample, retrying failures if requested."""
+    results = sum_stats_to_array(summary_statistics(model(pars)))
+    try_cnt = 1
+    while not np.all(np.isfinite(results)) and try_cnt < try_limit:
+        results = sum_stats_to_array(
+            summary_statistics(model(pars, draw=try_cnt)))
+        try_cnt += 1
+    return results
+
+
+def _evaluate_chunk(args):
+    start, samples, seed = args
+    model, summary_statistics, n_stats, try_limit = _worker_state
+
+    # Avoid identical background draws in every forked worker
+    background = getattr(model, 'background', None)
+    if background is not None and background.bank is None:
+        background.rng = np.random.RandomState(seed)
+
+    output = np.empty((len(samples), n_stats))
+    for i, pars in enumerate(samples):
+        output[i, :] = _evaluate_one(model, summary_statistics, pars,
+                                     try_limit)
+    return start, output
+
+
+def evaluate_samples(model: Callable,
+                     summary_statistics: Callable,
+                     samples: List[Dict[str, float]],
+                     n_stats: int,
+                     n_workers: int=1,
+                     try_limit: int=1,
+                     chunksize: int=None,
+                     seed: int=None) -> np.ndarray:
+    """Summary statistics for each parameter sample.
+
+    Args:
+        model (Callable): Model function from `setup`.
+        summary_statistics (Callable): Summary statistics function from
+            `setup`, in either dict or array format.
+        samples (List[Dict[str, float]]): Parameter samples to evaluate.
+        n_stats (int): Number of summary statistics, i.e. observations.
+        n_workers (int): Number of processes. Evaluated in the current
+            process if 1.
+        try_limit (int): Number of attempts with different background
+            samples for failed simulations.
+        chunksize (int): Number of samples sent to a worker at once.
+            Defaults to spreading samples evenly over four chunks per worker.
+        seed (int): Optional seed for background sampling in workers.
+
+    Returns:
+        np.ndarray: Summary statistics with shape (samples, statistics).
+            Failed samples are filled with np.inf.
+    """
+    global _worker_state
+
+    n_workers = max(1, min(n_workers, len(samples)))
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(len(samples)/(4*n_workers))))
+    chunk_seeds = np.random.RandomState(seed).randint(
+        2**31, size=int(np.ceil(len(samples)/chunksize)))
+    chunks = [(start, samples[start:start+chunksize], chunk_seeds[k])
+              for k, start in enumerate(range(0, len(samples), chunksize))]
+
+    results = np.empty((len(samples), n_stats))
+    if n_workers == 1:
+        for start, chunk, _ in chunks:
+            for i, pars in enumerate(chunk):
+                results[start+i, :] = _evaluate_one(
+                    model, summary_statistics, pars, try_limit)
+        return results
+
+    _worker_state = (model, summary_statistics, n_stats, try_limit)
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(n_workers) as pool:
+            for start, output in pool.imap_unordered(_evaluate_chunk, chunks):
+                results[start:start+len(output), :] = output
+    finally:
+        _worker_state = None
+    return results
@@ -6,7 +6,8 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from typing import List, Dict, Tuple, Callable
 
-from .distance import IonChannelDistance
+from .distance import IonChannelDistance, distance_by_experiment
+from .parallel import evaluate_samples, sum_stats_to_array
 
 
 def calculate_parameter_sensitivity(
@@ -16,13 +17,22 @@ def calculate_parameter_sensitivity(
         parameters: Dict[str, float],
         distance_fn: IonChannelDistance,
         sigma: float=0.1,
-        n_samples: int=500) -> Tuple[pd.DataFrame, pd.DataFrame, List[float]]:
+        n_samples: int=500,
+        n_workers: int=1,
+        oversample: float=1.2,
+        max_rounds: int=20,
+        seed: int=None) -> Tuple[pd.DataFrame, pd.DataFrame, List[float]]:
     """Estimate of sensitivity to parameter variation and regression fit.
 
     Based on work of:
     Sobie EA. Parameter sensitivity analysis in electrophysiological models
     using multivariable regression. Biophys J. 2009 Feb 18;96(4):1264-74.
 
+    Samples are simulated in batches across `n_workers` processes. Each
+    batch is oversampled to replace failed simulations, and further
+    batches are only drawn if too few succeed. The first `n_samples`
+    successful samples in draw order are used.
+
     Args:
         model (Callable): Model to interrogate.
         summary_statistics (Callable): Summary statistics function
@@ -31,16 +41,22 @@ def calculate_parameter_sensitivity(
         distance_fn (IonChannelDistance): ABC distance function.
         sigma (float): Standard deviation of normalised log-normal distribution.
         n_samples (int): Number of parameter samples for training data.
+        n_workers (int): Number of processes to simulate samples.
+        oversample (float): Factor of extra samples drawn to replace
+            failed simulations.
+        max_rounds (int): Maximum number of batches drawn.
+        seed (int): Optional seed for drawing parameter samples.
 
     Returns:
         Dataframes of sensitivty of each parameter and goodness of regression fit.
         List of r2 scores for regression fits.
         All outputs are used in subsequent functions to produce plots.
-    """
 
-    # Generate lognormal distribution for parameters
-    scale_dist_ln = np.random.lognormal(mean=0.0, sigma=sigma,
-                                        size=(n_samples, len(parameters.keys())))
+    Raises:
+        RuntimeError: Fewer than `n_samples` simulations succeeded in
+            `max_rounds` batches.
+    """
+    rng = np.random.RandomState(seed)
 
     # Get original parameter values
     observations = summary_statistics(model(parameters))
@@ -49,41 +65,46 @@ def calculate_parameter_sensitivity(
     # Initialize weights
     _ = distance_fn(observations, observations, 0)
 
-    p = distance_fn.p
-    w = distance_fn.w[0]
-
+    obs = sum_stats_to_array(observations)
     m = max(exp_map)+1
-    X = np.empty((n_samples, len(original_vals)))
-    Y = np.empty((n_samples, m))
-    def dist(x, y):
-        d = [pow(abs(w[key]*(x[key]-y[key])), p)
-             if key in x and key in y else 0
-             for key in w]
-        d_by_exp = {}
-        for i in range(len(d)):
-            if exp_map[i] not in d_by_exp.keys():
-                d_by_exp[exp_map[i]] = []
-            d_by_exp[exp_map[i]].append(d[i])
-
-        d_out = []
-        for _, val in d_by_exp.items():
-            d_out.append(pow(sum(val), 1/p))
-        return d_out
-
-    # Loop through requested samples and eliminate NaN values
-    i = 0
-    while i < n_samples:
-        X[i, :] = np.multiply(original_vals, scale_dist_ln[i, :])
-        results = summary_statistics(
-                model(dict(zip(parameters.keys(), X[i, :]))))
-        if not np.all(np.isfinite(list(results.values()))):
-            # Change scale multiplier for this sample
-            scale_dist_ln[i, :] = np.random.lognormal(mean=0.0, sigma=sigma,
-                                        size=(1, len(parameters.keys())))
+
+    # Draw batches of lognormal perturbations until enough succeed
+    X = np.empty((0, len(original_vals)))
+    Y = np.empty((0, len(obs)))
+    n_drawn = 0
+    for _ in range(max_rounds):
+        if len(X) >= n_samples:
+            break
+        n_remaining = n_samples - len(X)
+        n_draw = int(np.ceil(n_remaining*oversample))
+        scale_dist_ln = rng.lognormal(mean=0.0, sigma=sigma,
+                                      size=(n_draw, len(original_vals)))
+        X_batch = np.multiply(original_vals, scale_dist_ln)
+        Y_batch = evaluate_samples(
+            model,
+            summary_statistics,
+            [dict(zip(parameters.keys(), x)) for x in X_batch],
+            n_stats=len(obs),
+            n_workers=n_workers,
+            seed=rng.randint(2**31))
+        success = np.all(np.isfinite(Y_batch), axis=1)
+        n_drawn += n_draw
+        if not np.any(success):
+            # Increase oversampling (up to 100x) if a whole batch failed
+            oversample = min(oversample*2, 100.)
             continue
-        # Otherwise continue and add to results
-        Y[i, :] = dist(results, observations)
-        i = i + 1
+        X = np.vstack((X, X_batch[success]))
+        Y = np.vstack((Y, Y_batch[success]))
+    if len(X) < n_samples:
+        raise RuntimeError(
+            'Only {} of {} simulations succeeded ({:.1%}) in {} batches, '
+            'fewer than the {} samples required.'
+            .format(len(X), n_drawn, len(X)/max(n_drawn, 1), max_rounds,
+                    n_samples))
+    X, Y = X[:n_samples], Y[:n_samples]
+
+    # Distance by experiment for all samples at once
+    Y = distance_by_experiment(distance_fn, Y, obs, exp_map)
 
     # Mean center and normalise
     X = np.divide(X - np.mean(X, axis=0), np.std(X, axis=0))
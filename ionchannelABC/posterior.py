@@ -0,0 +1,127 @@
+"""Export of pyABC posteriors to memory-mapped arrays.
+
+Reading a posterior from a pyABC database runs SQL queries and builds
+dataframes on every call. An exported posterior is a directory holding
+the parameter samples as one (particles x parameters) array, the weights
+and the parameter names, which any number of processes can memory-map
+read-only at no parse cost. Exported directories can be passed to `setup`
+and plotting functions in `prev_runs` in place of a database.
+
+Samples of `log_` parameters are stored on linear scale, with a flag of
+which columns were converted, so background sampling reads them without
+copying the array.
+"""
+import os
+import numpy as np
+import pandas as pd
+from typing import Tuple, Union
+
+from pyabc import History
+
+_PARAMETERS = 'parameters.npy'
+_WEIGHTS = 'weights.npy'
+_NAMES = 'names.npy'
+_IS_LOG = 'is_log.npy'
+
+
+def _is_log(names) -> np.ndarray:
+    return np.array([name.startswith('log') for name in names], dtype=bool)
+
+
+def export_posterior(history: Union[History, str],
+                     path: str,
+                     t: int=None) -> str:
+    """Write one generation of a pyABC run to memory-mappable arrays.
+
+    Args:
+        history (Union[History, str]): History of the run, or its database,
+            e.g. "sqlite:///run.db" (defaults to the latest run).
+        path (str): Directory to export to.
+        t (int): Generation to export. Defaults to the last.
+
+    Returns:
+        str: `path`.
+    """
+    if not isinstance(history, History):
+        history = History(history)
+    df, w = history.get_distribution(t=t)
+    is_log = _is_log(df.columns)
+    values = np.array(df.values, dtype=float)
+    values[:, is_log] = 10**values[:, is_log]
+    os.makedirs(path, exist_ok=True)
+    for filename, arr in ((_NAMES, np.array(list(df.columns), dtype=str)),
+                          (_IS_LOG, is_log),
+                          (_WEIGHTS, np.asarray(w, dtype=float)),
+                          (_PARAMETERS, values)):
+        tmp = os.path.join(path, 'tmp-'+filename)
+        np.save(tmp, arr)
+        os.replace(tmp, os.path.join(path, filename))
+    return path
+
+
+def is_exported_posterior(path: str) -> bool:
+    """Whether `path` is a posterior exported by `export_posterior`."""
+    return (isinstance(path, str) and
+            os.path.isfile(os.path.join(path, _PARAMETERS)))
+
+
+def load_posterior_arrays(path: str,
+                          mmap: bool=True,
+                          linear: bool=False
+                          ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parameter names, samples and weights of an exported posterior.
+
+    Args:
+        path (str): Directory from `export_posterior`.
+        mmap (bool): Whether to memory-map samples and weights read-only.
+        linear (bool): Whether to return all samples on linear scale, with
+            the `log_` prefix removed from names. This reads the stored
+            array without a copy, otherwise `log_` parameters are
+            converted back to log scale.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Names, samples with
+            shape (particles, parameters) and weights.
+    """
+    mmap_mode = 'r' if mmap else None
+    names = np.load(os.path.join(path, _NAMES))
+    values = np.load(os.path.join(path, _PARAMETERS), mmap_mode=mmap_mode)
+    w = np.load(os.path.join(path, _WEIGHTS), mmap_mode=mmap_mode)
+    is_log = _is_log(names)
+    # Exports without the flag hold samples as in the pyABC history
+    stored_linear = os.path.isfile(os.path.join(path, _IS_LOG))
+    if np.any(is_log) and linear != stored_linear:
+        values = np.array(values, dtype=float)
+        if linear:
+            values[:, is_log] = 10**values[:, is_log]
+        else:
+            values[:, is_log] = np.log10(values[:, is_log])
+    if linear:
+        names = np.array([name[4:] if log else name
+                          for name, log in zip(names, is_log)], dtype=str)
+    return names, values, w
+
+
+def load_posterior(source: Union[History, str],
+                   t: int=None,
+                   mmap: bool=True) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Posterior samples and weights as from `History.get_distribution`.
+
+    Args:
+        source (Union[History, str]): Directory from `export_posterior`,
+            or a History or database to read from.
+        t (int): Generation if reading from a History. Defaults to the
+            last.
+        mmap (bool): Whether to memory-map an exported posterior. Samples
+            of `log_` parameters are converted back from linear scale in
+            memory.
+
+    Returns:
+        Tuple[pd.DataFrame, np.ndarray]: Parameter samples and weights.
+    """
+    if is_exported_posterior(source):
+        names, values, w = load_posterior_arrays(source, mmap=mmap)
+        return pd.DataFrame(values, columns=list(names), copy=False), w
+    if not isinstance(source, History):
+        source = History(source)
+    return source.get_distribution(t=t)
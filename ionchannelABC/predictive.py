@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+from typing import Tuple
+
+from .experiment import Experiment, setup
+from .parallel import evaluate_samples
+from .store import PosteriorStore
+
+
+def posterior_predictive(modelfile: str,
+                         *experiments: Experiment,
+                         df: pd.DataFrame=None,
+                         w: np.ndarray=None,
+                         n_samples: int=100,
+                         n_workers: int=1,
+                         exclude_infs: bool=False,
+                         try_limit: int=100,
+                         seed: int=None,
+                         store: PosteriorStore=None,
+                         **setup_kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Simulate summary statistics for samples from an ABC posterior.
+
+    Samples are evaluated across a pool of processes and collected into a
+    preallocated (samples x summary statistics) array which is converted to
+    a tidy dataframe once at the end.
+
+    Args:
+        modelfile (str): Path to Myokit MMT file.
+        *experiments (Experiment): Experiments to simulate.
+        df (pd.DataFrame): Dataframe of parameters (see pyabc.History).
+            If `None` runs model with current parameter settings.
+        w (np.ndarray): The corresponding weights (see pyabc.History).
+        n_samples (int): Number of ABC posterior samples.
+        n_workers (int): Number of processes to evaluate samples.
+        exclude_infs (bool): Whether to retry failed simulations with a
+            different background sample (see `setup` prev_runs and
+            additional_pars) up to `try_limit` times.
+        try_limit (int): Maximum attempts per sample if `exclude_infs`.
+        seed (int): Optional seed for posterior and background sampling.
+        store (PosteriorStore): Optional store for this posterior. Results
+            already stored for the same model, experiments and options are
+            read instead of simulated, otherwise new results are added.
+        **setup_kwargs: Passed to `setup`.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]:
+            Observations from `setup`.
+            Simulated output with columns `x`, `y`, `exp_id` and `sample`.
+
+    Raises:
+        Exception: `exclude_infs` is set and a sample still fails after
+            `try_limit` attempts.
+    """
+    if store is not None:
+        key = store.key(modelfile,
+                        list(experiments),
+                        df=df,
+                        w=w,
+                        n_samples=n_samples,
+                        exclude_infs=exclude_infs,
+                        try_limit=try_limit if exclude_infs else 1,
+                        seed=seed,
+                        **_store_options(setup_kwargs))
+        if key in store:
+            _, observations, output = store.load_predictive(key)
+            return observations, output
+
+    observations, model, summary_statistics = setup(modelfile,
+                                                    *experiments,
+                                                    seed=seed,
+                                                    **setup_kwargs)
+
+    if df is not None:
+        posterior_samples = (df.sample(n=n_samples, weights=w, replace=True,
+                                       random_state=seed)
+                               .to_dict(orient='records'))
+    else:
+        posterior_samples = [{}]
+
+    results = evaluate_samples(model,
+                               summary_statistics,
+                               posterior_samples,
+                               n_stats=len(observations),
+                               n_workers=n_workers,
+                               try_limit=try_limit if exclude_infs else 1,
+                               seed=seed)
+    if exclude_infs and not np.all(np.isfinite(results)):
+        raise Exception('exclude_infs failed in {} iterations'
+                        .format(try_limit))
+
+    n = len(posterior_samples)
+    output = pd.DataFrame({'x': np.tile(observations.x.values, n),
+                           'y': results.reshape(-1),
+                           'exp_id': np.tile(observations.exp_id.values, n),
+                           'sample': np.repeat(np.arange(n),
+                                               len(observations))})
+    if store is not None:
+        store.save_predictive(key, pd.DataFrame(posterior_samples),
+                              observations, output)
+    return observations, output
+
+
+def _store_options(setup_kwargs: dict) -> dict:
+    """Options identifying results.
+
+    The result cache and profiler are excluded as they do not change
+    results. The failure region cache and runtime budget do, by rejecting
+    particles, so are identified by their settings.
+    """
+    options = {k: v for k, v in setup_kwargs.items()
+               if k not in ('cache', 'profiler')}
+    for k in ('failure_cache', 'runtime_budget'):
+        if options.get(k) is not None:
+            options[k] = (type(options[k]).__name__,
+                          sorted((name, value)
+                                 for name, value in vars(options[k]).items()
+                                 if not name.startswith('_')))
+    return options
@@ -0,0 +1,227 @@
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict
+
+
+class Profiler:
+    """Collector of timings inside the model and summary statistics.
+
+    Pass to `setup` to record, for every evaluation, the time spent by each
+    experiment setting parameters, resetting the simulation, running it
+    (including creating the logged `myokit.DataLog`) and calculating its
+    summary statistics, and whether that stage failed. Runs also record
+    the solver statistics in `solver_stats`.
+
+    Records are kept in memory by the process that made them. pyABC
+    multicore samplers evaluate particles in forked worker processes, so
+    set `path` to have each process append its records to its own file in
+    that directory after every evaluation; `to_dataframe` then combines the
+    records of all processes.
+
+    Records are assigned to the generation set with `set_generation` (which
+    forked workers inherit), or to a pyABC generation afterwards by passing
+    the `pyabc.History` of the run to `to_dataframe` or `summary`.
+
+    Args:
+        path (str): Optional directory to write records of each process to.
+    """
+    # Solver statistic: method of `myokit.Simulation` reporting it for the
+    # last run. Myokit only reports the number of CVODE steps and
+    # right-hand side evaluations, not Jacobian evaluations or error test
+    # failures. Runs which fail before reporting are recorded as nan.
+    solver_stats = {'steps': 'last_number_of_steps',
+                    'rhs_evaluations': 'last_number_of_evaluations'}
+    columns = (['timestamp', 'pid', 'generation', 'experiment', 'stage',
+                'duration', 'failed'] + list(solver_stats.keys()))
+
+    def __init__(self, path: str=None):
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.generation = np.nan
+        self._records = []
+
+    def set_generation(self, t: int):
+        """Assign subsequent records to generation `t`."""
+        self.generation = t
+
+    def record(self,
+               experiment: int,
+               stage: str,
+               duration: float,
+               failed: bool=False,
+               **stats: float):
+        """Add a record of one stage of one experiment.
+
+        Args:
+            **stats: Solver statistics of the stage (see `solver_stats`).
+        """
+        self._records.append([time.time(), os.getpid(), self.generation,
+                              experiment, stage, duration, failed] +
+                             [stats.get(k, np.nan) for k in self.solver_stats])
+
+    @classmethod
+    def get_solver_stats(cls, sim: 'myokit.Simulation') -> Dict[str, float]:
+        """Solver statistics of the last run of a simulation."""
+        stats = {}
+        for name, method in cls.solver_stats.items():
+            try:
+                stats[name] = float(getattr(sim, method)())
+            except (AttributeError, TypeError, ValueError):
+                stats[name] = np.nan
+        return stats
+
+    @contextmanager
+    def stage(self, experiment: int, name: str):
+        """Time the enclosed block as stage `name` of `experiment`.
+
+        Yields a dict whose `failed` entry can be set to mark the stage as
+        failed, and to which solver statistics can be added. Exceptions
+        raised in the block also mark it as failed.
+        """
+        rec = {'failed': False}
+        start = time.perf_counter()
+        try:
+            yield rec
+        except BaseException:
+            rec['failed'] = True
+            raise
+        finally:
+            duration = time.perf_counter()-start
+            self.record(experiment, name, duration, **rec)
+
+    def timed(self, experiment: int, name: str, f: Callable) -> Callable:
+        """Wrap function `f` to time each call as stage `name`."""
+        def timed_f(*args, **kwargs):
+            with self.stage(experiment, name):
+                return f(*args, **kwargs)
+        return timed_f
+
+    def _file(self) -> str:
+        return os.path.join(self.path, 'profile-{}.csv'.format(os.getpid()))
+
+    def flush(self):
+        """Append buffered records to this process's file in `path`."""
+        if self.path is None or len(self._records) == 0:
+            return
+        filename = self._file()
+        (pd.DataFrame(self._records, columns=self.columns)
+           .to_csv(filename, mode='a', index=False,
+                   header=not os.path.exists(filename)))
+        self._records = []
+
+    def to_dataframe(self, history=None) -> pd.DataFrame:
+        """All records as a table with one row per stage of an experiment.
+
+        Args:
+            history (pyabc.History): Optional history of the profiled run
+                used to assign records to generations by time.
+        """
+        frames = [pd.DataFrame(self._records, columns=self.columns)]
+        if self.path is not None:
+            frames += [pd.read_csv(os.path.join(self.path, f))
+                       for f in sorted(os.listdir(self.path))
+                       if f.startswith('profile-') and f.endswith('.csv')]
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        if history is not None:
+            df['generation'] = generation_from_time(history,
+                                                    df['timestamp'].values)
+        return df
+
+    def summary(self, history=None) -> pd.DataFrame:
+        """Time and failures by generation, experiment and stage.
+
+        Args:
+            history (pyabc.History): Optional history of the profiled run
+                used to assign records to generations by time.
+        """
+        df = self.to_dataframe(history=history)
+        by = ['experiment', 'stage']
+        if df['generation'].notnull().any():
+            by = ['generation'] + by
+        return (df.groupby(by)
+                  .agg(count=('duration', 'size'),
+                       total=('duration', 'sum'),
+                       mean=('duration', 'mean'),
+                       median=('duration', 'median'),
+                       failed=('failed', 'sum'),
+                       **{'mean_'+k: (k, 'mean') for k in self.solver_stats}))
+
+    def solver_histogram(self,
+                         stat: str='steps',
+                         bins: int=20,
+                         log: bool=True,
+                         history=None) -> pd.DataFrame:
+        """Histogram of a solver statistic by generation and experiment.
+
+        All histograms share the same bins so generations can be compared.
+
+        Args:
+            stat (str): Solver statistic (see `solver_stats`).
+            bins (int): Number of bins.
+            log (bool): Whether bins are evenly spaced in log10 of `stat`.
+            history (pyabc.History): Optional history of the profiled run
+                used to assign records to generations by time.
+
+        Returns:
+            pd.DataFrame: Columns `generation`, `experiment`, `left`,
+                `right` and `count` with one row per bin.
+        """
+        df = self.to_dataframe(history=history)
+        df = df[(df.stage == 'run') & df[stat].notnull()]
+        if len(df) == 0:
+            raise ValueError('No runs recorded with {}.'.format(stat))
+        values = df[stat].values.astype(float)
+        if log:
+            values = np.log10(np.maximum(values, 1.))
+        edges = np.histogram_bin_edges(values, bins=bins)
+        rows = []
+        generation = df['generation'].fillna(-1).values
+        for (t, exp), idx in (pd.DataFrame({'t': generation,
+                                            'exp': df['experiment'].values})
+                                .groupby(['t', 'exp']).indices.items()):
+            counts, _ = np.histogram(values[idx], bins=edges)
+            left, right = edges[:-1], edges[1:]
+            if log:
+                left, right = 10**left, 10**right
+            rows.append(pd.DataFrame({'generation': t if t >= 0 else np.nan,
+                                      'experiment': exp,
+                                      'left': left,
+                                      'right': right,
+                                      'count': counts}))
+        return pd.concat(rows, ignore_index=True)
+
+    def reset(self):
+        """Discard all records, including those written to `path`."""
+        self._records = []
+        if self.path is not None:
+            for f in os.listdir(self.path):
+                if f.startswith('profile-') and f.endswith('.csv'):
+                    os.remove(os.path.join(self.path, f))
+
+
+def generation_from_time(history, timestamps: np.ndarray) -> np.ndarray:
+    """Generation of a pyABC run in progress at each (epoch) timestamp.
+
+    Args:
+        history (pyabc.History): History of the run.
+        timestamps (np.ndarray): Times as returned by `time.time()`.
+
+    Returns:
+        np.ndarray: Generation `t`, or nan after the last generation ended.
+    """
+    populations = history.get_all_populations()
+    populations = populations[populations.t >= 0].sort_values('t')
+    end_times = np.array([t.timestamp()
+                          for t in populations.population_end_time])
+    idx = np.searchsorted(end_times, np.asarray(timestamps, dtype=float))
+    t = np.append(populations.t.values.astype(float), np.nan)
+    return t[idx]
+
+
+@contextmanager
+def _no_profile(experiment: int, name: str):
+    yield {'failed': False}
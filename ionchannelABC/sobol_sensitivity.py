@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+import seaborn as sns
+from typing import Callable, Dict, List, Tuple
+import warnings
+
+from .distance import IonChannelDistance, distance_by_experiment
+from .parallel import evaluate_samples, sum_stats_to_array
+
+
+def calculate_sobol_sensitivity(
+        model: Callable,
+        summary_statistics: Callable,
+        exp_map: List[int],
+        limits: Dict[str, Tuple[float, float]],
+        distance_fn: IonChannelDistance,
+        x_0: Dict[str, float],
+        n_base: int=512,
+        n_workers: int=1,
+        n_bootstrap: int=100,
+        seed: int=None) -> pd.DataFrame:
+    """Variance-based (Sobol) sensitivity of each experiment to parameters.
+
+    First-order and total-order indices of the distance of each experiment
+    to the reference data are estimated with the Saltelli sampling scheme
+    using the estimators of:
+    Saltelli A, et al. Variance based sensitivity analysis of model output.
+    Design and estimator for the total sensitivity index. Comput Phys
+    Commun. 2010;181(2):259-270.
+
+    Two base matrices A and B of `n_base` points are drawn from a scrambled
+    Sobol sequence over the parameter limits, giving n_base*(d+2)
+    simulations for d parameters. All experiments are computed from the
+    same simulations. Base points for which any simulation fails are
+    dropped for all parameters.
+
+    Args:
+        model (Callable): Model to interrogate.
+        summary_statistics (Callable): Summary statistics function.
+        exp_map (List[int]): List of experiment number for each data point.
+        limits (Dict[str, Tuple[float, float]]): Lower and upper bounds of
+            each parameter, in the same space as passed to the model (e.g.
+            log-transformed for `log_` parameters).
+        distance_fn (IonChannelDistance): ABC distance function.
+        x_0 (Dict[str, float]): Reference summary statistics, e.g. observed
+            data.
+        n_base (int): Number of base samples, rounded up to a power of 2.
+        n_workers (int): Number of processes to simulate samples.
+        n_bootstrap (int): Number of bootstrap resamples for confidence
+            intervals.
+        seed (int): Optional seed for scrambling and bootstrapping.
+
+    Returns:
+        pd.DataFrame: Columns `param`, `exp`, `S1`, `ST` and 95% bootstrap
+            confidence half-widths `S1_conf`, `ST_conf`.
+
+    Raises:
+        RuntimeError: Simulations failed for every base point.
+    """
+    try:
+        from scipy.stats import qmc
+    except ImportError:
+        raise ImportError('Sobol sensitivity requires scipy>=1.7 for '
+                          'scrambled Sobol sequences.')
+
+    names = list(limits.keys())
+    d = len(names)
+    lower = np.array([limits[k][0] for k in names])
+    upper = np.array([limits[k][1] for k in names])
+
+    # Base matrices from one 2d-dimensional scrambled Sobol sequence
+    sampler = qmc.Sobol(d=2*d, scramble=True, seed=seed)
+    base = sampler.random_base2(m=int(np.ceil(np.log2(n_base))))
+    n = base.shape[0]
+    A = lower + (upper-lower)*base[:, :d]
+    B = lower + (upper-lower)*base[:, d:]
+    AB = np.tile(A, (d, 1, 1))
+    for i in range(d):
+        AB[i, :, i] = B[:, i]
+
+    # Simulate A, B and each AB_i in one batch
+    X = np.vstack([A, B]+[AB[i] for i in range(d)])
+    # Initialize weights
+    _ = distance_fn(x_0, x_0, 0)
+    x_0 = sum_stats_to_array(x_0)
+    Y = evaluate_samples(model,
+                         summary_statistics,
+                         [dict(zip(names, x)) for x in X],
+                         n_stats=len(x_0),
+                         n_workers=n_workers,
+                         seed=seed)
+    D = distance_by_experiment(distance_fn, Y, x_0, exp_map)
+    D = D.reshape(d+2, n, -1)
+    f_A, f_B, f_AB = D[0], D[1], D[2:]
+
+    # Drop base points with any failed simulation
+    valid = (np.all(np.isfinite(f_A), axis=1) &
+             np.all(np.isfinite(f_B), axis=1) &
+             np.all(np.isfinite(f_AB), axis=(0, 2)))
+    n_valid = int(np.sum(valid))
+    if n_valid == 0:
+        raise RuntimeError('Simulations failed for all {} base points.'
+                           .format(n))
+    if n_valid < n/2:
+        warnings.warn('Simulations failed for {} of {} base points, Sobol '
+                      'indices are estimated from the remaining {}.'
+                      .format(n-n_valid, n, n_valid))
+    f_A, f_B, f_AB = f_A[valid], f_B[valid], f_AB[:, valid]
+
+    S1, ST, S1_conf, ST_conf = sobol_indices(f_A, f_B, f_AB,
+                                             n_bootstrap=n_bootstrap,
+                                             seed=seed)
+
+    # Indices have shape (parameters, experiments)
+    m = S1.shape[1]
+    parameter_names = [p.split('.')[-1] for p in names]
+    return pd.DataFrame({'param': parameter_names*m,
+                         'exp': np.repeat(np.arange(m), d),
+                         'S1': S1.T.reshape(-1),
+                         'ST': ST.T.reshape(-1),
+                         'S1_conf': S1_conf.T.reshape(-1),
+                         'ST_conf': ST_conf.T.reshape(-1)})
+
+
+def sobol_indices(f_A: np.ndarray,
+                  f_B: np.ndarray,
+                  f_AB: np.ndarray,
+                  n_bootstrap: int=100,
+                  seed: int=None) -> Tuple[np.ndarray, ...]:
+    """First- and total-order Sobol indices from Saltelli samples.
+
+    Args:
+        f_A (np.ndarray): Outputs at base points A, shape (n, outputs).
+        f_B (np.ndarray): Outputs at base points B, shape (n, outputs).
+        f_AB (np.ndarray): Outputs at A with column i from B, shape
+            (parameters, n, outputs).
+        n_bootstrap (int): Number of bootstrap resamples for confidence
+            intervals.
+        seed (int): Optional seed for bootstrapping.
+
+    Returns:
+        Tuple[np.ndarray, ...]: S1, ST and their 95% bootstrap confidence
+            half-widths, each with shape (parameters, outputs).
+    """
+    def indices(idx):
+        var = np.var(np.concatenate((f_A[idx], f_B[idx])), axis=0)
+        S1 = np.mean(f_B[idx]*(f_AB[:, idx]-f_A[idx]), axis=1)/var
+        ST = 0.5*np.mean((f_A[idx]-f_AB[:, idx])**2, axis=1)/var
+        return S1, ST
+
+    n = f_A.shape[0]
+    S1, ST = indices(np.arange(n))
+
+    rng = np.random.RandomState(seed)
+    boot = [indices(rng.randint(n, size=n)) for _ in range(n_bootstrap)]
+    S1_conf = 1.96*np.std([b[0] for b in boot], axis=0)
+    ST_conf = 1.96*np.std([b[1] for b in boot], axis=0)
+    return S1, ST, S1_conf, ST_conf
+
+
+def plot_sobol_sensitivity(indices: pd.DataFrame) -> sns.FacetGrid:
+    """Plot first- and total-order Sobol indices for each experiment."""
+    df = pd.melt(indices, id_vars=['param', 'exp'],
+                 value_vars=['S1', 'ST'], var_name='order',
+                 value_name='index')
+    grid = (sns.catplot(x='param', y='index', hue='order',
+                        row='exp', data=df, kind='bar',
+                        sharey=False)
+                .despine(left=True, bottom=True))
+    return grid
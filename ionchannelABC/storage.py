@@ -0,0 +1,194 @@
+"""Compact storage of accepted summary statistics.
+
+pyABC stores every summary statistic of every accepted particle in its
+database. `export_sum_stats` writes each generation's summary statistics
+instead as one (particles x statistics) array file, read back memory-mapped
+by `load_sum_stats`, after which `prune_sum_stats` can remove them from the
+database. Summary statistics in `array` format (see `setup`) are already
+stored by pyABC as one packed array per particle, optionally as float32.
+"""
+import os
+import re
+import sqlite3
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple, Union
+
+from pyabc import History
+
+from .parallel import sum_stats_to_array
+
+
+def _sum_stats_file(path: str, t: int) -> str:
+    return os.path.join(path, 'sum_stats_{}.npy'.format(t))
+
+
+def _weights_file(path: str, t: int) -> str:
+    return os.path.join(path, 'sum_stats_weights_{}.npy'.format(t))
+
+
+def sum_stats_matrix(sum_stats: List[Dict],
+                     dtype: str='float64') -> np.ndarray:
+    """Stack summary statistics of particles into a 2D array.
+
+    Args:
+        sum_stats (List[Dict]): Summary statistics of each particle in
+            dict or array format.
+        dtype (str): Data type of the output.
+
+    Returns:
+        np.ndarray: Array with shape (particles, statistics).
+    """
+    if len(sum_stats) == 0:
+        return np.empty((0, 0), dtype=dtype)
+    return np.stack([sum_stats_to_array(ss) for ss in sum_stats]).astype(
+            dtype, copy=False)
+
+
+def export_sum_stats(history: History,
+                     path: str,
+                     t: Union[int, List[int]]=None,
+                     dtype: str='float32') -> List[int]:
+    """Write accepted summary statistics of generations to array files.
+
+    Args:
+        history (History): History of the ABC run.
+        path (str): Directory of the array files.
+        t (Union[int, List[int]]): Generation(s) to export. Defaults to all.
+        dtype (str): Data type of the stored summary statistics.
+
+    Returns:
+        List[int]: Generations exported.
+    """
+    os.makedirs(path, exist_ok=True)
+    if t is None:
+        t = list(range(history.max_t+1))
+    elif not isinstance(t, list):
+        t = [t]
+    for t_ in t:
+        weights, sum_stats = history.get_weighted_sum_stats(t=t_)
+        for filename, arr in ((_sum_stats_file(path, t_),
+                               sum_stats_matrix(sum_stats, dtype=dtype)),
+                              (_weights_file(path, t_),
+                               np.asarray(weights, dtype=float))):
+            tmp = filename+'.tmp.npy'
+            np.save(tmp, arr)
+            os.replace(tmp, filename)
+    return t
+
+
+def exported_generations(path: str) -> List[int]:
+    """Generations with summary statistics exported to `path`."""
+    return sorted(int(m.group(1)) for m in
+                  (re.match(r'sum_stats_(\d+)\.npy$', f)
+                   for f in os.listdir(path)) if m is not None)
+
+
+def load_sum_stats(source: Union[History, str],
+                   t: int=None,
+                   mmap: bool=True) -> Tuple[np.ndarray, np.ndarray]:
+    """Accepted summary statistics and weights of a generation.
+
+    Args:
+        source (Union[History, str]): History of the ABC run, or directory
+            of array files from `export_sum_stats`.
+        t (int): Generation. Defaults to the last.
+        mmap (bool): Whether to memory-map exported arrays read-only
+            rather than reading them into memory.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Summary statistics with shape
+            (particles, statistics) and the corresponding weights.
+    """
+    if isinstance(source, History):
+        weights, sum_stats = source.get_weighted_sum_stats(t=t)
+        return sum_stats_matrix(sum_stats), np.asarray(weights, dtype=float)
+    if t is None:
+        t = exported_generations(source)[-1]
+    mmap_mode = 'r' if mmap else None
+    return (np.load(_sum_stats_file(source, t), mmap_mode=mmap_mode),
+            np.load(_weights_file(source, t), mmap_mode=mmap_mode))
+
+
+def sum_stats_output(sum_stats: np.ndarray,
+                     observations: pd.DataFrame) -> pd.DataFrame:
+    """Long-format summary statistics for plotting.
+
+    Undoes the normalisation applied in `setup`, giving the same format as
+    the simulated output of `posterior_predictive`.
+
+    Args:
+        sum_stats (np.ndarray): Summary statistics with shape (particles,
+            statistics), e.g. from `load_sum_stats`.
+        observations (pd.DataFrame): Observations from `setup` for the
+            same experiments.
+
+    Returns:
+        pd.DataFrame: Columns `x`, `y`, `exp_id` and `sample`.
+    """
+    n, n_obs = sum_stats.shape
+    y = np.asarray(sum_stats, dtype=float)*observations.normalise_factor.values
+    return pd.DataFrame({'x': np.tile(observations.x.values, n),
+                         'y': y.reshape(-1),
+                         'exp_id': np.tile(observations.exp_id.values, n),
+                         'sample': np.repeat(np.arange(n), n_obs)})
+
+
+def prune_sum_stats(db: str,
+                    path: str,
+                    abc_id: int=None,
+                    t: Union[int, List[int]]=None) -> List[int]:
+    """Delete stored summary statistics of a run from a pyABC database.
+
+    Only accepted summary statistics of generations t >= 0 are deleted.
+    The observed summary statistics, stored by pyABC as a population before
+    the first generation, and other runs in the database are kept. Note
+    that pyABC can then no longer read summary statistics of the pruned
+    generations, e.g. for adaptive distance functions when resuming the
+    run.
+
+    Args:
+        db (str): Database as passed to pyABC, e.g. "sqlite:///run.db".
+        path (str): Directory of array files written by `export_sum_stats`.
+        abc_id (int): Run in the database. Defaults to the latest.
+        t (Union[int, List[int]]): Generation(s) to prune. Defaults to all.
+
+    Returns:
+        List[int]: Generations pruned.
+
+    Raises:
+        ValueError: A generation has not been exported to `path`.
+    """
+    if not db.startswith('sqlite:///'):
+        raise ValueError('Only SQLite databases are supported.')
+    conn = sqlite3.connect(db[len('sqlite:///'):])
+    try:
+        if abc_id is None:
+            abc_id = conn.execute('SELECT MAX(id) FROM abc_smc').fetchone()[0]
+        if t is None:
+            t = [row[0] for row in conn.execute(
+                    'SELECT t FROM populations WHERE abc_smc_id = ? '
+                    'AND t >= 0 ORDER BY t', (abc_id,))]
+        elif not isinstance(t, list):
+            t = [t]
+        exported = set(exported_generations(path))
+        missing = [t_ for t_ in t if t_ not in exported]
+        if len(missing) > 0:
+            raise ValueError('Summary statistics of generations {} have '
+                             'not been exported.'.format(missing))
+        for t_ in t:
+            if t_ < 0:
+                continue
+            conn.execute(
+                'DELETE FROM summary_statistics WHERE sample_id IN ('
+                'SELECT samples.id FROM samples '
+                'JOIN particles ON samples.particle_id = particles.id '
+                'JOIN models ON particles.model_id = models.id '
+                'JOIN populations ON models.population_id = populations.id '
+                'WHERE populations.abc_smc_id = ? AND populations.t = ?)',
+                (abc_id, t_))
+        conn.commit()
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+    return [t_ for t_ in t if t_ >= 0]
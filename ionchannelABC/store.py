@@ -0,0 +1,159 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple
+
+from .cache import experiment_signature
+from .traces import TraceEnsemble
+
+
+def _posterior_hash(df: pd.DataFrame, w: np.ndarray) -> str:
+    """Hash of posterior samples and weights, or None if no posterior."""
+    if df is None:
+        return None
+    h = hashlib.sha1()
+    h.update(repr(list(df.columns)).encode())
+    h.update(np.ascontiguousarray(df.values, dtype=float).tobytes())
+    if w is not None:
+        h.update(np.ascontiguousarray(w, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+class PosteriorStore:
+    """Persistent store of posterior-predictive results for one posterior.
+
+    Each entry is a compressed `.npz` file in `directory`, keyed by a hash
+    of the model file, experiments, posterior and options it was simulated
+    with (see `key`), so adding an entry never rewrites others. An entry
+    records the posterior samples drawn, the observations and their
+    simulated summary statistics, or downsampled traces as a
+    `TraceEnsemble`. Plotting functions read an existing entry instead of
+    simulating.
+
+    Args:
+        directory (str): Directory holding store entries, created if
+            necessary.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key+'.npz')
+
+    def _write(self, key: str, arrays: Dict[str, np.ndarray]):
+        # Write to temporary file then move so readers never see partial
+        # entries written by other processes.
+        path = self._path(key)
+        tmp = path+'.{}.tmp.npz'.format(os.getpid())
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, path)
+
+    def _read(self, key: str) -> Dict[str, np.ndarray]:
+        with np.load(self._path(key), allow_pickle=False) as f:
+            return {k: f[k] for k in f.files}
+
+    @staticmethod
+    def key(modelfile: str,
+            experiments: List,
+            df: pd.DataFrame=None,
+            w: np.ndarray=None,
+            **options) -> str:
+        """Key of an entry simulated with the given model and options.
+
+        Args:
+            modelfile (str): Path to Myokit MMT file.
+            experiments (List[Experiment]): Experiments simulated.
+            df (pd.DataFrame): Posterior parameter samples, or None for the
+                default model parameters.
+            w (np.ndarray): Corresponding weights.
+            options: Any other settings which change the results.
+        """
+        return experiment_signature(modelfile, experiments,
+                                    posterior=_posterior_hash(df, w),
+                                    **options)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def save_predictive(self,
+                        key: str,
+                        samples: pd.DataFrame,
+                        observations: pd.DataFrame,
+                        output: pd.DataFrame):
+        """Store posterior samples and their simulated summary statistics.
+
+        Args:
+            key (str): Entry key from `key`.
+            samples (pd.DataFrame): Posterior parameter samples drawn.
+            observations (pd.DataFrame): Observations from `setup`.
+            output (pd.DataFrame): Simulated output with columns `x`, `y`,
+                `exp_id` and `sample` (see `posterior_predictive`).
+        """
+        n_samples = output['sample'].nunique()
+        self._write(key, {
+            'kind': np.array('predictive'),
+            'par_names': np.array(list(samples.columns), dtype=str),
+            'par_values': samples.values.astype(float),
+            'obs_x': observations.x.values.astype(float),
+            'obs_y': observations.y.values.astype(float),
+            'obs_variance': observations.variance.values.astype(float),
+            'obs_exp_id': observations.exp_id.values.astype(str),
+            'obs_normalise_factor':
+                observations.normalise_factor.values.astype(float),
+            'sum_stats': output['y'].values.astype(float)
+                                .reshape(n_samples, -1)})
+
+    def load_predictive(self, key: str
+                        ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """Posterior samples, observations and simulated output of an entry.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]: Posterior
+                samples, observations and output as returned by
+                `posterior_predictive`.
+        """
+        a = self._read(key)
+        samples = pd.DataFrame(a['par_values'],
+                               columns=list(a['par_names']))
+        observations = pd.DataFrame({'x': a['obs_x'],
+                                     'y': a['obs_y'],
+                                     'variance': a['obs_variance'],
+                                     'exp_id': a['obs_exp_id'],
+                                     'normalise_factor':
+                                         a['obs_normalise_factor']})
+        sum_stats = a['sum_stats']
+        n, n_obs = sum_stats.shape
+        output = pd.DataFrame({'x': np.tile(a['obs_x'], n),
+                               'y': sum_stats.reshape(-1),
+                               'exp_id': np.tile(a['obs_exp_id'], n),
+                               'sample': np.repeat(np.arange(n), n_obs)})
+        return samples, observations, output
+
+    def save_traces(self, key: str, ensemble: TraceEnsemble):
+        """Store downsampled traces of posterior samples."""
+        arrays = {'kind': np.array('traces'),
+                  'n_samples': np.array(ensemble.n_samples),
+                  'n_points': np.array(ensemble.n_points)}
+        for i, trace_key in enumerate(ensemble.keys()):
+            exp_id, measure, step = trace_key
+            arrays['trace{}_key'.format(i)] = np.array(
+                [str(exp_id), measure, str(step)])
+            arrays['trace{}_time'.format(i)] = ensemble.time(trace_key)
+            arrays['trace{}_values'.format(i)] = ensemble.values(trace_key)
+        self._write(key, arrays)
+
+    def load_traces(self, key: str) -> TraceEnsemble:
+        """Downsampled traces of posterior samples."""
+        a = self._read(key)
+        n_traces = sum(1 for k in a if k.endswith('_key'))
+        ensemble = TraceEnsemble(int(a['n_samples']),
+                                 n_points=int(a['n_points']))
+        for i in range(n_traces):
+            exp_id, measure, step = a['trace{}_key'.format(i)]
+            time = a['trace{}_time'.format(i)]
+            for sample, values in enumerate(a['trace{}_values'.format(i)]):
+                ensemble.add(sample, int(exp_id), str(measure), int(step),
+                             time, values)
+        return ensemble
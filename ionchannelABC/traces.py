@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+from typing import Callable, List, Tuple, Union
+
+from pyabc import Distribution
+
+from .experiment import Experiment, setup
+from .cache import ResultCache
+from .hpd import hpd
+
+
+class TraceEnsemble:
+    """Compact array-backed store of simulated traces across samples.
+
+    Each trace is identified by (experiment, measure, step). The first
+    sample of a trace fixes its time grid, downsampled to at most
+    `n_points` evenly spaced points, and every sample is interpolated onto
+    that grid into a preallocated (samples x points) float32 array as soon
+    as it is simulated. Memory is therefore bounded by
+    samples x points x traces regardless of the number of solver output
+    points, and no long-format dataframe is built.
+
+    Args:
+        n_samples (int): Maximum number of samples to be added.
+        n_points (int): Maximum number of time points stored per trace.
+    """
+    def __init__(self, n_samples: int, n_points: int=500):
+        self.n_samples = n_samples
+        self.n_points = n_points
+        self._time = {}
+        self._values = {}
+        self._filled = {}
+
+    def add(self,
+            sample: int,
+            exp_id: int,
+            measure: str,
+            step: int,
+            time: np.ndarray,
+            values: np.ndarray):
+        """Add one trace of one sample."""
+        key = (exp_id, measure, step)
+        time = np.asarray(time, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if key not in self._time:
+            if len(time) > self.n_points:
+                grid = np.linspace(time[0], time[-1], self.n_points)
+            else:
+                grid = time.copy()
+            self._time[key] = grid
+            self._values[key] = np.full((self.n_samples, len(grid)), np.nan,
+                                        dtype=np.float32)
+            self._filled[key] = np.zeros(self.n_samples, dtype=bool)
+        grid = self._time[key]
+        if len(time) == len(grid) and np.array_equal(time, grid):
+            self._values[key][sample] = values
+        else:
+            self._values[key][sample] = np.interp(grid, time, values)
+        self._filled[key][sample] = True
+
+    def keys(self) -> List[Tuple[int, str, int]]:
+        """(experiment, measure, step) of each stored trace."""
+        return list(self._time.keys())
+
+    def time(self, key: Tuple[int, str, int]) -> np.ndarray:
+        return self._time[key]
+
+    def values(self, key: Tuple[int, str, int]) -> np.ndarray:
+        """Stored samples of a trace with shape (samples, points)."""
+        return self._values[key][self._filled[key]]
+
+    def median(self, key: Tuple[int, str, int]) -> np.ndarray:
+        return np.median(self.values(key), axis=0)
+
+    def hpd(self,
+            key: Tuple[int, str, int],
+            credible_interval: Union[float, List[float]]=0.89) -> np.ndarray:
+        """HPD interval of a trace at each time point (see `hpd`)."""
+        return hpd(self.values(key), credible_interval=credible_interval)
+
+    def nbytes(self) -> int:
+        """Memory used by stored traces."""
+        return sum(v.nbytes for v in self._values.values())
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Median of every trace in long format for plotting."""
+        frames = []
+        for key in self.keys():
+            exp_id, measure, step = key
+            frames.append(pd.DataFrame({'time': self._time[key],
+                                        'y': self.median(key),
+                                        'measure': measure,
+                                        'step': step,
+                                        'exp_id': exp_id}))
+        return pd.concat(frames, ignore_index=True)
+
+
+def sample_experiment_traces(modelfile: str,
+                             recordvars: List[str],
+                             split_data_fns: List[Callable],
+                             *experiments: Experiment,
+                             df: pd.DataFrame=None,
+                             w: np.ndarray=None,
+                             prev_runs: List[str]=[],
+                             additional_pars: Distribution=None,
+                             pacevar: str='membrane.V',
+                             timevar: str='engine.time',
+                             log_interval: float=None,
+                             n_samples: int=100,
+                             n_points: int=500,
+                             timeout: int=None,
+                             exclude_fails: bool=False,
+                             try_limit: int=100,
+                             seed: int=None,
+                             cache: ResultCache=None,
+                             store: 'PosteriorStore'=None) -> TraceEnsemble:
+    """Simulate traces for posterior samples into a `TraceEnsemble`.
+
+    Each sample is added to the ensemble as soon as it is simulated so
+    only one sample's full-resolution output is held in memory at a time.
+    Arguments are as for `plot_experiment_traces`.
+
+    Args:
+        n_points (int): Maximum number of time points stored per trace.
+        store (PosteriorStore): Optional store for this posterior. Traces
+            already stored for the same model, experiments and options are
+            read instead of simulated, otherwise they are added.
+
+    Returns:
+        TraceEnsemble: Downsampled traces with measure `pace` for the
+            pacing variable and the name of each recorded variable.
+    """
+    recordvars = [v for v in recordvars if v != timevar]
+    if store is not None:
+        key = store.key(modelfile,
+                        list(experiments),
+                        df=df,
+                        w=w,
+                        kind='traces',
+                        recordvars=recordvars,
+                        split_data_fns=[getattr(f, '__qualname__', repr(f))
+                                        for f in split_data_fns],
+                        prev_runs=prev_runs,
+                        additional_pars=additional_pars,
+                        pacevar=pacevar,
+                        timevar=timevar,
+                        log_interval=log_interval,
+                        n_samples=n_samples,
+                        n_points=n_points,
+                        timeout=timeout,
+                        exclude_fails=exclude_fails,
+                        try_limit=try_limit if exclude_fails else 1,
+                        seed=seed)
+        if key in store:
+            return store.load_traces(key)
+
+    _, model, _ = setup(modelfile,
+                        *experiments,
+                        log_interval=log_interval,
+                        logvars=[timevar, pacevar]+recordvars,
+                        pacevar=pacevar,
+                        prev_runs=prev_runs,
+                        timeout=timeout,
+                        additional_pars=additional_pars,
+                        normalise=False,
+                        seed=seed,
+                        cache=cache)
+
+    if df is not None:
+        posterior_samples = (df.sample(n=n_samples, weights=w, replace=True,
+                                       random_state=seed)
+                               .to_dict(orient='records'))
+    else:
+        posterior_samples = [{}]
+
+    ensemble = TraceEnsemble(len(posterior_samples), n_points=n_points)
+    for i, th in enumerate(posterior_samples):
+        data = model(th)
+        try_cnt = 1
+        while exclude_fails and data is None and try_cnt < try_limit:
+            data = model(th, draw=try_cnt)
+            try_cnt += 1
+        if data is None:
+            if exclude_fails:
+                raise Exception('failed to simulate after {} attempts'
+                                .format(try_limit))
+            continue
+
+        for j, d in enumerate(data):
+            for k, step in enumerate(split_data_fns[j](d)):
+                ensemble.add(i, j, 'pace', k, step[timevar], step[pacevar])
+                for rvar in recordvars:
+                    ensemble.add(i, j, rvar, k, step[timevar], step[rvar])
+        del data
+
+    if store is not None:
+        store.save_traces(key, ensemble)
+    return ensemble
@@ -0,0 +1,95 @@
+import numpy as np
+from typing import Callable, Dict, List
+
+import myokit
+
+
+def compile_variable(m: myokit.Model,
+                     var: str,
+                     parameters: List[str],
+                     pacevar: str='membrane.V') -> Callable:
+    """Compile a model variable to a NumPy function of voltage and parameters.
+
+    The variable's expression is expanded in terms of the pacing variable
+    and the named parameters, which are kept as arguments. All other
+    (constant) variables are inlined. The expression tree is converted to
+    Python once, and the returned function broadcasts over its arguments.
+
+    Args:
+        m (myokit.Model): Model containing the variable.
+        var (str): Name of the variable to compile.
+        parameters (List[str]): Names of parameters kept as arguments.
+        pacevar (str): Name of pacing variable in the model.
+
+    Returns:
+        Callable: Function `f(v, *parameter_values)`.
+
+    Raises:
+        ValueError: Expression depends on variables other than the pacing
+            variable and parameters, e.g. other state variables.
+    """
+    arg_vars = [m.get(pacevar)]+[m.get(p) for p in parameters]
+    arg_names = {v.qname(): '_a{}'.format(i) for i, v in enumerate(arg_vars)}
+
+    # Substituting arguments by themselves prevents them being expanded
+    keep = {myokit.Name(v): myokit.Name(v) for v in arg_vars}
+    expr = m.get(var).rhs().clone(subst=keep, expand=True)
+
+    def lhs_name(lhs):
+        try:
+            return arg_names[lhs.var().qname()]
+        except KeyError:
+            raise ValueError('Variable {} depends on {} which is not the '
+                             'pacing variable or a parameter.'
+                             .format(var, lhs.var().qname()))
+
+    w = myokit.numpy_writer()
+    w.set_lhs_function(lhs_name)
+    code = 'lambda {}: {}'.format(
+        ', '.join(arg_names[v.qname()] for v in arg_vars), w.ex(expr))
+    return eval(code, {'numpy': np})
+
+
+def evaluate_variables(m: myokit.Model,
+                       variables: Dict[str, str],
+                       v: np.ndarray,
+                       par_samples: List[Dict[str, float]],
+                       pacevar: str='membrane.V') -> Dict[str, np.ndarray]:
+    """Evaluate model variables for all parameter samples and voltages.
+
+    Args:
+        m (myokit.Model): Model containing the variables.
+        variables (Dict[str, str]): Mapping from common names to variables
+            in the model.
+        v (np.ndarray): Voltage range.
+        par_samples (List[Dict[str, float]]): Parameter samples with
+            `log_` prefix for log-transformed parameters. Parameters not
+            in a sample take their value in the model.
+        pacevar (str): Name of pacing variable in the model.
+
+    Returns:
+        Dict[str, np.ndarray]: Values of each variable with shape
+            (samples, voltages).
+    """
+    v = np.asarray(v, dtype=float)
+    keys = list(par_samples[0].keys()) if len(par_samples) > 0 else []
+    names = [key[4:] if key.startswith("log") else key for key in keys]
+
+    # One column of parameter values per sample for broadcasting
+    values = []
+    for key in keys:
+        col = np.array([s[key] for s in par_samples], dtype=float)
+        if key.startswith("log"):
+            col = 10**col
+        values.append(col[:, np.newaxis])
+
+    shape = (max(1, len(par_samples)), len(v))
+    output = {}
+    for key, var in variables.items():
+        try:
+            f = compile_variable(m, var, names, pacevar=pacevar)
+        except KeyError:
+            raise Exception('Could not find variable '+var+' in model '+m.name())
+        output[key] = np.broadcast_to(
+            f(v[np.newaxis, :], *values), shape).astype(float)
+    return output
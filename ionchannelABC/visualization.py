@@ -2,6 +2,14 @@ from .distance import IonChannelDistance
 from .experiment import (Experiment,
                          setup,
                          get_observations_df)
+from .cache import ResultCache
+from .predictive import posterior_predictive
+from .hpd import hpd
+from .traces import sample_experiment_traces
+from .variables import evaluate_variables
+from .kde import KDECache
+from .store import PosteriorStore
+from .profiling import Profiler
 import numpy as np
 import myokit
 import pandas as pd
@@ -9,10 +17,8 @@ import warnings
 import matplotlib.pyplot as plt
 import seaborn as sns
 from typing import Callable, List, Union, Tuple
-import pymc3.stats
 
 from pyabc import Distribution
-from pyabc.visualization.kde import kde_1d, plot_kde_matrix
 
 def normalise(df, limits=None):
     result = df.copy()
@@ -41,7 +47,11 @@ def plot_sim_results(modelfiles: Union[str,List[str]],
                      n_samples: int=100,
                      credible_interval: Union[float, List[float]]=0.89,
                      alpha: float=0.2,
-                     exclude_infs: bool=False) -> sns.FacetGrid:
+                     exclude_infs: bool=False,
+                     seed: int=None,
+                     cache: ResultCache=None,
+                     n_workers: int=1,
+                     store: PosteriorStore=None) -> sns.FacetGrid:
     """Plot output of ABC against experimental and/or original output.
 
     Note that excluding infinite values assumes that previous runs or
@@ -72,11 +82,20 @@ def plot_sim_results(modelfiles: Union[str,List[str]],
         credible_interval (float, List[float]): % interval to plot for high density
             posterior interval.
         alpha (float): Transparency value for shaded region.
+        exclude_infs (bool): Whether to retry failed simulations with a
+            different background sample.
+        seed (int): Optional seed for posterior and background sampling
+            to make plots reproducible.
+        cache (ResultCache): Optional cache of model evaluations shared
+            between plots of the same posterior.
+        n_workers (int): Number of processes to simulate posterior samples.
+        store (PosteriorStore): Optional persistent store of results for
+            this posterior. Stored results are plotted without simulating.
 
     Returns
         sns.FacetGrid: Plots of measured output.
     """
-    model_samples = pd.DataFrame({})
+    model_samples = []
 
     # wrap inputs if necessary and only one
     if not isinstance(modelfiles, list):
@@ -97,13 +116,25 @@ def plot_sim_results(modelfiles: Union[str,List[str]],
                                               if val is not None]
         else:
             experiment_list = experiments
-        observations, model, summary_statistics = setup(modelfile,
-                                                        *experiment_list,
-                                                        pacevar=pacevar,
-                                                        tvar=tvar,
-                                                        prev_runs=prev_runs,
-                                                        additional_pars=additional_pars,
-                                                        normalise=False)
+        if df is not None and df[i] is not None:
+            df_i, w_i = df[i], w[i]
+        else:
+            df_i, w_i = None, None
+        observations, output = posterior_predictive(modelfile,
+                                                    *experiment_list,
+                                                    df=df_i,
+                                                    w=w_i,
+                                                    n_samples=n_samples,
+                                                    n_workers=n_workers,
+                                                    exclude_infs=exclude_infs,
+                                                    seed=seed,
+                                                    pacevar=pacevar,
+                                                    tvar=tvar,
+                                                    prev_runs=prev_runs,
+                                                    additional_pars=additional_pars,
+                                                    normalise=False,
+                                                    cache=cache,
+                                                    store=store)
 
         # save the correct observations for plotting later
         if temp_match_model==i:
@@ -124,38 +155,15 @@ def plot_sim_results(modelfiles: Union[str,List[str]],
                     else:
                         exp_map.append(str(masks[i][j]))
 
-        # Generate model samples from ABC approximate posterior or create default
-        # samples if posterior was not provided as input.
-        if df is not None and df[i] is not None:
-            posterior_samples = (df[i].sample(n=n_samples, weights=w[i], replace=True)
-                                      .to_dict(orient='records'))
-        else:
-            posterior_samples = [{}]
-
-        for j, th in enumerate(posterior_samples):
-            results = {'0': float('inf')}
-            if exclude_infs:
-                try_limit = 100
-                try_cnt = 0
-                while not np.all(np.isfinite(list(results.values()))) and try_cnt < try_limit:
-                    results = summary_statistics(model(th))
-                    try_cnt += 1
-                if try_cnt == try_limit:
-                    raise Exception('exclude_infs failed in 100 iterations')
-            else:
-                results = summary_statistics(model(th))
-            output = pd.DataFrame({'x': observations.x,
-                                   'y': list(results.values()),
-                                   'exp_id': observations.exp_id})
-            output['sample'] = j
-            output['model'] = name
-            if masks is not None and masks[i] is not None:
-                output.exp_id = [exp_map[int(exp_id)] for exp_id in output.exp_id]
-            model_samples = model_samples.append(output, ignore_index=True)
+        output['model'] = name
+        if masks is not None and masks[i] is not None:
+            output.exp_id = [exp_map[int(exp_id)] for exp_id in output.exp_id]
+        model_samples.append(output)
 
         if masks is not None and masks[i] is not None:
             observations.exp_id = [exp_map[int(exp_id)] for exp_id in observations.exp_id]
         all_observations.append(observations)
+    model_samples = pd.concat(model_samples, ignore_index=True)
 
     # Temperature adjust to model temperature specified in index
     # i.e. scale those model variables not at the same temperature
@@ -201,20 +209,15 @@ def plot_sim_results(modelfiles: Union[str,List[str]],
         for mi, model in enumerate(model_samples['model'].unique()):
             data = model_samples[(model_samples['exp_id']==exp_id) & \
                                  (model_samples['model']==model)]
-            hpd = []
-            for ci in credible_interval:
-                hpd.append(np.zeros((len(data['x'].unique()), 2)))
-
-            for i, xi in enumerate(data['x'].unique()):
-                data_xi = data[data['x']==xi]
-                for cnt, hpdi in enumerate(hpd):
-                    hpdi[i,:] = pymc3.stats.hpd(data_xi['y'],
-                                                credible_interval=credible_interval[cnt])
-
+            # rows are ordered by sample then data point
+            n_samples_model = data['sample'].nunique()
+            y = data['y'].values.reshape(n_samples_model, -1)
+            x = data['x'].values[:y.shape[1]]
+            intervals = hpd(y, credible_interval=credible_interval)
 
             # plot on graph
-            for hpdi in hpd:
-                ax.fill_between(data['x'].unique(), hpdi[:,0], hpdi[:,1],
+            for hpdi in intervals:
+                ax.fill_between(x, hpdi[:,0], hpdi[:,1],
                                 alpha=alpha, color=current_palette[mi])
 
     # Format lines in all plots
@@ -244,8 +247,62 @@ def plot_experiment_traces(modelfile: str,
                            n_samples: int=100,
                            timeout: int=None,
                            exclude_fails: bool=False,
-                           try_limit: int=100
+                           try_limit: int=100,
+                           seed: int=None,
+                           cache: ResultCache=None,
+                           streaming: bool=False,
+                           n_points: int=500,
+                           store: PosteriorStore=None
                            ) -> sns.FacetGrid:
+    """Plot simulated traces of experiments for posterior samples.
+
+    With `streaming` set, each sample is downsampled to at most `n_points`
+    time points per trace and accumulated in a `TraceEnsemble` as soon as
+    it is simulated, instead of collecting all full-resolution traces in a
+    long-format dataframe. This bounds memory use for many samples.
+
+    Passing a `store` implies `streaming`, and the downsampled traces are
+    read from or added to the store.
+    """
+    if cache is not None and not cache.store_traces:
+        raise ValueError('Plotting traces requires a cache which stores traces.')
+    if streaming or store is not None:
+        ensemble = sample_experiment_traces(modelfile,
+                                            recordvars,
+                                            split_data_fns,
+                                            *experiments,
+                                            df=df,
+                                            w=w,
+                                            prev_runs=prev_runs,
+                                            additional_pars=additional_pars,
+                                            pacevar=pacevar,
+                                            timevar=timevar,
+                                            log_interval=log_interval,
+                                            n_samples=n_samples,
+                                            n_points=n_points,
+                                            timeout=timeout,
+                                            exclude_fails=exclude_fails,
+                                            try_limit=try_limit,
+                                            seed=seed,
+                                            cache=cache,
+                                            store=store)
+        model_samples = ensemble.to_dataframe()
+        grid = _plot_trace_grid(model_samples)
+        if ensemble.n_samples > 1:
+            exp_ids = list(model_samples['exp_id'].unique())
+            measures = list(model_samples['measure'].unique())
+            for key in ensemble.keys():
+                exp_id, measure, step_id = key
+                if measure == 'pace':
+                    continue
+                n_steps = sum(1 for e, m, _ in ensemble.keys()
+                              if e == exp_id and m == measure)
+                palette = sns.color_palette("viridis", n_steps)
+                hpdi = ensemble.hpd(key, credible_interval=credible_interval)
+                (grid.axes[measures.index(measure), exp_ids.index(exp_id)]
+                     .fill_between(ensemble.time(key), hpdi[:,0], hpdi[:,1],
+                                   alpha=alpha, color=palette[step_id]))
+        return grid
 
     if timevar not in recordvars:
         recordvars = [timevar,]+recordvars
@@ -257,11 +314,14 @@ def plot_experiment_traces(modelfile: str,
                         prev_runs=prev_runs,
                         timeout=timeout,
                         additional_pars=additional_pars,
-                        normalise=False)
+                        normalise=False,
+                        seed=seed,
+                        cache=cache)
 
     model_samples = pd.DataFrame({})
     if df is not None:
-        posterior_samples = (df.sample(n=n_samples, weights=w, replace=True)
+        posterior_samples = (df.sample(n=n_samples, weights=w, replace=True,
+                                       random_state=seed)
                                .to_dict(orient='records'))
     else:
         posterior_samples = [{}]
@@ -272,7 +332,7 @@ def plot_experiment_traces(modelfile: str,
             try_limit = try_limit
             try_cnt = 0
             while data is None and try_cnt<try_limit:
-                data = model(th)
+                data = model(th, draw=try_cnt)
                 try_cnt += 1
             if try_cnt == try_limit:
                 raise Exception('failed to simulate after 100 attempts')
@@ -304,18 +364,7 @@ def plot_experiment_traces(modelfile: str,
         model_samples = model_samples.append(output, ignore_index=True)
 
     # plotting code
-    grid = sns.relplot(x='time', y='y',
-                       hue='step',
-                       col='exp_id', row='measure',
-                       palette='viridis',
-                       legend=False,
-                       data=model_samples,
-                       kind='line',
-                       estimator=np.median,
-                       ci=None,
-                       facet_kws={'sharex': 'col',
-                                  'sharey': 'row'})
-
+    grid = _plot_trace_grid(model_samples)
 
     if len(model_samples['sample'].unique()) > 1:
         # calculate HPDI for each sample
@@ -328,18 +377,31 @@ def plot_experiment_traces(modelfile: str,
                 palette = sns.color_palette("viridis", len(measure_samples['step'].unique()))
                 for si, step_id in enumerate(measure_samples['step'].unique()):
                     data = measure_samples[(measure_samples['step']==step_id)]
-                    hpd = np.zeros((len(data['time'].unique()), 2))
-                    for i, ti in enumerate(data['time'].unique()):
-                        data_ti = data[data['time']==ti]
-                        hpd[i,:] = pymc3.stats.hpd(data_ti['y'],
-                                                   credible_interval=credible_interval)
+                    y = data.pivot_table(index='sample', columns='time',
+                                         values='y')
+                    hpdi = hpd(y.values, credible_interval=credible_interval)
 
                     # plot on graph
-                    grid.axes[k,j].fill_between(data['time'].unique(), hpd[:,0], hpd[:,1],
+                    grid.axes[k,j].fill_between(y.columns, hpdi[:,0], hpdi[:,1],
                                                 alpha=alpha, color=palette[si])
 
     return grid
 
+def _plot_trace_grid(model_samples: pd.DataFrame) -> sns.FacetGrid:
+    """Median traces by experiment (columns) and measure (rows)."""
+    return sns.relplot(x='time', y='y',
+                       hue='step',
+                       col='exp_id', row='measure',
+                       palette='viridis',
+                       legend=False,
+                       data=model_samples,
+                       kind='line',
+                       estimator=np.median,
+                       ci=None,
+                       facet_kws={'sharex': 'col',
+                                  'sharey': 'row'})
+
+
 def plot_distance_weights(
         observations: pd.DataFrame,
         distance_fn: IonChannelDistance,
@@ -377,6 +439,41 @@ def plot_distance_weights(
     return grid
 
 
+def plot_solver_statistics(profiler: Profiler,
+                           stat: str='steps',
+                           bins: int=20,
+                           log: bool=True,
+                           history=None) -> sns.FacetGrid:
+    """Plot histograms of a solver statistic by generation and experiment.
+
+    Args:
+        profiler (Profiler): Profiler passed to `setup` for the run.
+        stat (str): Solver statistic (see `Profiler.solver_stats`).
+        bins (int): Number of bins.
+        log (bool): Whether to use a log scale for `stat`.
+        history (pyabc.History): Optional history of the profiled run
+            used to assign records to generations.
+
+    Returns:
+        sns.FacetGrid: Histograms with a row per generation and a column
+            per experiment.
+    """
+    hist = profiler.solver_histogram(stat=stat, bins=bins, log=log,
+                                     history=history)
+    hist['generation'] = hist['generation'].fillna(-1).astype(int)
+    row = 'generation' if hist['generation'].nunique() > 1 else None
+    grid = sns.FacetGrid(hist, row=row, col='experiment',
+                         sharey=False, height=1.5, aspect=2)
+
+    def bar(left, right, count, **kwargs):
+        plt.bar(left, count, width=right-left, align='edge', **kwargs)
+    grid = grid.map(bar, 'left', 'right', 'count')
+    if log:
+        grid.set(xscale='log')
+    grid.set_xlabels(stat)
+    return grid
+
+
 def plot_variables(v: np.ndarray,
                    variables: Union[dict,List[dict]],
                    modelfiles: Union[str,List[str]],
@@ -384,7 +481,8 @@ def plot_variables(v: np.ndarray,
                    original: Union[bool,List[bool]]=False,
                    credible_interval: Union[float,List[float]]=0.89,
                    alpha: float=0.2,
-                   figshape: Tuple[int]=None):
+                   figshape: Tuple[int]=None,
+                   pacevar: str='membrane.V'):
     """Plot model variables over voltage range.
 
     v (np.ndarray): Voltage range to plot over.
@@ -399,6 +497,7 @@ def plot_variables(v: np.ndarray,
         posterior interval.
     alpha (float): Transparency value for shaded region.
     figshape (Tuple[int]): Shape of figure. Defaults to single row
+    pacevar (str): Name of voltage variable in the models.
     """
     if original:
         assert par_samples is not None, 'Require parameter value samples to plot original values.'
@@ -425,50 +524,35 @@ def plot_variables(v: np.ndarray,
                            figsize=(ncols*5, nrows*5),
                            sharex=True)
 
-    samples = pd.DataFrame({})
+    samples = []
     for i, modelfile in enumerate(modelfiles):
         m = myokit.load_model(modelfile)
 
-        original_vals = {}
-        if original[i]:
-            for p in par_samples[i][0].keys():
-                name = p
-                if p.startswith("log"):
-                    name = p[4:]
-                original_vals[name] = m.value(name)
-
+        # Each variable is compiled once and evaluated for all samples
+        # and voltages in a single broadcast.
         if par_samples[i] is not None:
-            for j, pars in enumerate(par_samples[i]):
-                for p, val in pars.items():
-                    if p.startswith("log"):
-                        val = 10**val
-                        p = p[4:]
-                    m.set_value(p, val)
-
-                output = pd.DataFrame({})
-                for key, var in variables[i].items():
-                    output[key] = m.get(var).pyfunc()(v)
-                output['V'] = v
-                output['samples'] = j
-                output['model'] = m.name()
-                output['data'] = 'recalibrated'
-                samples = samples.append(output, ignore_index=True)
+            n = len(par_samples[i])
+            values = evaluate_variables(m, variables[i], v, par_samples[i],
+                                        pacevar=pacevar)
+            output = pd.DataFrame({key: val.reshape(-1)
+                                   for key, val in values.items()})
+            output['V'] = np.tile(v, n)
+            output['samples'] = np.repeat(np.arange(n), len(v))
+            output['model'] = m.name()
+            output['data'] = 'recalibrated'
+            samples.append(output)
 
         # Plot original values
         if par_samples[i] is None or original[i]:
-            output = pd.DataFrame({})
-            if original:
-                for p, val in original_vals.items():
-                    m.set_value(p, val)
-            for key, var in variables[i].items():
-                try:
-                    output[key] = m.get(var).pyfunc()(v)
-                except:
-                    raise Exception('Could not find variable '+key+' in modelfile '+modelfile)
-                output['V'] = v
+            values = evaluate_variables(m, variables[i], v, [{}],
+                                        pacevar=pacevar)
+            output = pd.DataFrame({key: val.reshape(-1)
+                                   for key, val in values.items()})
+            output['V'] = v
             output['model'] = m.name()
             output['data'] = 'original'
-            samples = samples.append(output)
+            samples.append(output)
+    samples = pd.concat(samples, ignore_index=True, sort=False)
 
     current_palette = sns.color_palette()
 
@@ -482,21 +566,17 @@ def plot_variables(v: np.ndarray,
                      legend=False)
         sns.despine(ax=ax.flatten()[i])
         for mi, model in enumerate(samples['model'].unique()):
-            data = samples[(samples['model']==model)]
-            hpd = []
-            for ci in credible_interval:
-                hpd.append(np.zeros((len(data['V'].unique()), 2)))
-
-            for k, vk in enumerate(data['V'].unique()):
-                data_vk = data[data['V']==vk]
-                for cnt, hpdi in enumerate(hpd):
-                    hpdi[k,:] = pymc3.stats.hpd(data_vk[key],
-                                                credible_interval=credible_interval[cnt])
+            data = samples[(samples['model']==model) &
+                           (samples['data']=='recalibrated')]
+            if data.empty:
+                continue
+            y = data.pivot_table(index='samples', columns='V', values=key)
+            intervals = hpd(y.values, credible_interval=credible_interval)
 
             # plot on graph
-            for hpdi in hpd:
+            for hpdi in intervals:
                 ax.flatten()[i].fill_between(
-                        data['V'].unique(), hpdi[:,0], hpdi[:,1],
+                        y.columns, hpdi[:,0], hpdi[:,1],
                         alpha=alpha, color=current_palette[mi])
 
     plt.tight_layout()
@@ -518,13 +598,17 @@ def plot_parameters_kde(df, w, limits, aspect=None, height=None):
     sns.set(style="white", rc={"axes.facecolor": (0, 0, 0, 0)})
     pal = sns.cubehelix_palette(len(limits), rot=-.25, light=.7)
 
-    df_melt = pd.melt(normalise(df, limits))
+    df_norm = normalise(df, limits)
+    df_melt = pd.melt(df_norm)
     g = sns.FacetGrid(df_melt, row="name", hue="name", aspect=aspect,
                       height=height, palette=pal, sharex=False)
 
+    # Each density is computed once and shared by both drawing passes
+    kde_cache = KDECache(df_norm, w, numx=1000)
+
     def custom_kde(x, shade=False, **kwargs):
-        df = pd.concat((x,), axis=1)
-        x_vals, pdf = kde_1d(df, w, x.name, xmin=0.0, xmax=1.0, numx=1000)
+        x_vals, pdf = kde_cache.marginal(kwargs.get("label"),
+                                         xmin=0.0, xmax=1.0)
         pdf = (pdf-pdf.min())/(pdf.max()-pdf.min())
         facecolor = kwargs.pop("facecolor", None)
         ax = plt.gca()
@@ -572,18 +656,54 @@ def plot_parameters_kde(df, w, limits, aspect=None, height=None):
 
     return g
 
-def plot_kde_matrix_custom(df, w, limits=None, refval=None):
-    """Wrapper around pyabc.visualization.plot_kde_matrix."""
-
-    arr_ax = plot_kde_matrix(df, w, limits=limits, refval=refval)
+def plot_kde_matrix_custom(df, w, limits=None, refval=None, numx=100,
+                           height=2.5):
+    """Plot matrix of marginal and pairwise posterior KDEs.
 
-    # Remove titles
-    n_par = df.shape[1]
-    for i in range(0, n_par):
-        for j in range(0, i):
-            # lower axis is 2D density
+    Replacement for pyabc.visualization.plot_kde_matrix using binned KDEs
+    which are each computed once. Diagonal shows marginal densities,
+    lower triangle pairwise densities and upper triangle weighted samples.
+    """
+    names = list(df.columns)
+    n_par = len(names)
+    if limits is None:
+        limits = {}
+    lims = {n: limits.get(n, (df[n].min(), df[n].max())) for n in names}
+    kde_cache = KDECache(df, w, numx=numx)
+    w_scaled = np.asarray(w)/np.max(w)
+
+    fig, arr_ax = plt.subplots(nrows=n_par, ncols=n_par,
+                               figsize=(height*n_par, height*n_par),
+                               squeeze=False)
+    for i, y in enumerate(names):
+        for j, x in enumerate(names):
             ax = arr_ax[i, j]
-            ax.set_title(None)
+            if i == j:
+                x_vals, pdf = kde_cache.marginal(x, *lims[x])
+                ax.plot(x_vals, pdf)
+                ax.set_ylim(0, None)
+                if refval is not None:
+                    ax.axvline(refval[x], color='C1')
+            elif i > j:
+                X, Y, PDF = kde_cache.pairwise(x, y, *lims[x], *lims[y])
+                ax.pcolormesh(X, Y, PDF, cmap='viridis')
+                if refval is not None:
+                    ax.scatter([refval[x]], [refval[y]], color='C1')
+            else:
+                ax.scatter(df[x], df[y], s=4, alpha=0.5,
+                           c=w_scaled, cmap='viridis')
+                ax.set_ylim(*lims[y])
+            ax.set_xlim(*lims[x])
+
+            # Label only outer axes
+            if i == n_par-1:
+                ax.set_xlabel(x)
+            else:
+                ax.set_xticklabels([])
+            if j == 0 and i != 0:
+                ax.set_ylabel(y)
+            elif i != j:
+                ax.set_yticklabels([])
 
     plt.set_cmap('viridis')
 
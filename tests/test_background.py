@@ -0,0 +1,42 @@
+import multiprocessing
+
+import numpy as np
+
+from pyabc import Distribution, RV
+
+from ionchannelABC.background import AliasTable, BackgroundSampler
+
+
+def test_alias_table_frequencies_match_weights():
+    w = np.array([0., 1., 2., 5., 0.5, 1.5])
+    table = AliasTable(w)
+    draws = table.draw(np.random.RandomState(0), size=200000)
+    freq = np.bincount(draws, minlength=len(w))/len(draws)
+    np.testing.assert_allclose(freq, w/np.sum(w), atol=0.005)
+    assert freq[0] == 0.
+
+
+def _sampler():
+    return BackgroundSampler(additional_pars=Distribution(b=RV('norm', 0, 1)),
+                             seed=3)
+
+
+_forked = _sampler()
+
+
+def _sample_forked(a):
+    return _forked.sample({'a': a})
+
+
+def test_seeded_draws_follow_particle():
+    keys = [{'a': 0.1*i} for i in range(8)]
+    expected = [_sampler().sample(key) for key in keys]
+
+    # Independent of earlier draws and of the process
+    sampler = _sampler()
+    assert [sampler.sample(key) for key in reversed(keys)] == expected[::-1]
+    with multiprocessing.get_context('fork').Pool(2) as pool:
+        assert pool.map(_sample_forked, [k['a'] for k in keys]) == expected
+
+    # Offsets retry with a different background
+    assert sampler.sample(keys[0], offset=1) != expected[0]
@@ -0,0 +1,23 @@
+import numpy as np
+
+from ionchannelABC.cache import function_signature
+
+
+def _peak_factory(index, scale=1.):
+    def peak(data, offset=np.zeros(2)):
+        return scale*data[index]+offset[0]
+    return peak
+
+
+def test_signature_includes_closure_and_defaults():
+    assert (function_signature(_peak_factory(0)) ==
+            function_signature(_peak_factory(0)))
+    assert (function_signature(_peak_factory(0)) !=
+            function_signature(_peak_factory(1)))
+    assert (function_signature(_peak_factory(0, scale=2.)) !=
+            function_signature(_peak_factory(0)))
+
+    peak = _peak_factory(0)
+    shifted = _peak_factory(0)
+    shifted.__defaults__ = (np.ones(2),)
+    assert function_signature(peak) != function_signature(shifted)
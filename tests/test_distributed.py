@@ -0,0 +1,148 @@
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ionchannelABC.distributed import (DistributedEvaluator,
+                                       DistributedSampler,
+                                       LocalQueueServer,
+                                       connect_local_queue,
+                                       run_worker)
+
+
+def _model_factory():
+    def model(pars):
+        time.sleep(pars.get('delay', 0.))
+        if pars['a'] < 0:
+            raise ValueError('Negative parameter.')
+        return {'0': 2.*pars['a']}
+    def summary_statistics(data):
+        if data is None:
+            return {'0': np.inf}
+        return data
+    return model, summary_statistics
+
+
+def _worker(address, authkey):
+    queue = connect_local_queue(address, authkey=authkey)
+    run_worker(queue, _model_factory, heartbeat_interval=0.1,
+               poll_interval=0.05, idle_timeout=2.)
+
+
+@pytest.fixture
+def server():
+    with LocalQueueServer() as server:
+        yield server
+
+
+def _start_workers(server, n):
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=_worker,
+                           args=(server.address, server.authkey))
+               for _ in range(n)]
+    for w in workers:
+        w.start()
+    return workers
+
+
+def _join(workers):
+    for w in workers:
+        w.join(timeout=30)
+        assert w.exitcode == 0
+
+
+def test_worker_round_trip(server):
+    workers = _start_workers(server, 1)
+    evaluator = DistributedEvaluator(server.queue(), lease=5.)
+    samples = [{'a': float(i)} for i in range(7)]
+    output = evaluator.map(samples, n_stats=1, batch_size=3)
+    np.testing.assert_array_equal(output[:, 0], 2.*np.arange(7))
+    assert evaluator.n_requeued == 0
+    _join(workers)
+
+
+def test_requeue_after_lease_expiry(server):
+    queue = server.queue()
+    evaluator = DistributedEvaluator(queue, lease=0.5, poll_interval=0.05)
+    task_id = evaluator.submit([{'a': 1.}])
+
+    # Claimed by a worker which dies without heartbeats or a result
+    assert queue.claim('dead')[0] == task_id
+    assert queue.size() == 0
+
+    workers = _start_workers(server, 1)
+    result = evaluator.wait([task_id])
+    assert result[task_id] == [{'0': 2.}]
+    assert evaluator.n_requeued == 1
+    _join(workers)
+
+
+def test_results_in_proposal_order(server):
+    workers = _start_workers(server, 3)
+    evaluator = DistributedEvaluator(server.queue(), lease=5.)
+    # Earlier samples take longer, so finish last
+    samples = [{'a': float(i), 'delay': 0.1*(5-i)} for i in range(6)]
+    output = evaluator.map(samples, n_stats=1, batch_size=1)
+    np.testing.assert_array_equal(output[:, 0], 2.*np.arange(6))
+    _join(workers)
+
+
+def test_failed_sample_keeps_batch(server):
+    workers = _start_workers(server, 1)
+    evaluator = DistributedEvaluator(server.queue(), lease=5.)
+    samples = [{'a': 1.}, {'a': -1.}, {'a': 2.}]
+    output = evaluator.map(samples, n_stats=1, batch_size=3)
+    np.testing.assert_array_equal(output[:, 0], [2., np.inf, 4.])
+    _join(workers)
+
+
+def test_task_cancelled_after_max_redeliveries(server):
+    queue = server.queue()
+    evaluator = DistributedEvaluator(queue, lease=0.2, poll_interval=0.05,
+                                     max_redeliveries=1)
+    task_id = evaluator.submit([{'a': 1.}])
+
+    # A worker which claims tasks and never completes them
+    stop = threading.Event()
+    def hang():
+        dead = server.queue()
+        while not stop.is_set():
+            dead.claim('dead')
+            time.sleep(0.01)
+    thread = threading.Thread(target=hang)
+    thread.start()
+    try:
+        with pytest.raises(RuntimeError):
+            evaluator.wait([task_id])
+    finally:
+        stop.set()
+        thread.join()
+    assert evaluator.n_requeued == 2
+    assert queue.claim('worker') is None
+
+
+class _Particle:
+    def __init__(self, index, accepted):
+        self.index = index
+        self.accepted = accepted
+
+
+class _ListSampler(DistributedSampler):
+    def _create_empty_sample(self):
+        return []
+
+
+def test_sampler_keeps_proposal_order():
+    count = iter(range(100))
+    def simulate_one():
+        i = next(count)
+        # Later proposals finish first
+        time.sleep(0.05*(10-i) if i < 10 else 0.)
+        return _Particle(i, accepted=True)
+
+    sampler = _ListSampler(n_threads=4)
+    sample = sampler.sample_until_n_accepted(4, simulate_one)
+    assert [p.index for p in sample] == [0, 1, 2, 3]
+    assert sampler.nr_evaluations_ >= 4
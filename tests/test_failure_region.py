@@ -0,0 +1,50 @@
+import multiprocessing
+import pickle
+
+import pytest
+
+from ionchannelABC.failure_region import FailureRegionCache
+
+
+def _generation(cache, failed):
+    for i in range(10):
+        cache.record({'a': 0.001*i, 'b': 0.}, failed)
+    cache.should_skip({'a': 0., 'b': 0.})
+
+
+def _run_forked(cache, failed):
+    ctx = multiprocessing.get_context('fork')
+    p = ctx.Process(target=_generation, args=(cache, failed))
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+
+
+def test_counts_persist_across_forked_generations():
+    cache = FailureRegionCache(parameters=['a', 'b'], k=3)
+    _run_forked(cache, failed=True)
+    assert cache.counters() == {'evaluated': 10, 'failed': 10, 'skipped': 1}
+
+    # Successes recorded by a second generation end the skipping
+    _run_forked(cache, failed=False)
+    assert cache.counters() == {'evaluated': 20, 'failed': 10, 'skipped': 1}
+    assert cache.should_skip({'a': 0.0045, 'b': 0.}) is False
+
+
+def test_skips_deep_inside_failure_region():
+    cache = FailureRegionCache(scale={'a': 1., 'b': 1.}, k=3, radius=0.1)
+    for i in range(5):
+        cache.record({'a': 0.01*i, 'b': 0.}, True)
+    cache.record({'a': 1., 'b': 1.}, False)
+    assert cache.should_skip({'a': 0.02, 'b': 0.})
+    assert not cache.should_skip({'a': 0.9, 'b': 0.9})
+
+    cache.reset()
+    assert cache.counters() == {'evaluated': 0, 'failed': 0, 'skipped': 0}
+    assert not cache.should_skip({'a': 0.02, 'b': 0.})
+
+
+def test_pickling_fails_clearly():
+    cache = FailureRegionCache(parameters=['a'])
+    with pytest.raises(TypeError, match='fork'):
+        pickle.dumps(cache)
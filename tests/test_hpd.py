@@ -0,0 +1,36 @@
+import numpy as np
+
+from ionchannelABC.hpd import hpd
+
+
+def _narrowest(x, credible_interval):
+    x = np.sort(x[~np.isnan(x)])
+    m = int(np.floor(credible_interval*len(x)))
+    widths = [x[i+m]-x[i] for i in range(len(x)-m)]
+    i = int(np.argmin(widths))
+    return x[i], x[i+m]
+
+
+def test_matches_narrowest_interval_per_point():
+    rng = np.random.RandomState(0)
+    samples = np.column_stack([rng.normal(size=500),
+                               rng.exponential(size=500),
+                               rng.uniform(size=500)])
+    samples[:50, 0] = np.nan
+
+    intervals = hpd(samples, credible_interval=0.9)
+    assert intervals.shape == (3, 2)
+    for j in range(3):
+        np.testing.assert_allclose(intervals[j],
+                                   _narrowest(samples[:, j], 0.9))
+    # Skewed distribution is cut at its mode
+    assert intervals[1, 0] < 0.05
+
+
+def test_levels_and_single_point():
+    x = np.random.RandomState(1).normal(size=20000)
+    intervals = hpd(x, credible_interval=[0.5, 0.95])
+    assert intervals.shape == (2, 2)
+    np.testing.assert_allclose(intervals[1], [-1.96, 1.96], atol=0.1)
+    assert intervals[0, 0] > intervals[1, 0]
+    assert intervals[0, 1] < intervals[1, 1]
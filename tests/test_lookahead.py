@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from pyabc import ABCSMC, Distribution, RV
+from pyabc.epsilon import ListEpsilon
+from pyabc.sampler import SingleCoreSampler
+from pyabc.transition import MultivariateNormalTransition
+
+from ionchannelABC.lookahead import LookAheadSampler
+
+
+PRIOR = Distribution(a=RV('uniform', 0, 1))
+
+
+def _proposal(transition):
+    """Proposal as drawn by pyABC, redrawn outside the prior support."""
+    while True:
+        par = transition.rvs_single()
+        if PRIOR.pdf(par) > 0:
+            return float(par['a'])
+
+
+def _fit(transition, a):
+    transition.fit(pd.DataFrame({'a': a}), np.ones(len(a))/len(a))
+    return transition
+
+
+@pytest.mark.parametrize('M', [1., 2.])
+def test_replayed_slots_follow_proposal_on_bounded_prior(M):
+    np.random.seed(0)
+    sampler = LookAheadSampler(None, None, PRIOR,
+                               transition=MultivariateNormalTransition(),
+                               M=M)
+    # Preliminary and final transitions differ and straddle the bound
+    prelim = _fit(MultivariateNormalTransition(),
+                  np.random.uniform(0.05, 0.4, size=50))
+    ahead = []
+    while len(ahead) < 4000:
+        sampler._propose_ahead(prelim, ahead)
+    sampler._bank = [tuple(a) for a in ahead]
+    sampler._bank_fit = sampler.transition.n_fit
+    _fit(sampler.transition, np.random.uniform(0., 0.2, size=50))
+
+    replay = sampler._take_bank(prelim)
+    assert len(replay) == len(ahead)
+    slots = []
+    for par, _ in replay:
+        if PRIOR.pdf(pd.Series(par)) > 0:
+            slots.append(par['a'])
+        else:
+            slots.append(_proposal(sampler.transition))
+    direct = [_proposal(sampler.transition) for _ in range(len(slots))]
+    assert stats.ks_2samp(slots, direct).pvalue > 1e-3
+
+
+def _model(pars):
+    return {'y': pars['a']+0.05*np.random.normal()}
+
+
+def _summary_statistics(data):
+    return data
+
+
+def _distance(x, x_0):
+    return abs(x['y']-x_0['y'])
+
+
+def _posterior(tmpdir, name, sampler, model, summary_statistics,
+               transition):
+    abc = ABCSMC(models=model,
+                 parameter_priors=PRIOR,
+                 distance_function=_distance,
+                 population_size=300,
+                 summary_statistics=summary_statistics,
+                 transitions=transition,
+                 eps=ListEpsilon([0.2, 0.1, 0.05]),
+                 sampler=sampler)
+    abc.new('sqlite:///'+str(tmpdir.join(name+'.db')), {'y': 0.05})
+    history = abc.run(minimum_epsilon=0.05, max_nr_populations=3)
+    df, w = history.get_distribution()
+    return df['a'].values, w
+
+
+def test_marginals_agree_with_plain_sampling(tmpdir):
+    np.random.seed(1)
+    sampler = LookAheadSampler(_model, _summary_statistics, PRIOR, n_procs=2)
+    a, w = _posterior(tmpdir, 'look_ahead', sampler, sampler.model,
+                      sampler.summary_statistics, sampler.transition)
+    a_plain, w_plain = _posterior(tmpdir, 'plain', SingleCoreSampler(),
+                                  _model, _summary_statistics,
+                                  MultivariateNormalTransition())
+
+    mean, mean_plain = np.average(a, weights=w), np.average(a_plain,
+                                                            weights=w_plain)
+    std = np.sqrt(np.average((a-mean)**2, weights=w))
+    std_plain = np.sqrt(np.average((a_plain-mean_plain)**2, weights=w_plain))
+    assert abs(mean-mean_plain) < 0.02
+    assert abs(std-std_plain) < 0.02
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from pyabc.epsilon import ConstantEpsilon
+
+from ionchannelABC.multifidelity import MultiFidelity
+
+
+def _model(pars):
+    return {'0': pars['a']}
+
+
+def _coarse_model(pars):
+    # Far from the observation, so every particle is outside the margin
+    return {'0': pars['a']+10.}
+
+
+def _summary_statistics(data):
+    if data is None:
+        return {'0': np.inf}
+    return data
+
+
+def _distance(x, x_0, t=None, par=None):
+    return abs(x['0']-x_0['0'])
+
+
+def test_audited_weights_are_unbiased():
+    np.random.seed(0)
+    mf = MultiFidelity(_model, _summary_statistics, _coarse_model,
+                       _summary_statistics, _distance,
+                       pd.DataFrame({'y': [0.]}), margin=0.,
+                       audit_probability=0.25, eps=ConstantEpsilon(1.))
+    # Epsilon is known before the first particle is simulated
+    assert mf.epsilon(0) == 1.
+
+    n = 4000
+    weights = np.zeros(n)
+    for i in range(n):
+        par = {'a': np.random.uniform(0., 0.5)}
+        ss = mf.summary_statistics(mf.model(par))
+        result = mf.acceptor(_distance, mf.epsilon, ss, {'0': 0.}, 0, par)
+        if result.accept:
+            weights[i] = result.weight
+        else:
+            # Rejected at low fidelity with the failure value
+            assert ss == {'0': np.inf}
+
+    assert mf.n_full == mf.n_audited
+    assert abs(mf.fraction_avoided-0.75) < 0.05
+    # Every particle has expected weight 1, as without early rejection
+    assert abs(np.mean(weights)-1.) < 0.1
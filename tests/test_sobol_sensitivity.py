@@ -0,0 +1,26 @@
+import numpy as np
+
+from ionchannelABC.sobol_sensitivity import sobol_indices
+
+
+def _ishigami(X, a=7., b=0.1):
+    return (np.sin(X[..., 0]) + a*np.sin(X[..., 1])**2 +
+            b*X[..., 2]**4*np.sin(X[..., 0]))[..., np.newaxis]
+
+
+def test_ishigami_indices():
+    rng = np.random.RandomState(0)
+    n = 20000
+    A = rng.uniform(-np.pi, np.pi, size=(n, 3))
+    B = rng.uniform(-np.pi, np.pi, size=(n, 3))
+    AB = np.repeat(A[np.newaxis], 3, axis=0)
+    for i in range(3):
+        AB[i, :, i] = B[:, i]
+
+    S1, ST, S1_conf, ST_conf = sobol_indices(_ishigami(A), _ishigami(B),
+                                             _ishigami(AB), seed=1)
+
+    # Analytical values for a=7, b=0.1
+    np.testing.assert_allclose(S1[:, 0], [0.3139, 0.4424, 0.], atol=0.05)
+    np.testing.assert_allclose(ST[:, 0], [0.5576, 0.4424, 0.2437], atol=0.05)
+    assert np.all(S1_conf > 0) and np.all(ST_conf > 0)